@@ -0,0 +1,82 @@
+""" Synthetic documents for the benchmarks, loaded into a local knowledge base
+or a Redis Stack instance. The embeddings come from whatever openai.api_base
+points to, normally the fake server in fake_openai.py.
+"""
+import random
+
+import redis
+
+from chatbot.chatbot import (
+    KnowledgeBaseLocal,
+    KnowledgeBaseRedis,
+    write_knowledge_base_local,
+)
+from chatbot.redis_utils.add_to_redis import batched, embed_texts
+from chatbot.redis_utils.create_index import create_index
+
+# The fake server doesn't check it, but openai needs one
+API_KEY = "benchmark"
+
+
+def make_vocabulary(size: int = 2000, seed: int = 0) -> list[str]:
+    """ Made up words of 2 to 10 letters."""
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [
+        "".join(rng.choices(letters, k=rng.randint(2, 10)))
+        for _ in range(size)
+    ]
+
+
+def make_text(num_words: int, rng: random.Random, vocabulary: list[str]) -> str:
+    """ A paragraph of random words, with a sentence break every 15 words."""
+    words = rng.choices(vocabulary, k=num_words)
+    sentences = [
+        " ".join(words[i:i + 15]).capitalize() + "."
+        for i in range(0, num_words, 15)
+    ]
+    return " ".join(sentences)
+
+
+def make_texts(num_texts: int, num_words: int, seed: int = 0) -> list[str]:
+    """ Deterministic synthetic documents."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(seed=seed)
+    return [make_text(num_words, rng, vocabulary) for _ in range(num_texts)]
+
+
+def load_local(path: str, texts: list[str], **kwargs) -> KnowledgeBaseLocal:
+    """ Embed the texts and write them to a local knowledge base, the keyword
+    arguments are passed to KnowledgeBaseLocal."""
+    documents = [
+        {"url": f"bench/{i}", "content": text} for i, text in enumerate(texts)
+    ]
+    write_knowledge_base_local(path, documents, embed_texts(texts))
+    return KnowledgeBaseLocal(path, api_key=API_KEY, **kwargs)
+
+
+def load_redis(
+        redis_url: str,
+        texts: list[str],
+        index_name: str = "bench",
+        **kwargs) -> KnowledgeBaseRedis:
+    """ Embed the texts and store them in Redis under their own index and
+    prefix, the keyword arguments are passed to KnowledgeBaseRedis. Remove
+    them afterwards with drop_redis."""
+    db = redis.from_url(redis_url)
+    prefix = f"{index_name}:"
+    create_index(db, index_name, prefix, algorithm="FLAT")
+    vectors = embed_texts(texts)
+    for batch in batched(enumerate(zip(texts, vectors)), 500):
+        pipe = db.pipeline(transaction=False)
+        for i, (text, vector) in batch:
+            pipe.hset(f"{prefix}{i}", mapping={
+                "url": f"bench/{i}", "content": text, "embedding": vector})
+        pipe.execute()
+    return KnowledgeBaseRedis(
+        redis_url, api_key=API_KEY, index_name=index_name, **kwargs)
+
+
+def drop_redis(redis_url: str, index_name: str = "bench"):
+    """ Drop the benchmark index and its documents."""
+    redis.from_url(redis_url).ft(index_name).dropindex(delete_documents=True)
@@ -0,0 +1,167 @@
+""" A local stand-in for OpenAI's chat completions and embeddings endpoints,
+so the benchmarks measure this library instead of the network. Each request
+sleeps for a configurable latency (plus optional jitter) before answering.
+Embeddings are deterministic for a given text, so caches behave as they would
+against the real API.
+
+It can be started in the same process with :func:`start_server`, or on its
+own so other processes can use it:
+
+    python fake_openai.py --port 8123 --latency 0.2
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """ A normalized float32 vector that only depends on the text."""
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    seed = int.from_bytes(digest[:8], "big")
+    vector = np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers /v1/chat/completions (streamed or not) and /v1/embeddings."""
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write, small separate writes make the client
+    # wait for delayed ACKs and add ~40ms to every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        if self.path.endswith("/embeddings"):
+            self._send_json(self._embeddings(body))
+        elif self.path.endswith("/chat/completions"):
+            if body.get("stream"):
+                self._send_stream(body)
+            else:
+                self._send_json(self._completion(body))
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        # Logging every request would dominate the measurements
+        pass
+
+    def _embeddings(self, body: dict) -> dict:
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            vector = fake_embedding(text)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text.split()) for text in texts)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def _reply(self) -> str:
+        return " ".join(["benchmark"] * self.server.reply_words)
+
+    def _completion(self, body: dict) -> dict:
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self._reply()},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0,
+                      "completion_tokens": self.server.reply_words,
+                      "total_tokens": self.server.reply_words},
+        }
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        deltas = [{"role": "assistant"}]
+        deltas += [{"content": word + " "} for word in self._reply().split()]
+        for delta in deltas + [{}]:
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": delta,
+                             "finish_reason": None if delta else "stop"}],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_server(
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        reply_words: int = 50,
+        port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """ Start the fake server in a background thread, returns the server
+    (call shutdown() to stop it) and the API base URL to give openai. Each
+    request waits latency seconds, plus up to jitter more, and completions
+    are reply_words long. By default it listens on a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.reply_words = reply_words
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI API.")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--reply-words", type=int, default=50)
+    args = parser.parse_args()
+    server, api_base = start_server(
+        args.latency, args.jitter, args.reply_words, args.port)
+    print(f"Set openai.api_base = {api_base!r}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+""" Benchmarks of the chatbot's own overhead, without network access.
+
+The OpenAI API is replaced by the local fake server in fake_openai.py (with
+--latency to simulate the real one), and the knowledge base is filled with
+synthetic documents, locally or in a Redis Stack given with --redis-url.
+Results are printed (or written with --output) as JSON, one entry per
+benchmark and set of parameters, with the throughput and p50/p95/p99 latency,
+so runs from different versions can be compared. For example:
+
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --latency 0.3 --output results.json
+
+tiktoken downloads its encodings the first time they're used, run once with
+network access (or set TIKTOKEN_CACHE_DIR to a warm cache) to work offline.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import openai
+
+# Run as a script, only benchmarks/ is on the path, add the repo root so the
+# chatbot package is imported from this checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from chatbot.chatbot import (  # noqa: E402
+    ChatBot,
+    GPT_MODEL,
+    MessageMemory,
+    SessionMemoryStore,
+)
+from chatbot.redis_utils.add_to_redis import write_local  # noqa: E402
+from chatbot.utils import (  # noqa: E402
+    get_encoding,
+    message_tokens,
+    num_tokens,
+)
+
+import corpus  # noqa: E402
+from fake_openai import start_server  # noqa: E402
+
+BENCHMARKS = ("import", "num_tokens", "trim", "get_reply", "ingestion")
+IMPORT_MODULES = ("chatbot.chatbot", "chatbot.async_chatbot")
+# Run in a fresh interpreter, prints the import time then the time to load
+# the tokenizer, which ChatBot.warmup() moves to startup
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from chatbot.utils import get_encoding
+get_encoding({model!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def summarize(latencies: list[float], wall_time: float) -> dict:
+    """ Throughput and latency percentiles of a set of timed calls."""
+    latencies = np.array(latencies) * 1000
+    return {
+        "iterations": len(latencies),
+        "throughput_per_s": len(latencies) / wall_time,
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def measure(fn, iterations: int, concurrency: int = 1, warmup: int = 1) -> dict:
+    """ Call fn(i) iterations times, from concurrency threads, and summarize
+    the latency of each call."""
+    for i in range(warmup):
+        fn(i)
+    latencies = []
+
+    def timed(i):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for i in range(iterations):
+            timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, range(iterations)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def make_history(length: int, words: int = 60, seed: int = 0) -> list[dict]:
+    """ A conversation of alternating user and assistant messages."""
+    texts = corpus.make_texts(length, words, seed)
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": text}
+        for i, text in enumerate(texts)
+    ]
+
+
+def bench_import(args) -> list[dict]:
+    """ Cold start: importing the modules, and loading the tokenizer."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+    results = []
+    for module in IMPORT_MODULES:
+        imports, loads = [], []
+        for _ in range(args.import_iterations):
+            output = subprocess.run(
+                [sys.executable, "-c",
+                 IMPORT_SCRIPT.format(module=module, model=GPT_MODEL)],
+                env=env, capture_output=True, text=True, check=True).stdout
+            import_time, load_time = map(float, output.split())
+            imports.append(import_time)
+            loads.append(load_time)
+        results.append({
+            "benchmark": "import",
+            "params": {"module": module},
+            **summarize(imports, sum(imports)),
+        })
+    # The same whichever module was imported first
+    results.append({
+        "benchmark": "tokenizer_load",
+        "params": {"model": GPT_MODEL},
+        **summarize(loads, sum(loads)),
+    })
+    return results
+
+
+def bench_num_tokens(args) -> list[dict]:
+    results = []
+    for history in args.history:
+        messages = make_history(history)
+        results.append({
+            "benchmark": "num_tokens",
+            "params": {"history": history},
+            **measure(lambda i: num_tokens(messages, GPT_MODEL), args.iterations),
+        })
+    return results
+
+
+def bench_trim(args) -> list[dict]:
+    results = []
+    bot = ChatBot(api_key=corpus.API_KEY)
+    encoding = get_encoding(GPT_MODEL)
+    for history in args.history:
+        messages = make_history(history)
+        # get_reply passes the counts cached by the message memory
+        counts = [message_tokens(m, encoding) for m in messages]
+        for context_words in args.context:
+            context = corpus.make_texts(1, context_words, seed=1)[0]
+
+            def trim(i):
+                bot._trim_to_fit_token_limit(list(messages), context, counts)
+
+            results.append({
+                "benchmark": "trim",
+                "params": {"history": history, "context_words": context_words},
+                **measure(trim, args.iterations),
+            })
+    return results
+
+
+def knowledge_bases(args, workdir: str):
+    """ Yields (name, knowledge base) for each store to benchmark."""
+    yield "none", None
+    texts = corpus.make_texts(args.docs, args.doc_words)
+    yield "local", corpus.load_local(os.path.join(workdir, "kb"), texts)
+    if args.redis_url:
+        index_name = f"bench_{os.getpid()}"
+        try:
+            yield "redis", corpus.load_redis(args.redis_url, texts, index_name)
+        finally:
+            corpus.drop_redis(args.redis_url, index_name)
+
+
+def bench_get_reply(args, workdir: str) -> list[dict]:
+    results = []
+    queries = corpus.make_texts(64, 20, seed=2)
+    for store, knowledge_base in knowledge_bases(args, workdir):
+        for history in args.history:
+            messages = make_history(history)
+
+            def memory_factory(session_id):
+                # Start every conversation with a full history
+                memory = MessageMemory(memory_length=history)
+                for message in messages:
+                    memory._append(message)
+                return memory
+
+            for concurrency in args.concurrency:
+                bot = ChatBot(
+                    api_key=corpus.API_KEY,
+                    knowledge_base=knowledge_base,
+                    session_store=SessionMemoryStore(memory_factory))
+
+                def get_reply(i):
+                    # One conversation per thread, so they don't wait on
+                    # each other's session lock
+                    bot.get_reply(
+                        queries[i % len(queries)],
+                        session_id=threading.current_thread().name)
+
+                results.append({
+                    "benchmark": "get_reply",
+                    "params": {
+                        "store": store,
+                        "history": history,
+                        "concurrency": concurrency,
+                        "latency_s": args.latency,
+                    },
+                    **measure(get_reply, args.iterations, concurrency),
+                })
+    return results
+
+
+def bench_ingestion(args, workdir: str) -> list[dict]:
+    results = []
+    for num_posts in args.posts:
+        texts = corpus.make_texts(num_posts, args.post_words, seed=3)
+        posts = [(f"bench/{i}", text) for i, text in enumerate(texts)]
+        path = os.path.join(workdir, f"ingest_{num_posts}")
+
+        def ingest(i):
+            # Remove the previous run, or every post would be unchanged
+            for name in ("embeddings.npy", "documents.jsonl"):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+            write_local(path, posts)
+
+        result = measure(ingest, args.ingest_iterations, warmup=0)
+        result["posts_per_s"] = result["throughput_per_s"] * num_posts
+        results.append({
+            "benchmark": "ingestion",
+            "params": {"posts": num_posts, "post_words": args.post_words,
+                       "latency_s": args.latency},
+            **result,
+        })
+    return results
+
+
+def git_commit() -> str | None:
+    """ The commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chatbot against a fake OpenAI API.")
+    parser.add_argument(
+        "--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="seconds the fake API waits before answering")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument(
+        "--redis-url", default=os.getenv("REDIS_URL"),
+        help="a Redis Stack to also benchmark KnowledgeBaseRedis with")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--import-iterations", type=int, default=10,
+        help="fresh interpreters to time the imports in")
+    parser.add_argument("--history", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--context", type=int, nargs="+", default=[0, 500, 15000],
+        help="context sizes in words, the largest has to be truncated")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--doc-words", type=int, default=200)
+    parser.add_argument("--posts", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--post-words", type=int, default=1000)
+    parser.add_argument("--ingest-iterations", type=int, default=3)
+    parser.add_argument(
+        "--quick", action="store_true", help="fewer iterations and sizes")
+    parser.add_argument("--output", help="write the JSON results to a file")
+    args = parser.parse_args()
+    if args.quick:
+        args.iterations = 20
+        args.import_iterations = 3
+        args.history = args.history[:2]
+        args.concurrency = args.concurrency[:2]
+        args.docs = 200
+        args.posts = args.posts[:1]
+        args.ingest_iterations = 1
+
+    server, api_base = start_server(args.latency, args.jitter)
+    openai.api_base = api_base
+    openai.api_key = corpus.API_KEY
+    results = []
+    try:
+        # The chatbot prints warnings, keep stdout for the results
+        with (tempfile.TemporaryDirectory() as workdir,
+              contextlib.redirect_stdout(sys.stderr)):
+            if "import" in args.only:
+                results += bench_import(args)
+            if "num_tokens" in args.only:
+                results += bench_num_tokens(args)
+            if "trim" in args.only:
+                results += bench_trim(args)
+            if "get_reply" in args.only:
+                results += bench_get_reply(args, workdir)
+            if "ingestion" in args.only:
+                results += bench_ingestion(args, workdir)
+    finally:
+        server.shutdown()
+
+    report = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
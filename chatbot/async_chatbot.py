@@ -0,0 +1,488 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import aiohttp
+import openai
+
+from chatbot import instrumentation
+from chatbot.chatbot import (
+    BaseKnowledgeBase,
+    BaseMessageMemory,
+    ChatBot,
+    DEFAULT_PROMPT,
+    EMBEDDING_MODEL,
+    GPT_MODEL,
+    KnowledgeBaseRedis,
+    SessionMemoryStore,
+)
+from chatbot.embedding_batcher import EmbeddingBatcher
+from chatbot.embedding_cache import BaseEmbeddingCache, aget_embedding
+from chatbot.instrumentation import BaseInstrumentation
+from chatbot.rate_limiter import RateLimiter
+from chatbot.response_cache import BaseResponseCache
+from chatbot.utils import compact_vector, get_encoding
+
+
+class AsyncKnowledgeBaseRedis(KnowledgeBaseRedis):
+    """Asyncio version of :class:`KnowledgeBaseRedis`. Uses an async Redis
+    client backed by a connection pool, so many concurrent queries can share
+    a handful of connections without blocking the event loop. The sync
+    :meth:`get_context` is still available.
+
+    :param redis_url: The URL for the Redis instance
+    :type redis_url: str
+    :param api_key: The API key for OpenAI's API
+    :type api_key: str
+    :param max_connections: The size of the async Redis connection pool,
+        defaults to 50
+    :type max_connections: int, optional
+    :param embedding_cache: Cache for the query embeddings, defaults to None
+    :type embedding_cache: :class:`BaseEmbeddingCache`, optional
+    :param top_k: The number of documents to fetch for each query, defaults
+        to 4
+    :type top_k: int, optional
+    :param context_tokens: The maximum number of tokens of context, defaults
+        to 1500
+    :type context_tokens: int, optional
+    :param index_name: The name of the Redis search index, defaults to
+        "posts"
+    :type index_name: str, optional
+    :param ef_runtime: The size of the HNSW candidate list at query time,
+        defaults to None (the index's default)
+    :type ef_runtime: int, optional
+    :param vector_type: The type of the index's vector field, "FLOAT32" or
+        "FLOAT16", defaults to "FLOAT32"
+    :type vector_type: str, optional
+    :param dim: The number of dimensions kept in the index, defaults to None
+        (all of them)
+    :type dim: int, optional
+    :param embedding_batcher: Batches the query embeddings of concurrent
+        requests into fewer API calls, defaults to None
+    :type embedding_batcher: :class:`EmbeddingBatcher`, optional
+    :param rate_limiter: Schedules and retries the embedding calls, defaults
+        to None. A batcher uses its own.
+    :type rate_limiter: :class:`RateLimiter`, optional
+    :param mmr_lambda: Re-rank the documents by Maximal Marginal Relevance,
+        defaults to None (no re-ranking)
+    :type mmr_lambda: float, optional
+    :param fetch_k: The number of candidates fetched to re-rank or dedupe,
+        defaults to 20
+    :type fetch_k: int, optional
+    :param dedupe_threshold: Drop documents with a cosine similarity above
+        this to a more relevant one, defaults to None (no dedupe)
+    :type dedupe_threshold: float, optional
+    """
+    def __init__(
+            self,
+            redis_url: str,
+            api_key: str,
+            max_connections: int = 50,
+            embedding_cache: BaseEmbeddingCache = None,
+            top_k: int = 4,
+            context_tokens: int = 1500,
+            index_name: str = "posts",
+            ef_runtime: int = None,
+            vector_type: str = "FLOAT32",
+            dim: int = None,
+            embedding_batcher: EmbeddingBatcher = None,
+            rate_limiter: RateLimiter = None,
+            mmr_lambda: float = None,
+            fetch_k: int = 20,
+            dedupe_threshold: float = None):
+        super().__init__(
+            redis_url,
+            api_key,
+            embedding_cache=embedding_cache,
+            top_k=top_k,
+            context_tokens=context_tokens,
+            index_name=index_name,
+            ef_runtime=ef_runtime,
+            vector_type=vector_type,
+            dim=dim,
+            embedding_batcher=embedding_batcher,
+            rate_limiter=rate_limiter,
+            mmr_lambda=mmr_lambda,
+            fetch_k=fetch_k,
+            dedupe_threshold=dedupe_threshold)
+        import redis.asyncio
+        self.async_redis_client = redis.asyncio.from_url(
+            redis_url,
+            encoding='utf-8',
+            decode_responses=True,
+            socket_timeout=3.0,
+            max_connections=max_connections)
+
+    async def aget_context(self, user_query: str) -> str | None:
+        """Get the context for the user's query without blocking the event
+        loop.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The context for the user's query
+        :rtype: str | None
+        """
+        return await self._asearch_vectors(
+            await self.aget_embedding(user_query))
+
+    async def aget_embedding(self, user_query: str) -> bytes:
+        """Async version of :meth:`get_embedding`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The embedding of the query
+        :rtype: bytes
+        """
+        return await aget_embedding(
+            user_query,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.embedding_batcher,
+            self.rate_limiter)
+
+    async def awarmup(self):
+        """Async version of :meth:`warmup`, also opens a connection of the
+        async pool.
+
+        :raises redis.ResponseError: If the index doesn't exist
+        """
+        await asyncio.to_thread(self.warmup)
+        await self.async_redis_client.ping()
+
+    async def asearch_documents(
+            self, query_vector: bytes, top_k: int = None) -> list[dict]:
+        """Async version of :meth:`search_documents`.
+
+        :param query_vector: The vector to search for, as float32 bytes
+        :type query_vector: bytes
+        :param top_k: The number of documents to return, defaults to
+            ``top_k``
+        :type top_k: int, optional
+        :return: The documents with their scores, in the order they're used
+        :rtype: list[dict]
+        """
+        top_k = top_k or self.top_k
+        query_vector = compact_vector(query_vector, self.vector_type, self.dim)
+        if not self._reranks():
+            with instrumentation.stage("search"):
+                index = self.async_redis_client.ft(self.index_name)
+                results = await index.search(
+                    self._knn_query(top_k),
+                    query_params={"vector": query_vector})
+            return self._documents(results)
+        from redis.client import NEVER_DECODE
+        with instrumentation.stage("search"):
+            reply = await self.async_redis_client.execute_command(
+                *self._vector_search_args(query_vector, top_k),
+                **{NEVER_DECODE: []})
+        return self._rerank(query_vector, self._candidates(reply), top_k)
+
+    async def _asearch_vectors(
+            self, query_vector: bytes, top_k: int = None) -> str | None:
+        """ Async version of `_search_vectors`. Not meant to be called
+        directly, only implemented as a helper method for `aget_context`.
+
+        :param query_vector: The vector to search for
+        :type query_vector: bytes
+        :param top_k: The number of results to return, defaults to ``top_k``
+        :type top_k: int, optional
+        :return: The content of the most similar vectors that fit in the
+            context token budget
+        :rtype: str | None
+        """
+        try:
+            documents = await self.asearch_documents(query_vector, top_k)
+        except Exception as e:
+            print("Error calling Redis search: ", e)
+            return None
+        return self._pack(documents)
+
+    async def aclose(self):
+        """Close the async Redis connection pool."""
+        await self.async_redis_client.close()
+
+
+class AsyncChatBot(ChatBot):
+    """ Asyncio version of :class:`ChatBot`. Use :meth:`aget_reply` from async
+    code (e.g. ``async def`` FastAPI endpoints) so that a single worker can
+    serve many concurrent requests while they wait on the network.
+
+    All calls to OpenAI's API share one ``aiohttp`` session with a keep-alive
+    connection pool, instead of opening a new connection per request. Call
+    :meth:`aclose` on shutdown to release it.
+
+    The message memory and knowledge base are used through their async
+    methods (:meth:`BaseMessageMemory.aget_message_list`,
+    :meth:`BaseKnowledgeBase.aget_context`, etc.), use
+    :class:`AsyncKnowledgeBaseRedis` to get a non-blocking Redis search.
+
+    :param api_key: The API key for OpenAI's API
+    :type api_key: str
+    :param prompt: The prompt to use when calling OpenAI's API, defaults to
+        "You're a nice helpful chatbot."
+    :type prompt: str, optional
+    :param message_memory: The message memory to use, defaults to a new
+        :class:`MessageMemory`
+    :type message_memory: :class:`BaseMessageMemory`, optional
+    :param knowledge_base: The knowledge base to use, defaults to None.
+    :type knowledge_base: :class:`BaseKnowledgeBase`, optional
+    :param gpt_model: The GPT model to use, defaults to "gpt-3.5-turbo".
+    :type gpt_model: str, optional
+    :param response_cache: Cache of past replies, defaults to None.
+    :type response_cache: :class:`BaseResponseCache`, optional
+    :param session_store: Store of per conversation memories, defaults to None.
+    :type session_store: :class:`SessionMemoryStore`, optional
+    :param instrumentation: Hooks to time each stage of a request, defaults
+        to None
+    :type instrumentation: :class:`BaseInstrumentation`, optional
+    :param connection_limit: The maximum number of pooled connections to
+        OpenAI's API, defaults to 100
+    :type connection_limit: int, optional
+    :param keepalive_timeout: How long to keep idle connections open, in
+        seconds, defaults to 60
+    :type keepalive_timeout: float, optional
+    :param rate_limiter: Schedules and retries the completion calls,
+        defaults to None
+    :type rate_limiter: :class:`RateLimiter`, optional
+    """
+    def __init__(
+            self,
+            api_key: str,
+            prompt: str = DEFAULT_PROMPT,
+            message_memory: BaseMessageMemory = None,
+            knowledge_base: BaseKnowledgeBase = None,
+            gpt_model: str = GPT_MODEL,
+            response_cache: BaseResponseCache = None,
+            session_store: SessionMemoryStore = None,
+            instrumentation: BaseInstrumentation = None,
+            connection_limit: int = 100,
+            keepalive_timeout: float = 60.0,
+            rate_limiter: RateLimiter = None):
+        super().__init__(
+            api_key=api_key,
+            prompt=prompt,
+            message_memory=message_memory,
+            knowledge_base=knowledge_base,
+            gpt_model=gpt_model,
+            response_cache=response_cache,
+            session_store=session_store,
+            instrumentation=instrumentation,
+            rate_limiter=rate_limiter)
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """ Returns the pooled ``aiohttp`` session, creating it on first use.
+        It has to be created lazily because it binds to the running event
+        loop. This method is not intended to be called directly.
+
+        :return: The shared client session
+        :rtype: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connection_limit,
+                    keepalive_timeout=self.keepalive_timeout))
+        return self._session
+
+    async def _acreate_completion(
+            self, prompt: str, message_list: list, token_counts: list[int],
+            **kwargs):
+        """ Async version of `_create_completion`. This method is not
+        intended to be called directly."""
+        kwargs.update(self._completion_kwargs(prompt, message_list))
+        if self.rate_limiter is None:
+            return await openai.ChatCompletion.acreate(**kwargs)
+        return await self.rate_limiter.acall(
+            openai.ChatCompletion.acreate,
+            self._estimate_tokens(prompt, message_list, token_counts),
+            **kwargs)
+
+    async def awarmup(self, check_api: bool = False):
+        """Async version of :meth:`warmup`, also creates the pooled
+        ``aiohttp`` session. The blocking parts run in a worker thread.
+
+        :param check_api: Also call OpenAI's API once, which opens a pooled
+            connection and checks the API key and model, defaults to False
+        :type check_api: bool, optional
+        """
+        await asyncio.to_thread(get_encoding, self.gpt_model)
+        if self.knowledge_base:
+            await self.knowledge_base.awarmup()
+        if self.response_cache:
+            await asyncio.to_thread(self.response_cache.warmup)
+        session = self._get_session()
+        if check_api:
+            openai.aiosession.set(session)
+            await openai.Model.aretrieve(self.gpt_model)
+
+    async def aget_reply(self, user_query: str, session_id: str = None) -> str:
+        """Get a reply from the chatbot without blocking the event loop.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param session_id: The id of the conversation, defaults to None. If
+            given, the history of that conversation is used from the
+            ``session_store`` instead of the ``message_memory``.
+        :type session_id: str, optional
+        :return: The chatbot's response
+        :rtype: str
+        """
+        # openai picks the session up from a context variable, so this only
+        # affects the current task
+        openai.aiosession.set(self._get_session())
+        with instrumentation.request(self.instrumentation, "aget_reply"):
+            if session_id is None:
+                return await self._aget_reply(user_query, self.message_memory)
+            self._check_session_store()
+            async with self.session_store.asession(
+                    session_id) as message_memory:
+                return await self._aget_reply(user_query, message_memory)
+
+    async def _aget_reply(
+            self, user_query: str, message_memory: BaseMessageMemory) -> str:
+        """ Get a reply using the given message memory. This method is not
+        intended to be called directly, use :meth:`aget_reply`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param message_memory: The memory of the conversation
+        :type message_memory: :class:`BaseMessageMemory`
+        :return: The chatbot's response
+        :rtype: str
+        """
+        with instrumentation.stage("memory"):
+            await message_memory.aadd_latest_user_query(user_query)
+            message_list, token_counts = (
+                await message_memory.aget_messages_with_token_counts())
+        context = None
+        if self.knowledge_base:
+            with instrumentation.stage("context"):
+                context = await self.knowledge_base.aget_context(user_query)
+            self._record_context_tokens(context)
+        try:
+            if self.response_cache:
+                with instrumentation.stage("response_cache"):
+                    cached = await self.response_cache.alookup(
+                        user_query, context)
+                instrumentation.record_cache("response", cached is not None)
+                if cached is not None:
+                    await message_memory.aadd_latest_bot_response(
+                        {"role": "assistant", "content": cached})
+                    return cached
+            with instrumentation.stage("trim"):
+                prompt = self._trim_to_fit_token_limit(
+                    message_list, context, token_counts)
+            with instrumentation.stage("completion"):
+                completion = await self._acreate_completion(
+                    prompt, message_list, token_counts)
+            self._record_completion_tokens(completion)
+            response = completion["choices"][0]["message"]
+            with instrumentation.stage("save"):
+                await message_memory.aadd_latest_bot_response(response)
+                if self.response_cache:
+                    await self.response_cache.astore(
+                        user_query, context, response["content"])
+            return response["content"]
+        except Exception as e:
+            print(e)
+            raise(e)
+
+    async def aget_reply_stream(
+            self, user_query: str,
+            session_id: str = None) -> AsyncIterator[str]:
+        """Async version of :meth:`get_reply_stream`, yields the content
+        deltas of the reply as they arrive. The complete response is added to
+        the message memory when the stream is finished.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param session_id: The id of the conversation, defaults to None.
+        :type session_id: str, optional
+        :return: Async iterator over the pieces of the chatbot's response
+        :rtype: AsyncIterator[str]
+        """
+        openai.aiosession.set(self._get_session())
+        with instrumentation.request(self.instrumentation, "aget_reply_stream"):
+            if session_id is None:
+                async for delta in self._aget_reply_stream(
+                        user_query, self.message_memory):
+                    yield delta
+                return
+            self._check_session_store()
+            async with self.session_store.asession(
+                    session_id) as message_memory:
+                async for delta in self._aget_reply_stream(
+                        user_query, message_memory):
+                    yield delta
+
+    async def _aget_reply_stream(
+            self, user_query: str,
+            message_memory: BaseMessageMemory) -> AsyncIterator[str]:
+        """ Stream a reply using the given message memory. This method is not
+        intended to be called directly, use :meth:`aget_reply_stream`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param message_memory: The memory of the conversation
+        :type message_memory: :class:`BaseMessageMemory`
+        :return: Async iterator over the pieces of the chatbot's response
+        :rtype: AsyncIterator[str]
+        """
+        with instrumentation.stage("memory"):
+            await message_memory.aadd_latest_user_query(user_query)
+            message_list, token_counts = (
+                await message_memory.aget_messages_with_token_counts())
+        context = None
+        if self.knowledge_base:
+            with instrumentation.stage("context"):
+                context = await self.knowledge_base.aget_context(user_query)
+            self._record_context_tokens(context)
+        try:
+            if self.response_cache:
+                with instrumentation.stage("response_cache"):
+                    cached = await self.response_cache.alookup(
+                        user_query, context)
+                instrumentation.record_cache("response", cached is not None)
+                if cached is not None:
+                    await message_memory.aadd_latest_bot_response(
+                        {"role": "assistant", "content": cached})
+                    yield cached
+                    return
+            with instrumentation.stage("trim"):
+                prompt = self._trim_to_fit_token_limit(
+                    message_list, context, token_counts)
+            # Includes the time the caller takes to consume the stream
+            with instrumentation.stage("completion"):
+                chunks = await self._acreate_completion(
+                    prompt, message_list, token_counts, stream=True)
+                content = []
+                async for chunk in chunks:
+                    delta = self._chunk_content(chunk)
+                    if delta:
+                        if not content:
+                            instrumentation.mark("first_token")
+                        content.append(delta)
+                        yield delta
+            # Each chunk is one token
+            instrumentation.record_tokens("completion", len(content))
+            response = {"role": "assistant", "content": "".join(content)}
+            with instrumentation.stage("save"):
+                await message_memory.aadd_latest_bot_response(response)
+                if self.response_cache:
+                    await self.response_cache.astore(
+                        user_query, context, response["content"])
+        except Exception as e:
+            print(e)
+            raise(e)
+
+    async def aclose(self):
+        """Close the pooled HTTP session, and the async clients of the
+        knowledge base and response cache if they have one."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if hasattr(self.knowledge_base, "aclose"):
+            await self.knowledge_base.aclose()
+        if hasattr(self.response_cache, "aclose"):
+            await self.response_cache.aclose()
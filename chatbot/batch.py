@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+
+
+class BatchItem:
+    """A query, or a conversation of queries asked in order, answered by
+    :meth:`chatbot.chatbot.ChatBot.get_replies`. Not meant to be used
+    directly, see :func:`to_batch_items`.
+
+    :param item_id: The id of the item, used to resume from a checkpoint
+    :type item_id: str | int
+    :param queries: The queries, in order
+    :type queries: list[str]
+    :param conversation: Whether the item is a conversation, so its result
+        has all the replies instead of one
+    :type conversation: bool
+    """
+
+    def __init__(self, item_id, queries: list[str], conversation: bool):
+        self.id = item_id
+        self.queries = queries
+        self.conversation = conversation
+
+    def result(
+            self, replies: list[str], error: str | None,
+            seconds: float) -> dict:
+        """Returns the result of the item, as yielded by
+        :meth:`chatbot.chatbot.ChatBot.get_replies`.
+
+        :param replies: The replies so far, one per query
+        :type replies: list[str]
+        :param error: The error that stopped the item, or None
+        :type error: str | None
+        :param seconds: How long the item took
+        :type seconds: float
+        :return: The item's id, queries, replies and error
+        :rtype: dict
+        """
+        if self.conversation:
+            result = {
+                "id": self.id,
+                "conversation": self.queries,
+                "replies": replies,
+            }
+        else:
+            result = {
+                "id": self.id,
+                "query": self.queries[0],
+                "reply": replies[0] if replies else None,
+            }
+        result["error"] = error
+        result["seconds"] = round(seconds, 3)
+        return result
+
+
+def to_batch_items(items: list) -> list[BatchItem]:
+    """Read the items passed to :meth:`chatbot.chatbot.ChatBot.get_replies`:
+    queries (str), conversations (lists of queries) or dicts with an
+    ``"id"`` and a ``"query"`` or a ``"conversation"``. Items without an id
+    are numbered by their position.
+
+    :param items: The items
+    :type items: list
+    :raises ValueError: If an item isn't one of those, or an id is repeated
+    :return: The items to answer
+    :rtype: list[BatchItem]
+    """
+    batch = []
+    seen = set()
+    for position, item in enumerate(items):
+        item_id = position
+        if isinstance(item, dict):
+            item_id = item.get("id", position)
+            if "conversation" in item:
+                item = item["conversation"]
+            else:
+                item = item.get("query")
+        if isinstance(item, str):
+            batch.append(BatchItem(item_id, [item], False))
+        elif isinstance(item, list) and item and all(
+                isinstance(query, str) for query in item):
+            batch.append(BatchItem(item_id, list(item), True))
+        else:
+            raise ValueError(
+                f"Item {item_id} isn't a query or a list of queries.")
+        if item_id in seen:
+            raise ValueError(f"Item id {item_id} is repeated.")
+        seen.add(item_id)
+    return batch
+
+
+def read_jsonl(
+        path: str,
+        id_field: str = "request_id",
+        query_field: str = "body") -> list[dict]:
+    """Read the items for :meth:`chatbot.chatbot.ChatBot.get_replies` from a
+    JSONL file, one JSON object per line, e.g. a ``requests.jsonl`` with a
+    ``request_id``, a ``title`` and a ``body``. A query field holding a list
+    is read as a conversation.
+
+    :param path: The JSONL file
+    :type path: str
+    :param id_field: The field with the id of each line, defaults to
+        "request_id"
+    :type id_field: str, optional
+    :param query_field: The field with the query, defaults to "body"
+    :type query_field: str, optional
+    :return: The items, with an ``"id"`` and a ``"query"`` or
+        ``"conversation"``
+    :rtype: list[dict]
+    """
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            query = record[query_field]
+            key = "conversation" if isinstance(query, list) else "query"
+            items.append({"id": record[id_field], key: query})
+    return items
+
+
+class BatchCheckpoint:
+    """Appends the results of :meth:`chatbot.chatbot.ChatBot.get_replies` to
+    a JSONL file as they finish, one line each and flushed straight away, so
+    an interrupted run can be started again with the same file. The ids of
+    the results already there without an error are in ``done`` and skipped,
+    the items that failed are tried again (the last line for an id wins).
+
+    :param path: The JSONL file, created if it doesn't exist
+    :type path: str
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        self._file = None
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a run that was killed mid-write
+                    continue
+                if result.get("error") is None:
+                    self.done.add(result["id"])
+                else:
+                    self.done.discard(result["id"])
+
+    def write(self, result: dict):
+        """Append a result to the file.
+
+        :param result: The result of an item
+        :type result: dict
+        """
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(line)
+            self._file.flush()
+            if result["error"] is None:
+                self.done.add(result["id"])
+
+    def close(self):
+        """Close the file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        """ Open the file to append, after finishing a line cut off by a
+        killed run so the next result starts on its own line. Not meant to be
+        called directly."""
+        cut_off = False
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                cut_off = f.read(1) != b"\n"
+        f = open(self.path, "a", encoding="utf-8")
+        if cut_off:
+            f.write("\n")
+        return f
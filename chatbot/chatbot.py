@@ -1,14 +1,67 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from itertools import islice
+from typing import TYPE_CHECKING
+
 import openai
-import numpy as np
-import redis
-from redis.commands.search.query import Query
 
-from chatbot.utils import num_tokens
+from chatbot import instrumentation
+from chatbot.embedding_cache import (
+    BaseEmbeddingCache,
+    aget_embedding,
+    get_embedding,
+    get_embeddings,
+)
+from chatbot.embedding_batcher import EmbeddingBatcher
+from chatbot.instrumentation import BaseInstrumentation
+from chatbot.rate_limiter import RateLimiter
+from chatbot.response_cache import BaseResponseCache
+from chatbot.utils import (
+    VECTOR_TYPES,
+    compact_vector,
+    get_encoding,
+    max_marginal_relevance,
+    message_tokens,
+    num_tokens,
+    pack_to_tokens,
+    quantize_int8,
+    reduce_dimensions,
+    truncate_to_tokens,
+)
+
+# numpy and redis are only imported by the classes that use them, so bots
+# without a knowledge base start faster
+if TYPE_CHECKING:
+    import numpy as np
+    import redis
+    from redis.commands.search.query import Query
 
 
 DEFAULT_PROMPT = "You're a nice helpful chatbot."
 MAX_TOKENS = 16000
 GPT_MODEL = "gpt-3.5-turbo"
+# Rows of an int8 matrix converted to float32 at a time when searching, small
+# enough for the converted block to stay in the CPU cache
+SEARCH_BLOCK_ROWS = 256
+EMBEDDING_MODEL = "text-embedding-ada-002"
+SUMMARY_PROMPT = (
+    "Summarize the conversation between the user and the assistant below, "
+    "building on the summary so far if there is one. Keep the facts, names, "
+    "preferences and open questions needed to carry on the conversation, and "
+    "leave out small talk. Reply with the summary only.")
 
 
 class BaseMessageMemory:
@@ -19,9 +72,13 @@ class BaseMessageMemory:
     :param memory_length: The number of messages to store in the chat history,
         defaults to 5
     :type memory_length: int, optional
+    :param model: The GPT model, used to count the tokens in each message,
+        defaults to "gpt-3.5-turbo"
+    :type model: str, optional
     """
-    def __init__(self, memory_length: int = 5):
+    def __init__(self, memory_length: int = 5, model: str = GPT_MODEL):
         self.memory_length = memory_length
+        self.model = model
         self.message_queue = []
 
     def add_latest_user_query(self):
@@ -36,20 +93,90 @@ class BaseMessageMemory:
     def trim_message_list(self):
         raise NotImplementedError
 
+    def get_token_counts(self) -> list[int]:
+        """Returns the number of tokens in each message from
+        :meth:`get_message_list`. This counts them every time it's called,
+        child classes should override it if they can keep track of the counts
+        as messages are added.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        encoding = get_encoding(self.model)
+        return [message_tokens(m, encoding) for m in self.get_message_list()]
+
+    def get_messages_with_token_counts(self) -> tuple[list[dict], list[int]]:
+        """Returns the message list and the number of tokens in each message.
+        This is what the :class:`ChatBot` uses, child classes that can read
+        both at once (e.g. in one round trip) should override it.
+
+        :return: The message list and the token counts
+        :rtype: tuple[list[dict], list[int]]
+        """
+        return self.get_message_list(), self.get_token_counts()
+
+    async def aadd_latest_user_query(self, latest_message: str):
+        """Async version of :meth:`add_latest_user_query`, used by
+        :class:`chatbot.async_chatbot.AsyncChatBot`. Calls the sync method by
+        default, override it if the memory needs to do I/O.
+
+        :param latest_message: The latest user query
+        :type latest_message: str
+        """
+        self.add_latest_user_query(latest_message)
+
+    async def aadd_latest_bot_response(self, bot_response: dict):
+        """Async version of :meth:`add_latest_bot_response`.
+
+        :param bot_response: The latest bot response
+        :type bot_response: dict
+        """
+        self.add_latest_bot_response(bot_response)
+
+    async def aget_message_list(self) -> list[dict]:
+        """Async version of :meth:`get_message_list`.
+
+        :return: The message queue
+        :rtype: list[dict]
+        """
+        return self.get_message_list()
+
+    async def aget_token_counts(self) -> list[int]:
+        """Async version of :meth:`get_token_counts`.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        return self.get_token_counts()
+
+    async def aget_messages_with_token_counts(
+            self) -> tuple[list[dict], list[int]]:
+        """Async version of :meth:`get_messages_with_token_counts`.
+
+        :return: The message list and the token counts
+        :rtype: tuple[list[dict], list[int]]
+        """
+        return self.get_messages_with_token_counts()
+
 
 class MessageMemory(BaseMessageMemory):
     """Stores the conversation history in memory and uses the `memory_length`
     parameter to determine how many messages to send to the API to provide
-    context.
+    context. The tokens in each message are counted once, when it's added.
 
     :param memory_length: The number of messages to store in the chat history,
         defaults to 5
     :type memory_length: int, optional
+    :param model: The GPT model, used to count the tokens in each message,
+        defaults to "gpt-3.5-turbo"
+    :type model: str, optional
     """
 
-    def __init__(self, memory_length: int = 5):
+    def __init__(self, memory_length: int = 5, model: str = GPT_MODEL):
         """ Constructor method"""
-        super().__init__(memory_length)
+        super().__init__(memory_length, model)
+        self.token_counts = []
+        self.total_tokens = 0
 
 
     def add_latest_user_query(self, latest_message: str):
@@ -58,30 +185,627 @@ class MessageMemory(BaseMessageMemory):
         :param latest_message: The latest user query
         :type latest_message: str
         """
-        self.message_queue.append(
-            {"role": "user", "content": latest_message}
-        )
+        self._append({"role": "user", "content": latest_message})
 
-    def add_latest_bot_response(self, bot_response: str):
+    def add_latest_bot_response(self, bot_response: dict):
         """Add the latest bot response to the message queue.
 
         :param bot_response: The latest bot response
-        :type bot_response: str
+        :type bot_response: dict
         """
-        self.message_queue.append(bot_response)
+        self._append(bot_response)
         self.trim_message_list()
 
     def get_message_list(self) -> list[dict]:
-        """Returns the message queue.
+        """Returns a copy of the message queue.
         :return: The message queue
         :rtype: list[dict]
         """
-        return self.message_queue
+        return list(self.message_queue)
+
+    def get_token_counts(self) -> list[int]:
+        """Returns the number of tokens in each message of the queue.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        return list(self.token_counts)
 
     def trim_message_list(self):
         """Trims the message list to ``memory_length``."""
         while len(self.message_queue) > self.memory_length:
             self.message_queue.pop(0)
+            self.total_tokens -= self.token_counts.pop(0)
+
+    def _append(self, message: dict):
+        """ Add a message to the queue and count its tokens. Not meant to be
+        called directly."""
+        count = message_tokens(message, get_encoding(self.model))
+        self.message_queue.append(message)
+        self.token_counts.append(count)
+        self.total_tokens += count
+
+
+class SummarizingMessageMemory(MessageMemory):
+    """Stores the conversation history in memory like :class:`MessageMemory`,
+    but instead of forgetting old messages it folds them into a running
+    summary. Once the messages add up to more than ``summary_threshold``
+    tokens, all but the ``keep_recent`` latest are summarized (together with
+    the previous summary) by the completion API, and the summary is sent as a
+    system message before the recent messages. The prompt stays about the
+    same size however long the conversation gets.
+
+    The summary is written in a background thread, so replies don't wait for
+    it: until it's ready the messages are sent in full, the same as before.
+    If summarizing fails the error is printed and it's tried again after the
+    next reply, ``memory_length`` is still a hard limit on the number of
+    messages kept.
+
+    :param memory_length: The most messages to keep without summarizing them,
+        defaults to 50
+    :type memory_length: int, optional
+    :param model: The GPT model, used to count the tokens in each message,
+        defaults to "gpt-3.5-turbo"
+    :type model: str, optional
+    :param summary_threshold: Summarize once the messages are more than this
+        many tokens, defaults to 1000
+    :type summary_threshold: int, optional
+    :param keep_recent: The number of latest messages that are never
+        summarized, defaults to 4
+    :type keep_recent: int, optional
+    :param max_summary_tokens: The longest summary, in tokens, defaults to 300
+    :type max_summary_tokens: int, optional
+    :param summary_model: The model that writes the summary, defaults to
+        ``model``
+    :type summary_model: str, optional
+    :param rate_limiter: Schedules and retries the summary calls, defaults to
+        None. Share it with the :class:`ChatBot`.
+    :type rate_limiter: :class:`RateLimiter`, optional
+    :param background: Summarize in a background thread, defaults to True.
+        If False the reply that crosses the threshold waits for the summary.
+    :type background: bool, optional
+    """
+    # Shared by all the memories, a conversation has one summary in flight
+    # at most
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(
+            self,
+            memory_length: int = 50,
+            model: str = GPT_MODEL,
+            summary_threshold: int = 1000,
+            keep_recent: int = 4,
+            max_summary_tokens: int = 300,
+            summary_model: str = None,
+            rate_limiter: RateLimiter = None,
+            background: bool = True):
+        super().__init__(memory_length, model)
+        self.summary_threshold = summary_threshold
+        self.keep_recent = keep_recent
+        self.max_summary_tokens = max_summary_tokens
+        self.summary_model = summary_model or model
+        self.rate_limiter = rate_limiter
+        self.background = background
+        self.summary = ""
+        self.summary_tokens = 0
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def add_latest_user_query(self, latest_message: str):
+        """Add the latest user query to the message queue.
+
+        :param latest_message: The latest user query
+        :type latest_message: str
+        """
+        with self._lock:
+            self._append({"role": "user", "content": latest_message})
+
+    def add_latest_bot_response(self, bot_response: dict):
+        """Add the latest bot response to the message queue, and start
+        summarizing the older messages if they're over the threshold.
+
+        :param bot_response: The latest bot response
+        :type bot_response: dict
+        """
+        with self._lock:
+            self._append(bot_response)
+            self.trim_message_list()
+        self._maybe_summarize()
+
+    def get_message_list(self) -> list[dict]:
+        """Returns the summary, as a system message, followed by a copy of the
+        message queue.
+
+        :return: The message queue
+        :rtype: list[dict]
+        """
+        return self.get_messages_with_token_counts()[0]
+
+    def get_token_counts(self) -> list[int]:
+        """Returns the number of tokens in the summary and each message.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        return self.get_messages_with_token_counts()[1]
+
+    def get_messages_with_token_counts(self) -> tuple[list[dict], list[int]]:
+        """Returns the message list, with the summary first, and the number
+        of tokens in each message.
+
+        :return: The message list and the token counts
+        :rtype: tuple[list[dict], list[int]]
+        """
+        with self._lock:
+            messages = list(self.message_queue)
+            token_counts = list(self.token_counts)
+            if self.summary:
+                messages.insert(0, self._summary_message())
+                token_counts.insert(0, self.summary_tokens)
+        return messages, token_counts
+
+    def wait_for_summary(self, timeout: float = None):
+        """Wait for the summary in progress, if there is one.
+
+        :param timeout: The longest to wait, in seconds, defaults to None
+            (no limit)
+        :type timeout: float, optional
+        """
+        pending = self._pending
+        if pending is not None:
+            pending.result(timeout)
+
+    def _summary_message(self) -> dict:
+        """ The summary as a message for the chat completion API. Not meant
+        to be called directly."""
+        return {
+            "role": "system",
+            "content": f"Summary of the conversation so far: {self.summary}",
+        }
+
+    def _maybe_summarize(self):
+        """ Summarize the older messages if they're over the threshold and
+        there isn't a summary in progress. Not meant to be called directly."""
+        with self._lock:
+            message_tokens_total = self.total_tokens - self.summary_tokens
+            if (self._pending is not None
+                    or message_tokens_total <= self.summary_threshold):
+                return
+            evicted = self.message_queue[
+                :max(len(self.message_queue) - self.keep_recent, 0)]
+            if not evicted:
+                return
+            summary = self.summary
+            self._pending = done = Future()
+        if self.background:
+            # In a copy of the caller's context, so the summary's retries
+            # are recorded with the request that started it
+            self._get_executor().submit(
+                contextvars.copy_context().run,
+                self._summarize, summary, evicted, done)
+        else:
+            self._summarize(summary, evicted, done)
+
+    def _summarize(self, summary: str, evicted: list[dict], done: Future):
+        """ Fold the evicted messages into the summary and drop them. Not
+        meant to be called directly."""
+        try:
+            new_summary = self._create_summary(summary, evicted)
+        except Exception as e:
+            print("Error summarizing the conversation: ", e)
+            new_summary = None
+        with self._lock:
+            if new_summary:
+                self.summary = new_summary
+                self.total_tokens -= self.summary_tokens
+                self.summary_tokens = message_tokens(
+                    self._summary_message(), get_encoding(self.model))
+                self.total_tokens += self.summary_tokens
+                # The messages that were summarized are still the oldest,
+                # unless memory_length trimmed them in the meantime
+                folded = {id(m) for m in evicted}
+                while (self.message_queue
+                       and id(self.message_queue[0]) in folded):
+                    self.message_queue.pop(0)
+                    self.total_tokens -= self.token_counts.pop(0)
+            self._pending = None
+        done.set_result(None)
+
+    def _create_summary(self, summary: str, evicted: list[dict]) -> str:
+        """ Ask the completion API for the new summary. Not meant to be called
+        directly."""
+        transcript = "\n".join(
+            f"{m['role']}: {m['content']}" for m in evicted)
+        if summary:
+            transcript = (
+                f"Summary so far:\n{summary}\n\nNew messages:\n{transcript}")
+        kwargs = dict(
+            model=self.summary_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0,
+            max_tokens=self.max_summary_tokens)
+        if self.rate_limiter is None:
+            completion = openai.ChatCompletion.create(**kwargs)
+        else:
+            tokens = num_tokens(kwargs["messages"], self.summary_model)
+            completion = self.rate_limiter.call(
+                openai.ChatCompletion.create,
+                tokens + self.max_summary_tokens,
+                **kwargs)
+        return completion["choices"][0]["message"]["content"].strip()
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        """ Returns the thread pool the summaries are written in, creating it
+        on first use. Not meant to be called directly."""
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix="summarize")
+            return cls._executor
+
+
+class RedisMessageMemory(BaseMessageMemory):
+    """Stores the conversation history in Redis, so that every worker process
+    and replica serving the bot sees the same history. The conversation is
+    kept in a Redis list capped at ``memory_length`` messages, and each entry
+    stores the message with its token count so they're only counted once.
+
+    Every update is a single pipelined round trip (push, trim and refresh
+    the TTL), and reading the history is a single ``LRANGE``. Pass the
+    ``redis_client`` of a :class:`KnowledgeBaseRedis` to share its connection
+    pool. To keep one history per conversation, create these from a
+    :class:`SessionMemoryStore`::
+
+        SessionMemoryStore(memory_factory=lambda session_id: RedisMessageMemory(
+            knowledge_base.redis_client, session_id))
+
+    :param redis_client: The Redis client to use
+    :type redis_client: redis.Redis
+    :param conversation_id: The id of the conversation
+    :type conversation_id: str
+    :param memory_length: The number of messages to store in the chat history,
+        defaults to 5
+    :type memory_length: int, optional
+    :param ttl: How long to keep an idle conversation, in seconds, defaults
+        to one day
+    :type ttl: int, optional
+    :param model: The GPT model, used to count the tokens in each message,
+        defaults to "gpt-3.5-turbo"
+    :type model: str, optional
+    :param prefix: The prefix for the Redis keys, defaults to "conversation:"
+    :type prefix: str, optional
+    :param async_redis_client: Async Redis client for the async methods (e.g.
+        the ``async_redis_client`` of an
+        :class:`chatbot.async_chatbot.AsyncKnowledgeBaseRedis`), defaults to
+        None, which uses the sync client.
+    :type async_redis_client: redis.asyncio.Redis, optional
+    """
+
+    def __init__(
+            self,
+            redis_client: "redis.Redis",
+            conversation_id: str,
+            memory_length: int = 5,
+            ttl: int = 86400,
+            model: str = GPT_MODEL,
+            prefix: str = "conversation:",
+            async_redis_client=None):
+        """ Constructor method"""
+        super().__init__(memory_length, model)
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self.key = f"{prefix}{conversation_id}"
+        self.ttl = ttl
+
+    def add_latest_user_query(self, latest_message: str):
+        """Add the latest user query to the conversation.
+
+        :param latest_message: The latest user query
+        :type latest_message: str
+        """
+        self._push(
+            self.redis_client.pipeline(transaction=False),
+            {"role": "user", "content": latest_message},
+            trim=False).execute()
+
+    def add_latest_bot_response(self, bot_response: dict):
+        """Add the latest bot response to the conversation, and trim it to
+        ``memory_length``.
+
+        :param bot_response: The latest bot response
+        :type bot_response: dict
+        """
+        self._push(
+            self.redis_client.pipeline(transaction=False),
+            bot_response,
+            trim=True).execute()
+
+    def get_message_list(self) -> list[dict]:
+        """Returns the conversation history.
+
+        :return: The message list
+        :rtype: list[dict]
+        """
+        return self.get_messages_with_token_counts()[0]
+
+    def get_token_counts(self) -> list[int]:
+        """Returns the number of tokens in each message.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        return self.get_messages_with_token_counts()[1]
+
+    def get_messages_with_token_counts(self) -> tuple[list[dict], list[int]]:
+        """Returns the message list and token counts with one ``LRANGE``.
+
+        :return: The message list and the token counts
+        :rtype: tuple[list[dict], list[int]]
+        """
+        return self._parse(self.redis_client.lrange(self.key, 0, -1))
+
+    def trim_message_list(self):
+        """Trims the conversation to ``memory_length``."""
+        self.redis_client.ltrim(self.key, -self.memory_length, -1)
+
+    async def aadd_latest_user_query(self, latest_message: str):
+        """Async version of :meth:`add_latest_user_query`.
+
+        :param latest_message: The latest user query
+        :type latest_message: str
+        """
+        if self.async_redis_client is None:
+            return self.add_latest_user_query(latest_message)
+        await self._push(
+            self.async_redis_client.pipeline(transaction=False),
+            {"role": "user", "content": latest_message},
+            trim=False).execute()
+
+    async def aadd_latest_bot_response(self, bot_response: dict):
+        """Async version of :meth:`add_latest_bot_response`.
+
+        :param bot_response: The latest bot response
+        :type bot_response: dict
+        """
+        if self.async_redis_client is None:
+            return self.add_latest_bot_response(bot_response)
+        await self._push(
+            self.async_redis_client.pipeline(transaction=False),
+            bot_response,
+            trim=True).execute()
+
+    async def aget_messages_with_token_counts(
+            self) -> tuple[list[dict], list[int]]:
+        """Async version of :meth:`get_messages_with_token_counts`.
+
+        :return: The message list and the token counts
+        :rtype: tuple[list[dict], list[int]]
+        """
+        if self.async_redis_client is None:
+            return self.get_messages_with_token_counts()
+        return self._parse(
+            await self.async_redis_client.lrange(self.key, 0, -1))
+
+    async def aget_message_list(self) -> list[dict]:
+        """Async version of :meth:`get_message_list`.
+
+        :return: The message list
+        :rtype: list[dict]
+        """
+        return (await self.aget_messages_with_token_counts())[0]
+
+    async def aget_token_counts(self) -> list[int]:
+        """Async version of :meth:`get_token_counts`.
+
+        :return: The number of tokens in each message
+        :rtype: list[int]
+        """
+        return (await self.aget_messages_with_token_counts())[1]
+
+    def _push(self, pipe, message: dict, trim: bool):
+        """ Queue the commands to add a message to the pipeline and return
+        it. Not meant to be called directly."""
+        entry = json.dumps({
+            "message": {"role": message["role"], "content": message["content"]},
+            "tokens": message_tokens(message, get_encoding(self.model)),
+        })
+        pipe.rpush(self.key, entry)
+        if trim:
+            pipe.ltrim(self.key, -self.memory_length, -1)
+        pipe.expire(self.key, self.ttl)
+        return pipe
+
+    @staticmethod
+    def _parse(entries: list) -> tuple[list[dict], list[int]]:
+        """ Split the stored entries into messages and token counts. Not meant
+        to be called directly."""
+        entries = [json.loads(entry) for entry in entries]
+        return (
+            [entry["message"] for entry in entries],
+            [entry["tokens"] for entry in entries])
+
+
+class _Session:
+    """ A conversation in the :class:`SessionMemoryStore`. Not meant to be
+    used directly."""
+
+    def __init__(self, memory: BaseMessageMemory):
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.async_lock = None
+        self.last_used = time.monotonic()
+        # The requests holding or waiting for the lock, the session isn't
+        # evicted while there are any
+        self.in_use = 0
+
+    def num_tokens(self) -> int:
+        """ Returns the number of tokens in the conversation history."""
+        total = getattr(self.memory, "total_tokens", None)
+        if total is None:
+            total = sum(self.memory.get_token_counts())
+        return total
+
+
+class SessionMemoryStore:
+    """Keeps a separate message memory for each conversation, so one bot can
+    talk to many users (Slack channels, Google Chat spaces, etc.) without
+    their histories getting mixed up. Pass it to the :class:`ChatBot` and use
+    ``get_reply(user_query, session_id=...)``.
+
+    The store is bounded: sessions that haven't been used for ``ttl`` seconds
+    are dropped, and the least recently used sessions are dropped when there
+    are more than ``max_sessions`` or their histories add up to more than
+    ``max_total_tokens``. Sessions in use by a request are never dropped, so
+    the store can go over the limits while they're in use. Each session has
+    its own lock, so replies in the same conversation are generated one at a
+    time, which makes the store safe to use from threaded servers.
+
+    :param memory_factory: Called with the session id to create the memory
+        for a new session, defaults to creating a :class:`MessageMemory`
+    :type memory_factory: Callable[[str], BaseMessageMemory], optional
+    :param max_sessions: The maximum number of sessions to keep, defaults to
+        1000
+    :type max_sessions: int, optional
+    :param max_total_tokens: The maximum number of history tokens across all
+        sessions, defaults to None (no limit)
+    :type max_total_tokens: int, optional
+    :param ttl: How long an idle session is kept, in seconds, defaults to one
+        hour
+    :type ttl: float, optional
+    """
+
+    def __init__(
+            self,
+            memory_factory: Callable[[str], BaseMessageMemory] = None,
+            max_sessions: int = 1000,
+            max_total_tokens: int = None,
+            ttl: float = 3600):
+        if memory_factory is None:
+            memory_factory = lambda session_id: MessageMemory()
+        self.memory_factory = memory_factory
+        self.max_sessions = max_sessions
+        self.max_total_tokens = max_total_tokens
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> BaseMessageMemory:
+        """Get the message memory for the session, creating it if needed.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        :return: The session's message memory
+        :rtype: :class:`BaseMessageMemory`
+        """
+        return self._get_session(session_id).memory
+
+    def remove(self, session_id: str):
+        """Forget a session.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    @contextlib.contextmanager
+    def session(self, session_id: str) -> Iterator[BaseMessageMemory]:
+        """Context manager that holds the session's lock and gives access to
+        its memory. Used by :meth:`ChatBot.get_reply`.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        :return: The session's message memory
+        :rtype: Iterator[BaseMessageMemory]
+        """
+        session = self._get_session(session_id, use=True)
+        try:
+            with session.lock:
+                yield session.memory
+        finally:
+            self._release(session)
+        self._evict()
+
+    @contextlib.asynccontextmanager
+    async def asession(
+            self, session_id: str) -> AsyncIterator[BaseMessageMemory]:
+        """Async version of :meth:`session`, holds an ``asyncio`` lock for the
+        session so the event loop isn't blocked while waiting for it.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        :return: The session's message memory
+        :rtype: AsyncIterator[BaseMessageMemory]
+        """
+        session = self._get_session(session_id, use=True)
+        try:
+            with self._lock:
+                if session.async_lock is None:
+                    session.async_lock = asyncio.Lock()
+            async with session.async_lock:
+                yield session.memory
+        finally:
+            self._release(session)
+        self._evict()
+
+    def _get_session(self, session_id: str, use: bool = False) -> _Session:
+        """ Returns the session, creating it if needed and marking it as the
+        most recently used. With ``use``, it's also marked as in use until
+        `_release` is called. Not meant to be called directly."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = _Session(self.memory_factory(session_id))
+                self._sessions[session_id] = session
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            if use:
+                session.in_use += 1
+        self._evict()
+        return session
+
+    def _release(self, session: _Session):
+        """ Mark a session taken with `_get_session` as no longer in use by
+        that request. Not meant to be called directly."""
+        with self._lock:
+            session.in_use -= 1
+
+    def _evict(self):
+        """ Drop expired sessions, then the least recently used ones until the
+        store is within its limits. The most recently used session and the
+        sessions in use are always kept: dropping a session while a request
+        holds it would give the next request a new, empty memory, and the
+        conversation would fork. Not meant to be called directly."""
+        with self._lock:
+            now = time.monotonic()
+            newest = next(reversed(self._sessions), None)
+            count = len(self._sessions)
+            total = None
+            if self.max_total_tokens is not None:
+                total = sum(s.num_tokens() for s in self._sessions.values())
+            evicted = []
+            # Sessions are in order of use, least recently used first
+            for session_id, session in self._sessions.items():
+                if (now - session.last_used <= self.ttl
+                        and count <= max(self.max_sessions, 1)
+                        and (total is None or total <= self.max_total_tokens)):
+                    break
+                if session.in_use or session_id == newest:
+                    continue
+                evicted.append(session_id)
+                count -= 1
+                if total is not None:
+                    total -= session.num_tokens()
+            for session_id in evicted:
+                del self._sessions[session_id]
 
 
 class BaseKnowledgeBase:
@@ -96,6 +820,40 @@ class BaseKnowledgeBase:
     def get_context(self, user_query: str):
         raise NotImplementedError
 
+    async def aget_context(self, user_query: str) -> str | None:
+        """Async version of :meth:`get_context`. By default this runs the sync
+        method in a worker thread, child classes with a native async client
+        should override it.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The context for the user's query
+        :rtype: str | None
+        """
+        return await asyncio.to_thread(self.get_context, user_query)
+
+    def get_contexts(self, user_queries: list[str]) -> list[str | None]:
+        """Get the context for each of the queries, used by
+        :meth:`ChatBot.get_replies` to retrieve them ahead. By default this
+        calls :meth:`get_context` for each one, child classes that can embed
+        the queries together should override it.
+
+        :param user_queries: The users' queries
+        :type user_queries: list[str]
+        :return: The context for each query, in order
+        :rtype: list[str | None]
+        """
+        return [self.get_context(user_query) for user_query in user_queries]
+
+    def warmup(self):
+        """Load and connect what the first query would otherwise wait for,
+        called by :meth:`ChatBot.warmup`. Does nothing by default."""
+
+    async def awarmup(self):
+        """Async version of :meth:`warmup`, runs the sync method in a worker
+        thread by default."""
+        await asyncio.to_thread(self.warmup)
+
 
 class KnowledgeBaseRedis(BaseKnowledgeBase):
     """A knowledge base that uses Redis to store information and the embeddings
@@ -106,9 +864,79 @@ class KnowledgeBaseRedis(BaseKnowledgeBase):
     :type redis_url: str
     :param api_key: The API key for OpenAI's API
     :type api_key: str
+    :param embedding_cache: Cache for the query embeddings, defaults to None
+        (every query is embedded by OpenAI's API). See
+        :mod:`chatbot.embedding_cache` for the available caches.
+    :type embedding_cache: :class:`BaseEmbeddingCache`, optional
+    :param top_k: The number of documents (or chunks of documents) to fetch
+        for each query, defaults to 4
+    :type top_k: int, optional
+    :param context_tokens: The maximum number of tokens of context, the most
+        similar documents that fit are used, defaults to 1500. If None, all
+        ``top_k`` documents are used.
+    :type context_tokens: int, optional
+    :param index_name: The name of the Redis search index, defaults to
+        "posts". See :func:`chatbot.redis_utils.create_index.create_index`.
+    :type index_name: str, optional
+    :param ef_runtime: The size of the HNSW candidate list at query time,
+        higher is slower but more accurate, defaults to None (the index's
+        default). Only used with HNSW indexes.
+    :type ef_runtime: int, optional
+    :param vector_type: The type of the index's vector field, "FLOAT32" or
+        "FLOAT16" (half the memory), defaults to "FLOAT32". Must match the
+        index and the stored documents.
+    :type vector_type: str, optional
+    :param dim: The number of dimensions kept in the index, if the stored
+        embeddings were truncated, defaults to None (all of them)
+    :type dim: int, optional
+    :param embedding_batcher: Batches the query embeddings of concurrent
+        requests into fewer API calls, defaults to None
+    :type embedding_batcher: :class:`EmbeddingBatcher`, optional
+    :param rate_limiter: Schedules and retries the embedding calls, defaults
+        to None. A batcher uses its own.
+    :type rate_limiter: :class:`RateLimiter`, optional
+    :param mmr_lambda: Re-rank the documents by Maximal Marginal Relevance,
+        trading relevance (1) for diversity (0), defaults to None (no
+        re-ranking). See :func:`chatbot.utils.max_marginal_relevance`.
+    :type mmr_lambda: float, optional
+    :param fetch_k: The number of candidates fetched, with their vectors, to
+        re-rank or dedupe, defaults to 20
+    :type fetch_k: int, optional
+    :param dedupe_threshold: Drop documents with a cosine similarity above
+        this to a more relevant one (e.g. 0.95 for near duplicates), defaults
+        to None (no dedupe)
+    :type dedupe_threshold: float, optional
     """
-    def __init__(self, redis_url: str, api_key: str):
+    def __init__(
+            self,
+            redis_url: str,
+            api_key: str,
+            embedding_cache: BaseEmbeddingCache = None,
+            top_k: int = 4,
+            context_tokens: int = 1500,
+            index_name: str = "posts",
+            ef_runtime: int = None,
+            vector_type: str = "FLOAT32",
+            dim: int = None,
+            embedding_batcher: EmbeddingBatcher = None,
+            rate_limiter: RateLimiter = None,
+            mmr_lambda: float = None,
+            fetch_k: int = 20,
+            dedupe_threshold: float = None):
         openai.api_key = api_key
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.rate_limiter = rate_limiter
+        self.mmr_lambda = mmr_lambda
+        self.fetch_k = fetch_k
+        self.dedupe_threshold = dedupe_threshold
+        self.top_k = top_k
+        self.context_tokens = context_tokens
+        self.index_name = index_name
+        self.ef_runtime = ef_runtime
+        self.vector_type = vector_type
+        self.dim = dim
+        import redis
         self.redis_client = redis.from_url(
             redis_url, 
             encoding='utf-8',
@@ -123,34 +951,524 @@ class KnowledgeBaseRedis(BaseKnowledgeBase):
         :return: The context for the user's query
         :rtype: str | None
         """
-        # Compute embedding of latest message
-        embedding = openai.Embedding.create(
-            input=user_query,
-            model="text-embedding-ada-002")
-        embedding = embedding["data"][0]["embedding"]
-        vector = np.array(embedding).astype(np.float32).tobytes()
-        return self._search_vectors(vector)
+        return self._search_vectors(self.get_embedding(user_query))
+
+    def get_contexts(self, user_queries: list[str]) -> list[str | None]:
+        """Get the context for each of the queries, the ones that aren't in
+        the embedding cache are embedded together in one API call.
+
+        :param user_queries: The users' queries
+        :type user_queries: list[str]
+        :return: The context for each query, in order
+        :rtype: list[str | None]
+        """
+        vectors = get_embeddings(
+            user_queries,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.rate_limiter)
+        return [self._search_vectors(vector) for vector in vectors]
+
+    def get_embedding(self, user_query: str) -> bytes:
+        """Get the embedding of the user's query as float32 bytes, from the
+        embedding cache if possible.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The embedding of the query
+        :rtype: bytes
+        """
+        return get_embedding(
+            user_query,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.embedding_batcher,
+            self.rate_limiter)
+
+    def warmup(self):
+        """Load the tokenizer and the search modules, open a connection to
+        Redis and check that the index exists.
+
+        :raises redis.ResponseError: If the index doesn't exist
+        """
+        get_encoding(GPT_MODEL)
+        get_encoding(EMBEDDING_MODEL)
+        self._knn_query(self.top_k)
+        self.redis_client.ft(self.index_name).info()
+        if self.embedding_cache:
+            self.embedding_cache.warmup()
+
+    def search_documents(
+            self, query_vector: bytes, top_k: int = None) -> list[dict]:
+        """Find the documents for the query vector, with their scores. With
+        ``mmr_lambda`` or ``dedupe_threshold``, ``fetch_k`` candidates are
+        fetched with their stored vectors and re-ranked, otherwise these are
+        the ``top_k`` nearest documents.
+
+        :param query_vector: The vector to search for, as float32 bytes
+        :type query_vector: bytes
+        :param top_k: The number of documents to return, defaults to
+            ``top_k``
+        :type top_k: int, optional
+        :return: The ``"id"`` (Redis key), ``"content"`` and ``"score"``
+            (cosine similarity to the query) of each document, in the order
+            they're used, with their ``"mmr_score"`` if they were re-ranked
+        :rtype: list[dict]
+        """
+        top_k = top_k or self.top_k
+        query_vector = compact_vector(query_vector, self.vector_type, self.dim)
+        if not self._reranks():
+            with instrumentation.stage("search"):
+                results = self.redis_client.ft(self.index_name).search(
+                    self._knn_query(top_k),
+                    query_params={"vector": query_vector})
+            return self._documents(results)
+        from redis.client import NEVER_DECODE
+        with instrumentation.stage("search"):
+            # Not decoded, the vectors are binary
+            reply = self.redis_client.execute_command(
+                *self._vector_search_args(query_vector, top_k),
+                **{NEVER_DECODE: []})
+        return self._rerank(query_vector, self._candidates(reply), top_k)
 
-    def _search_vectors(self, query_vector: np.ndarray, top_k=1) -> str | None:
+    def _search_vectors(
+            self, query_vector: bytes, top_k: int = None) -> str | None:
         """ Search Redis for similar vectors. Not meant to be called directly,
         only implemented as a helper method for `get_context`.
 
         :param query_vector: The vector to search for
-        :type query_vector: np.ndarray
-        :param top_k: The number of results to return, defaults to 1
+        :type query_vector: bytes
+        :param top_k: The number of results to return, defaults to ``top_k``
         :type top_k: int, optional
-        :return: The most similar vector
+        :return: The content of the most similar vectors that fit in the
+            context token budget
         :rtype: str | None
         """
-        # Nearest neighbor search on query vector in redis db
-        base_query = f"*=>[KNN {top_k} @embedding $vector AS vector_score]"
-        query = Query(base_query).return_fields("content", "vector_score").sort_by("vector_score").dialect(2)
         try:
-            results = self.redis_client.ft("posts").search(query, query_params={"vector": query_vector})
+            documents = self.search_documents(query_vector, top_k)
         except Exception as e:
             print("Error calling Redis search: ", e)
             return None
-        return results.docs[0].content
+        return self._pack(documents)
+
+    def _pack(self, documents: list[dict]) -> str | None:
+        """ Record the documents' scores and join the ones that fit in the
+        context token budget. Not meant to be called directly.
+
+        :param documents: The documents from :meth:`search_documents`
+        :type documents: list[dict]
+        :return: The context
+        :rtype: str | None
+        """
+        instrumentation.record_documents(documents)
+        return pack_to_tokens(
+            [document["content"] for document in documents],
+            self.context_tokens,
+            get_encoding(GPT_MODEL))
+
+    def _reranks(self) -> bool:
+        """ Whether the candidates are fetched with their vectors and
+        re-ranked. Not meant to be called directly."""
+        return self.mmr_lambda is not None or self.dedupe_threshold is not None
+
+    @staticmethod
+    def _documents(results) -> list[dict]:
+        """ The documents of a search result, the score is the cosine
+        similarity (the index stores the distance). Not meant to be called
+        directly."""
+        return [
+            {
+                "id": doc.id,
+                "content": doc.content,
+                "score": 1.0 - float(doc.vector_score),
+            }
+            for doc in results.docs
+        ]
+
+    def _vector_search_args(self, query_vector: bytes, top_k: int) -> list:
+        """ The FT.SEARCH command for the candidates and their vectors, sent
+        without decoding the reply. Not meant to be called directly.
+
+        :param query_vector: The compacted query vector
+        :type query_vector: bytes
+        :param top_k: The number of documents that will be used
+        :type top_k: int
+        :return: The command and its arguments
+        :rtype: list
+        """
+        query = self._knn_query(max(self.fetch_k, top_k), with_vectors=True)
+        return [
+            "FT.SEARCH", self.index_name, *query.get_args(),
+            "PARAMS", 2, "vector", query_vector,
+        ]
+
+    @staticmethod
+    def _candidates(reply: list) -> list[dict]:
+        """ Parse the undecoded FT.SEARCH reply: the number of results,
+        then the key and the fields of each one. Not meant to be called
+        directly."""
+        candidates = []
+        for key, fields in zip(reply[1::2], reply[2::2]):
+            fields = dict(zip(fields[::2], fields[1::2]))
+            if b"embedding" not in fields:
+                continue
+            candidates.append({
+                "id": key.decode("utf-8"),
+                "content": fields[b"content"].decode("utf-8"),
+                "score": 1.0 - float(fields[b"vector_score"]),
+                "embedding": fields[b"embedding"],
+            })
+        return candidates
+
+    def _rerank(
+            self, query_vector: bytes, candidates: list[dict],
+            top_k: int) -> list[dict]:
+        """ Pick ``top_k`` of the candidates by MMR, without duplicates.
+        Not meant to be called directly.
+
+        :param query_vector: The compacted query vector
+        :type query_vector: bytes
+        :param candidates: The candidates, from `_candidates`
+        :type candidates: list[dict]
+        :param top_k: The number of documents to pick
+        :type top_k: int
+        :return: The picked documents, in order
+        :rtype: list[dict]
+        """
+        if not candidates:
+            return []
+        import numpy as np
+        dtype = VECTOR_TYPES[self.vector_type]
+        vectors = np.stack([
+            np.frombuffer(candidate.pop("embedding"), dtype=dtype)
+            for candidate in candidates
+        ])
+        query = np.frombuffer(query_vector, dtype=dtype)
+        lambda_mult = 1.0 if self.mmr_lambda is None else self.mmr_lambda
+        with instrumentation.stage("rerank"):
+            picked, scores = max_marginal_relevance(
+                query, vectors, top_k, lambda_mult, self.dedupe_threshold)
+        documents = []
+        for index, score in zip(picked, scores):
+            candidates[index]["mmr_score"] = score
+            documents.append(candidates[index])
+        return documents
+
+    def _knn_query(self, top_k: int, with_vectors: bool = False) -> "Query":
+        """ Build the nearest neighbor query used by `_search_vectors`.
+
+        :param top_k: The number of results to return
+        :type top_k: int
+        :param with_vectors: Also return the stored vectors, defaults to
+            False
+        :type with_vectors: bool, optional
+        :return: The KNN query
+        :rtype: Query
+        """
+        from redis.commands.search.query import Query
+        # Nearest neighbor search on query vector in redis db
+        ef_runtime = ""
+        if self.ef_runtime:
+            ef_runtime = f" EF_RUNTIME {self.ef_runtime}"
+        base_query = (
+            f"*=>[KNN {top_k} @embedding $vector{ef_runtime} AS vector_score]")
+        fields = ["content", "vector_score"]
+        if with_vectors:
+            fields.append("embedding")
+        # FT.SEARCH returns 10 results unless told otherwise
+        return (
+            Query(base_query)
+            .return_fields(*fields)
+            .sort_by("vector_score")
+            .paging(0, top_k)
+            .dialect(2))
+
+
+class KnowledgeBaseLocal(BaseKnowledgeBase):
+    """A knowledge base stored in local files, for corpora small enough that
+    a Redis server isn't needed. Searching is a single matrix-vector product,
+    with no network round trip, which takes microseconds for a few thousand
+    documents.
+
+    The knowledge base is a directory with ``embeddings.npy``, a matrix with
+    one normalized float32 embedding per row, and ``documents.jsonl``, with
+    the document for each row. The matrix is memory-mapped, so worker
+    processes using the same directory share the pages instead of each
+    loading a copy. Use :func:`write_knowledge_base_local` (or
+    ``add_to_redis.py --local``) to create it.
+
+    The matrix can also be stored compactly, as float16 or int8 (with
+    ``scales.npy``, the scale of each dimension), and with fewer dimensions
+    (truncated, or projected with ``projection.npy``). The query is
+    transformed to match, so no options are needed here. An int8 matrix is
+    still memory-mapped and searched in blocks of ``SEARCH_BLOCK_ROWS`` rows.
+    numpy has no fast float16 product, so a float16 matrix only saves disk
+    space: it's converted to float32 once when loaded, in each process's own
+    memory, which gives up the shared pages.
+
+    :param path: The directory of the knowledge base
+    :type path: str
+    :param api_key: The API key for OpenAI's API
+    :type api_key: str
+    :param embedding_cache: Cache for the query embeddings, defaults to None
+    :type embedding_cache: :class:`BaseEmbeddingCache`, optional
+    :param top_k: The number of documents to fetch for each query, defaults
+        to 4
+    :type top_k: int, optional
+    :param context_tokens: The maximum number of tokens of context, defaults
+        to 1500
+    :type context_tokens: int, optional
+    :param embedding_batcher: Batches the query embeddings of concurrent
+        requests into fewer API calls, defaults to None
+    :type embedding_batcher: :class:`EmbeddingBatcher`, optional
+    :param rate_limiter: Schedules and retries the embedding calls, defaults
+        to None. A batcher uses its own.
+    :type rate_limiter: :class:`RateLimiter`, optional
+    """
+    def __init__(
+            self,
+            path: str,
+            api_key: str,
+            embedding_cache: BaseEmbeddingCache = None,
+            top_k: int = 4,
+            context_tokens: int = 1500,
+            embedding_batcher: EmbeddingBatcher = None,
+            rate_limiter: RateLimiter = None):
+        openai.api_key = api_key
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.rate_limiter = rate_limiter
+        self.top_k = top_k
+        self.context_tokens = context_tokens
+        import numpy as np
+        self.embeddings = np.load(
+            os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        if self.embeddings.dtype == np.float16:
+            self.embeddings = self.embeddings.astype(np.float32)
+        self.scales = self._load_optional(path, "scales.npy")
+        self.projection = self._load_optional(path, "projection.npy")
+        with open(os.path.join(path, "documents.jsonl"), encoding="utf-8") as f:
+            self.documents = [json.loads(line)["content"] for line in f]
+
+    @staticmethod
+    def _load_optional(path: str, name: str) -> "np.ndarray | None":
+        """ Load a file of the knowledge base that only exists for compact
+        formats. Not meant to be called directly."""
+        import numpy as np
+        try:
+            return np.load(os.path.join(path, name))
+        except FileNotFoundError:
+            return None
+
+    def get_context(self, user_query: str) -> str | None:
+        """Get the context for the user's query.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The context for the user's query
+        :rtype: str | None
+        """
+        return self._search_vectors(self.get_embedding(user_query))
+
+    async def aget_context(self, user_query: str) -> str | None:
+        """Async version of :meth:`get_context`, the search is fast enough to
+        run on the event loop so only the embedding is awaited.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The context for the user's query
+        :rtype: str | None
+        """
+        return self._search_vectors(await aget_embedding(
+            user_query,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.embedding_batcher,
+            self.rate_limiter))
+
+    def get_contexts(self, user_queries: list[str]) -> list[str | None]:
+        """Get the context for each of the queries, the ones that aren't in
+        the embedding cache are embedded together in one API call.
+
+        :param user_queries: The users' queries
+        :type user_queries: list[str]
+        :return: The context for each query, in order
+        :rtype: list[str | None]
+        """
+        vectors = get_embeddings(
+            user_queries,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.rate_limiter)
+        return [self._search_vectors(vector) for vector in vectors]
+
+    def get_embedding(self, user_query: str) -> bytes:
+        """Get the embedding of the user's query as float32 bytes, from the
+        embedding cache if possible.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :return: The embedding of the query
+        :rtype: bytes
+        """
+        return get_embedding(
+            user_query,
+            EMBEDDING_MODEL,
+            self.embedding_cache,
+            self.embedding_batcher,
+            self.rate_limiter)
+
+    def warmup(self):
+        """Load the tokenizer and read the memory-mapped matrix, so its
+        pages are in memory before the first search."""
+        get_encoding(GPT_MODEL)
+        get_encoding(EMBEDDING_MODEL)
+        self.embeddings.max()
+        if self.embedding_cache:
+            self.embedding_cache.warmup()
+
+    def search(self, query_vector: bytes, top_k: int) -> list[tuple[int, float]]:
+        """Find the documents most similar to the vector.
+
+        :param query_vector: The vector to search for, as float32 bytes
+        :type query_vector: bytes
+        :param top_k: The number of results to return
+        :type top_k: int
+        :return: The row and cosine similarity of the closest documents, most
+            similar first
+        :rtype: list[tuple[int, float]]
+        """
+        if not len(self.documents):
+            return []
+        import numpy as np
+        query = np.frombuffer(query_vector, dtype=np.float32)
+        # Reduce the query to the dimensions that were kept
+        if self.projection is not None:
+            query = query @ self.projection
+        else:
+            query = query[:self.embeddings.shape[1]]
+        query = query / np.linalg.norm(query)
+        if self.scales is not None:
+            # int8 rows are the normalized rows divided by the scales
+            query = query * self.scales
+        # The rows are normalized, so this is the cosine similarity
+        scores = self._scores(query.astype(np.float32))
+        top_k = min(top_k, len(scores))
+        # Only the top k need sorting
+        rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows = rows[np.argsort(-scores[rows])]
+        return [(int(row), float(scores[row])) for row in rows]
+
+    def _scores(self, query: "np.ndarray") -> "np.ndarray":
+        """ The product of each row with the query. An int8 matrix is
+        converted to float32 a block of rows at a time, numpy would otherwise
+        convert the whole matrix for every query. Not meant to be called
+        directly."""
+        import numpy as np
+        if self.embeddings.dtype != np.int8:
+            return self.embeddings @ query
+        scores = np.empty(len(self.embeddings), dtype=np.float32)
+        for start in range(0, len(scores), SEARCH_BLOCK_ROWS):
+            block = self.embeddings[start:start + SEARCH_BLOCK_ROWS]
+            np.dot(
+                block.astype(np.float32), query,
+                out=scores[start:start + SEARCH_BLOCK_ROWS])
+        return scores
+
+    def _search_vectors(
+            self, query_vector: bytes, top_k: int = None) -> str | None:
+        """ Search for similar vectors. Not meant to be called directly, only
+        implemented as a helper method for `get_context`.
+
+        :param query_vector: The vector to search for
+        :type query_vector: bytes
+        :param top_k: The number of results to return, defaults to ``top_k``
+        :type top_k: int, optional
+        :return: The content of the most similar vectors that fit in the
+            context token budget
+        :rtype: str | None
+        """
+        with instrumentation.stage("search"):
+            results = self.search(query_vector, top_k or self.top_k)
+        instrumentation.record_documents(
+            [{"id": row, "score": score} for row, score in results])
+        return pack_to_tokens(
+            [self.documents[row] for row, _ in results],
+            self.context_tokens,
+            get_encoding(GPT_MODEL))
+
+
+def write_knowledge_base_local(
+        path: str,
+        documents: list[dict],
+        embeddings: list[bytes],
+        dtype: str = "float32",
+        dim: int = None,
+        pca: bool = False):
+    """Write documents and their embeddings in the format read by
+    :class:`KnowledgeBaseLocal`. The embeddings are normalized so searching
+    only needs a dot product. The files are replaced atomically, so processes
+    that already have the old files open keep working.
+
+    For large corpora the matrix can be made smaller, at some cost in recall
+    (see ``chatbot/redis_utils/compact_report.py`` to measure it). The full
+    float32 embeddings are then also written to ``embeddings_float32.npy``,
+    which is only read when the knowledge base is rebuilt.
+
+    :param path: The directory of the knowledge base, created if needed
+    :type path: str
+    :param documents: The documents, each a dict with at least a "content"
+        key, any other keys (e.g. "url") are stored with it
+    :type documents: list[dict]
+    :param embeddings: The float32 bytes of each document's embedding
+    :type embeddings: list[bytes]
+    :param dtype: The type of the stored matrix, "float32", "float16" (half
+        the size on disk, but converted back to float32 when loaded) or
+        "int8" (a quarter), defaults to "float32"
+    :type dtype: str, optional
+    :param dim: The number of dimensions to keep, defaults to None (all)
+    :type dim: int, optional
+    :param pca: Keep the ``dim`` principal components instead of the first
+        ``dim`` dimensions, defaults to False. Truncation only works well for
+        models trained for it (e.g. text-embedding-3), use PCA otherwise.
+    :type pca: bool, optional
+    """
+    import numpy as np
+    os.makedirs(path, exist_ok=True)
+    if embeddings:
+        matrix = np.array(
+            [np.frombuffer(e, dtype=np.float32) for e in embeddings],
+            dtype=np.float32)
+    else:
+        # No documents (e.g. a crawl that found no posts), the dimensions
+        # can't be known so the matrix is empty
+        matrix = np.zeros((0, dim or 0), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    files = {"embeddings.npy": matrix}
+    if (dim or dtype != "float32") and len(matrix):
+        files["embeddings_float32.npy"] = matrix
+    if dim and dim < matrix.shape[1]:
+        matrix, projection = reduce_dimensions(matrix, dim, pca)
+        if projection is not None:
+            files["projection.npy"] = projection
+    if dtype == "int8" and len(matrix):
+        matrix, files["scales.npy"] = quantize_int8(matrix)
+    files["embeddings.npy"] = matrix.astype(dtype)
+    for name, array in files.items():
+        with open(os.path.join(path, name + ".tmp"), "wb") as f:
+            np.save(f, array)
+    documents_path = os.path.join(path, "documents.jsonl")
+    with open(documents_path + ".tmp", "w", encoding="utf-8") as f:
+        for document in documents:
+            f.write(json.dumps(document) + "\n")
+    for name in files:
+        os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+    os.replace(documents_path + ".tmp", documents_path)
+    # Remove the files of a previous, different format
+    for name in ("embeddings_float32.npy", "projection.npy", "scales.npy"):
+        if name not in files and os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
 
 
 class ChatBot:
@@ -165,7 +1483,7 @@ class ChatBot:
         "You're a nice helpful chatbot." You will probably want to change this
         to make the chatbot more interesting.
     :type prompt: str, optional
-    :param message_memory: The message memory to use, defaults to
+    :param message_memory: The message memory to use, defaults to a new
         :class:`MessageMemory` - which is a simple in-memory implementation.
     :type message_memory: :class:`BaseMessageMemory`, optional
     :param knowledge_base: The knowledge base to use, defaults to None. If you
@@ -174,21 +1492,68 @@ class ChatBot:
     :type knowledge_base: :class:`BaseKnowledgeBase`, optional
     :param gpt_model: The GPT model to use, defaults to "gpt-3.5-turbo-0613".
     :type gpt_model: str, optional
+    :param response_cache: Cache of past replies to check before calling the
+        completion API, defaults to None. The cached replies ignore the
+        conversation history, so only use this with stateless bots. See
+        :class:`chatbot.response_cache.ResponseCacheRedis`.
+    :type response_cache: :class:`BaseResponseCache`, optional
+    :param session_store: Store of per conversation memories, used when a
+        ``session_id`` is passed to :meth:`get_reply`, defaults to None.
+    :type session_store: :class:`SessionMemoryStore`, optional
+    :param instrumentation: Hooks to time each stage of a request and record
+        its token counts and cache hits, defaults to None (nothing is
+        recorded). See :mod:`chatbot.instrumentation`.
+    :type instrumentation: :class:`BaseInstrumentation`, optional
+    :param rate_limiter: Schedules the completion calls to stay under the
+        model's rate limits and retries them when they're rate limited,
+        defaults to None (calls are sent straight away and not retried).
+        Share one between the bots that use the same model, see
+        :class:`chatbot.rate_limiter.RateLimiter`.
+    :type rate_limiter: :class:`RateLimiter`, optional
     """
     def __init__(
             self,
             api_key: str,
             prompt: str = DEFAULT_PROMPT,
-            message_memory: BaseMessageMemory = MessageMemory(),
+            message_memory: BaseMessageMemory = None,
             knowledge_base: BaseKnowledgeBase = None,
-            gpt_model: str = GPT_MODEL):
+            gpt_model: str = GPT_MODEL,
+            response_cache: BaseResponseCache = None,
+            session_store: SessionMemoryStore = None,
+            instrumentation: BaseInstrumentation = None,
+            rate_limiter: RateLimiter = None):
         openai.api_key = api_key
         self.prompt = prompt
         self.gpt_model = gpt_model
+        if message_memory is None:
+            message_memory = MessageMemory()
         self.message_memory = message_memory
         self.knowledge_base = knowledge_base
+        self.response_cache = response_cache
+        self.session_store = session_store
+        self.instrumentation = instrumentation
+        self.rate_limiter = rate_limiter
         self.max_tokens = 500
 
+    def warmup(self, check_api: bool = False):
+        """Load and connect everything the first request would otherwise
+        wait for: the model's tokenizer, the knowledge base (its Redis
+        connection and index, or its matrix) and the response cache. Call it
+        at startup so the first user doesn't pay for it.
+
+        :param check_api: Also call OpenAI's API once, which opens a pooled
+            connection (for the calling thread) and checks the API key and
+            model, defaults to False
+        :type check_api: bool, optional
+        """
+        get_encoding(self.gpt_model)
+        if self.knowledge_base:
+            self.knowledge_base.warmup()
+        if self.response_cache:
+            self.response_cache.warmup()
+        if check_api:
+            openai.Model.retrieve(self.gpt_model)
+
     def _get_prompt_with_context(self, context: str) -> str:
         """ Returns the prompt with the context appended to it. This method is
         not intended to be called directly, only implemented as a helper method.
@@ -206,7 +1571,8 @@ class ChatBot:
              The user says: """)
 
     def _trim_to_fit_token_limit( 
-      self, message_list: list, context: str) -> str:
+      self, message_list: list, context: str,
+      token_counts: list[int] = None) -> str:
         """Trims the message list and context to fit within the token limit.
         This method is not intended to be called directly, only implemented as
         a helper method.
@@ -215,54 +1581,484 @@ class ChatBot:
         :type message_list: list
         :param context: The context
         :type context: str
+        :param token_counts: The number of tokens in each message, from
+            :meth:`BaseMessageMemory.get_token_counts`. They're counted here if
+            not provided.
+        :type token_counts: list[int], optional
         :return: The prompt with the context appended to it
         :rtype: str
         """
+        encoding = get_encoding(self.gpt_model)
+        if token_counts is None:
+            token_counts = [message_tokens(m, encoding) for m in message_list]
+        else:
+            token_counts = list(token_counts)
+        # every reply is primed with <im_start>assistant
+        history_tokens = sum(token_counts) + 2
+        budget = MAX_TOKENS - self.max_tokens
         prompt = self._get_prompt_with_context(context)
-        while num_tokens(message_list, prompt) > (MAX_TOKENS - self.max_tokens):
+        prompt_tokens = len(encoding.encode(prompt))
+        context_tokens = None
+        # The leading system messages (the summary of a
+        # SummarizingMessageMemory) stand for the turns before the ones kept,
+        # so the oldest turns after them are dropped first
+        pinned = 0
+        while (pinned < len(message_list) - 1
+               and message_list[pinned].get("role") == "system"):
+            pinned += 1
+        while history_tokens + prompt_tokens > budget:
             if len(message_list) > 1:
-                message_list.pop(0)
+                if len(message_list) > pinned + 1:
+                    index = pinned
+                else:
+                    index = 0
+                    pinned -= 1
+                message_list.pop(index)
+                history_tokens -= token_counts.pop(index)
                 continue
-            if len(context) <= 1:
+            if not context:
                 raise ValueError("Message list and context are too long.")
             print("Message list is too long, but we can't trim it any further.")
             print("Triming context instead.")
-            context = context[:len(context)//2]
+            if context_tokens is None:
+                # Everything in the prompt except the context
+                template_tokens = len(encoding.encode(
+                    self._get_prompt_with_context(" "))) - 1
+                context_tokens = prompt_tokens - template_tokens
+            # Cut the context to exactly what's left, tokens can merge
+            # differently at the cut so this can take one more pass
+            context_tokens -= history_tokens + prompt_tokens - budget
+            if context_tokens <= 0:
+                raise ValueError("Message list and context are too long.")
+            context = truncate_to_tokens(context, context_tokens, encoding)
             prompt = self._get_prompt_with_context(context)
+            prompt_tokens = len(encoding.encode(prompt))
+        instrumentation.record_tokens("prompt", history_tokens + prompt_tokens)
         return prompt
 
-    def get_reply(self, user_query: str) -> str:
+    def _completion_kwargs(self, prompt: str, message_list: list) -> dict:
+        """ Returns the keyword arguments for the chat completion call, shared
+        by the sync and async clients. This method is not intended to be called
+        directly, only implemented as a helper method.
+
+        :param prompt: The prompt, with context, from `_trim_to_fit_token_limit`
+        :type prompt: str
+        :param message_list: The message list
+        :type message_list: list
+        :return: The keyword arguments for ``openai.ChatCompletion.create``
+        :rtype: dict
+        """
+        return dict(
+            model=self.gpt_model,
+            messages=[
+                {"role": "user", "content": prompt.strip()},
+                *message_list,
+            ],
+            temperature=0.5,
+            max_tokens=self.max_tokens,
+            top_p=1.0,
+            frequency_penalty=0.1,
+            presence_penalty=0.6
+        )
+
+    def _estimate_tokens(
+            self, prompt: str, message_list: list,
+            token_counts: list[int]) -> int:
+        """ Returns the most tokens the completion call can use, for the rate
+        limiter: the prompt, the messages left after trimming and the
+        completion. This method is not intended to be called directly.
+
+        :param prompt: The prompt, with context, from `_trim_to_fit_token_limit`
+        :type prompt: str
+        :param message_list: The trimmed message list
+        :type message_list: list
+        :param token_counts: The number of tokens in each message before
+            trimming, the oldest were trimmed
+        :type token_counts: list[int]
+        :return: The estimated number of tokens
+        :rtype: int
+        """
+        prompt_tokens = message_tokens(
+            {"role": "user", "content": prompt.strip()},
+            get_encoding(self.gpt_model))
+        kept = token_counts[len(token_counts) - len(message_list):]
+        history_tokens = sum(kept)
+        # every reply is primed with <im_start>assistant
+        return prompt_tokens + history_tokens + 2 + self.max_tokens
+
+    def _create_completion(
+            self, prompt: str, message_list: list, token_counts: list[int],
+            **kwargs):
+        """ Call the chat completion API, through the rate limiter if there
+        is one. This method is not intended to be called directly.
+
+        :param prompt: The prompt, with context, from `_trim_to_fit_token_limit`
+        :type prompt: str
+        :param message_list: The trimmed message list
+        :type message_list: list
+        :param token_counts: The number of tokens in each message
+        :type token_counts: list[int]
+        :return: The response of ``openai.ChatCompletion.create``
+        """
+        kwargs.update(self._completion_kwargs(prompt, message_list))
+        if self.rate_limiter is None:
+            return openai.ChatCompletion.create(**kwargs)
+        return self.rate_limiter.call(
+            openai.ChatCompletion.create,
+            self._estimate_tokens(prompt, message_list, token_counts),
+            **kwargs)
+
+    def _check_session_store(self):
+        """ Raise an error if a session id is used without a session store.
+        This method is not intended to be called directly."""
+        if self.session_store is None:
+            raise ValueError(
+                "A session_store is needed to get replies by session_id.")
+
+    def get_reply(self, user_query: str, session_id: str = None) -> str:
         """Get a reply from the chatbot.
 
         :param user_query: The user's query
         :type user_query: str
+        :param session_id: The id of the conversation, defaults to None. If
+            given, the history of that conversation is used from the
+            ``session_store`` instead of the ``message_memory``.
+        :type session_id: str, optional
+        :return: The chatbot's response
+        :rtype: str
+        """
+        with instrumentation.request(self.instrumentation, "get_reply"):
+            if session_id is None:
+                return self._get_reply(user_query, self.message_memory)
+            self._check_session_store()
+            with self.session_store.session(session_id) as message_memory:
+                return self._get_reply(user_query, message_memory)
+
+    def get_replies(
+            self,
+            items: list,
+            concurrency: int = 8,
+            checkpoint: str = None,
+            memory_factory: Callable[[], BaseMessageMemory] = None,
+            prefetch: int = 64) -> Iterator[dict]:
+        """Get replies for many queries or conversations, e.g. to run an
+        evaluation set. Each item is answered with its own new message
+        memory, so the items don't see each other's history (or the
+        ``message_memory``), and up to ``concurrency`` items are answered at
+        once in worker threads. With a knowledge base, the context of the
+        next ``prefetch`` items is retrieved ahead, their queries embedded in
+        one API call (see :meth:`BaseKnowledgeBase.get_contexts`).
+
+        An item is a query (str), a conversation (a list of queries asked in
+        order) or a dict with an ``"id"`` and a ``"query"`` or a
+        ``"conversation"``, see :func:`chatbot.batch.read_jsonl` to read them
+        from a JSONL file. Items without an id are numbered by their
+        position.
+
+        The results are yielded as they finish, not in order. Each is a dict
+        with the item's ``"id"``, its ``"query"`` and ``"reply"`` (or its
+        ``"conversation"`` and ``"replies"``), the ``"error"`` that stopped
+        it, or None, and the ``"seconds"`` it took. A failed item doesn't
+        stop the others.
+
+        :param items: The queries or conversations
+        :type items: list
+        :param concurrency: The most items answered at once, defaults to 8
+        :type concurrency: int, optional
+        :param checkpoint: A JSONL file the results are appended to as they
+            finish, defaults to None. Items with a result there are skipped,
+            so an interrupted run can be started again with the same file
+            (see :class:`chatbot.batch.BatchCheckpoint`).
+        :type checkpoint: str, optional
+        :param memory_factory: Returns a new memory for each item, defaults
+            to a :class:`MessageMemory` for the bot's model
+        :type memory_factory: Callable[[], BaseMessageMemory], optional
+        :param prefetch: The number of items whose context is retrieved
+            together, defaults to 64
+        :type prefetch: int, optional
+        :return: Iterator over the results, as they finish
+        :rtype: Iterator[dict]
+        """
+        from chatbot.batch import BatchCheckpoint, to_batch_items
+        if memory_factory is None:
+            def memory_factory():
+                return MessageMemory(model=self.gpt_model)
+        batch = to_batch_items(items)
+        store = None
+        if checkpoint:
+            store = BatchCheckpoint(checkpoint)
+            batch = [item for item in batch if item.id not in store.done]
+        pending = iter(batch)
+        prefetched = deque()
+        in_flight = set()
+        executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="get_replies")
+        try:
+            while True:
+                # Keep every worker busy, retrieving the next contexts while
+                # the workers answer the items already submitted
+                while len(in_flight) < concurrency:
+                    if not prefetched:
+                        prefetched.extend(self._prefetch_contexts(
+                            list(islice(pending, prefetch))))
+                        if not prefetched:
+                            break
+                    item, contexts, context_seconds = prefetched.popleft()
+                    in_flight.add(executor.submit(
+                        self._get_batch_reply,
+                        item, memory_factory(), contexts, context_seconds))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if store:
+                        store.write(result)
+                    yield result
+        finally:
+            # If the caller stops early, the items already started finish
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+            if store:
+                store.close()
+
+    def _prefetch_contexts(self, batch: list) -> list[tuple]:
+        """ Retrieve the context of every query of the items together, for
+        :meth:`get_replies`. If that fails, each item retrieves its own. This
+        method is not intended to be called directly.
+
+        :param batch: The next items
+        :type batch: list[:class:`chatbot.batch.BatchItem`]
+        :return: Each item, with the contexts by query or None, and each
+            query's share of the time it took in seconds
+        :rtype: list[tuple]
+        """
+        contexts = None
+        context_seconds = 0.0
+        if self.knowledge_base and batch:
+            queries = list(dict.fromkeys(
+                query for item in batch for query in item.queries))
+            start = time.perf_counter()
+            try:
+                contexts = dict(zip(
+                    queries, self.knowledge_base.get_contexts(queries)))
+                context_seconds = (
+                    (time.perf_counter() - start) / len(queries))
+            except Exception as e:
+                print("Error retrieving the contexts: ", e)
+        return [(item, contexts, context_seconds) for item in batch]
+
+    def _get_batch_reply(
+            self, item, message_memory: BaseMessageMemory,
+            contexts: dict | None, context_seconds: float = 0.0) -> dict:
+        """ Answer the queries of one item of :meth:`get_replies` in order,
+        stopping at the first error. This method is not intended to be called
+        directly.
+
+        :param item: The item
+        :type item: :class:`chatbot.batch.BatchItem`
+        :param message_memory: The item's own memory
+        :type message_memory: :class:`BaseMessageMemory`
+        :param contexts: The contexts retrieved ahead, by query, or None
+        :type contexts: dict | None
+        :param context_seconds: Each query's share of the time it took to
+            retrieve them, defaults to 0.0
+        :type context_seconds: float, optional
+        :return: The item's result
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        replies = []
+        error = None
+        try:
+            for user_query in item.queries:
+                with instrumentation.request(
+                        self.instrumentation, "get_replies"):
+                    replies.append(self._get_reply(
+                        user_query, message_memory, contexts,
+                        context_seconds))
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        return item.result(replies, error, time.perf_counter() - start)
+
+    def _get_reply(
+            self, user_query: str, message_memory: BaseMessageMemory,
+            contexts: dict = None, context_seconds: float = 0.0) -> str:
+        """ Get a reply using the given message memory. This method is not
+        intended to be called directly, use :meth:`get_reply`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param message_memory: The memory of the conversation
+        :type message_memory: :class:`BaseMessageMemory`
+        :param contexts: Contexts already retrieved, by query, defaults to
+            None. The knowledge base is used for queries that aren't in it.
+        :type contexts: dict, optional
+        :param context_seconds: The time it took to retrieve a context in
+            ``contexts``, recorded as the ``context`` stage, defaults to 0.0
+        :type context_seconds: float, optional
         :return: The chatbot's response
         :rtype: str
         """
-        self.message_memory.add_latest_user_query(user_query)
-        message_list = self.message_memory.get_message_list()
+        with instrumentation.stage("memory"):
+            message_memory.add_latest_user_query(user_query)
+            message_list, token_counts = (
+                message_memory.get_messages_with_token_counts())
         context = None
         if self.knowledge_base:
-            context = self.knowledge_base.get_context(user_query)
+            if contexts is not None and user_query in contexts:
+                context = contexts[user_query]
+                instrumentation.record_stage("context", context_seconds)
+            else:
+                with instrumentation.stage("context"):
+                    context = self.knowledge_base.get_context(user_query)
+            self._record_context_tokens(context)
         try:
-            prompt = self._trim_to_fit_token_limit(
-                message_list, context)
+            if self.response_cache:
+                with instrumentation.stage("response_cache"):
+                    cached = self.response_cache.lookup(user_query, context)
+                instrumentation.record_cache("response", cached is not None)
+                if cached is not None:
+                    message_memory.add_latest_bot_response(
+                        {"role": "assistant", "content": cached})
+                    return cached
+            with instrumentation.stage("trim"):
+                prompt = self._trim_to_fit_token_limit(
+                    message_list, context, token_counts)
             # Call OpenAI's API
-            response = openai.ChatCompletion.create(
-                model=self.gpt_model,
-                messages=[
-                    {"role": "user", "content": prompt.strip()},
-                    *message_list,
-                ],
-                temperature=0.5,
-                max_tokens=self.max_tokens,
-                top_p=1.0,
-                frequency_penalty=0.1,
-                presence_penalty=0.6
-            )["choices"][0]["message"]
-            self.message_memory.add_latest_bot_response(response)
+            with instrumentation.stage("completion"):
+                completion = self._create_completion(
+                    prompt, message_list, token_counts)
+            self._record_completion_tokens(completion)
+            response = completion["choices"][0]["message"]
+            with instrumentation.stage("save"):
+                message_memory.add_latest_bot_response(response)
+                if self.response_cache:
+                    self.response_cache.store(
+                        user_query, context, response["content"])
             return response["content"]
         except Exception as e:
             print(e)
             raise(e)
+
+    def get_reply_stream(
+            self, user_query: str, session_id: str = None) -> Iterator[str]:
+        """Get a reply from the chatbot as a stream of content deltas, yielded
+        as soon as they arrive from OpenAI's API. Once the stream is finished
+        the complete response is added to the message memory, the same as
+        :meth:`get_reply`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param session_id: The id of the conversation, defaults to None.
+        :type session_id: str, optional
+        :return: Iterator over the pieces of the chatbot's response
+        :rtype: Iterator[str]
+        """
+        with instrumentation.request(self.instrumentation, "get_reply_stream"):
+            if session_id is None:
+                yield from self._get_reply_stream(
+                    user_query, self.message_memory)
+                return
+            self._check_session_store()
+            with self.session_store.session(session_id) as message_memory:
+                yield from self._get_reply_stream(user_query, message_memory)
+
+    def _get_reply_stream(
+            self, user_query: str,
+            message_memory: BaseMessageMemory) -> Iterator[str]:
+        """ Stream a reply using the given message memory. This method is not
+        intended to be called directly, use :meth:`get_reply_stream`.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param message_memory: The memory of the conversation
+        :type message_memory: :class:`BaseMessageMemory`
+        :return: Iterator over the pieces of the chatbot's response
+        :rtype: Iterator[str]
+        """
+        with instrumentation.stage("memory"):
+            message_memory.add_latest_user_query(user_query)
+            message_list, token_counts = (
+                message_memory.get_messages_with_token_counts())
+        context = None
+        if self.knowledge_base:
+            with instrumentation.stage("context"):
+                context = self.knowledge_base.get_context(user_query)
+            self._record_context_tokens(context)
+        try:
+            if self.response_cache:
+                with instrumentation.stage("response_cache"):
+                    cached = self.response_cache.lookup(user_query, context)
+                instrumentation.record_cache("response", cached is not None)
+                if cached is not None:
+                    message_memory.add_latest_bot_response(
+                        {"role": "assistant", "content": cached})
+                    yield cached
+                    return
+            with instrumentation.stage("trim"):
+                prompt = self._trim_to_fit_token_limit(
+                    message_list, context, token_counts)
+            # Includes the time the caller takes to consume the stream
+            with instrumentation.stage("completion"):
+                chunks = self._create_completion(
+                    prompt, message_list, token_counts, stream=True)
+                content = []
+                for chunk in chunks:
+                    delta = self._chunk_content(chunk)
+                    if delta:
+                        if not content:
+                            instrumentation.mark("first_token")
+                        content.append(delta)
+                        yield delta
+            # Each chunk is one token
+            instrumentation.record_tokens("completion", len(content))
+            response = {"role": "assistant", "content": "".join(content)}
+            with instrumentation.stage("save"):
+                message_memory.add_latest_bot_response(response)
+                if self.response_cache:
+                    self.response_cache.store(
+                        user_query, context, response["content"])
+        except Exception as e:
+            print(e)
+            raise(e)
+
+    def _record_context_tokens(self, context: str | None):
+        """ Record the number of tokens of context, only counted when the
+        request is instrumented. This method is not intended to be called
+        directly.
+
+        :param context: The context for the query
+        :type context: str | None
+        """
+        if context and instrumentation.current() is not None:
+            instrumentation.record_tokens(
+                "context", len(get_encoding(self.gpt_model).encode(context)))
+
+    @staticmethod
+    def _record_completion_tokens(completion: dict):
+        """ Record the completion tokens reported by OpenAI's API. This method
+        is not intended to be called directly.
+
+        :param completion: The response of the chat completion API
+        :type completion: dict
+        """
+        usage = completion.get("usage")
+        if usage:
+            instrumentation.record_tokens(
+                "completion", usage["completion_tokens"])
+
+    @staticmethod
+    def _chunk_content(chunk: dict) -> str | None:
+        """ Returns the content delta of a streamed completion chunk, if it
+        has one. The first chunk only carries the role and the last one only
+        the finish reason. This method is not intended to be called directly.
+
+        :param chunk: A chunk from a streaming chat completion
+        :type chunk: dict
+        :return: The new piece of the response, if any
+        :rtype: str | None
+        """
+        return chunk["choices"][0]["delta"].get("content")
       
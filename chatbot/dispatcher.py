@@ -0,0 +1,544 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from collections.abc import Callable
+
+
+class Job:
+    """A message waiting for a reply.
+
+    :param session_id: The id of the conversation, replies in the same
+        conversation are generated in the order the messages arrived
+    :type session_id: str
+    :param user_query: The user's message
+    :type user_query: str
+    :param meta: Whatever ``deliver`` needs to post the reply (e.g. the
+        channel and thread), must be JSON serializable for
+        :class:`RedisStreamDispatcher`, defaults to None
+    :type meta: dict, optional
+    :param enqueued_at: When the job was submitted, defaults to now
+    :type enqueued_at: float, optional
+    """
+
+    def __init__(
+            self,
+            session_id: str,
+            user_query: str,
+            meta: dict = None,
+            enqueued_at: float = None):
+        self.session_id = session_id
+        self.user_query = user_query
+        self.meta = meta or {}
+        self.enqueued_at = enqueued_at or time.time()
+
+    def to_fields(self) -> dict:
+        """Returns the job as the fields of a Redis stream entry.
+
+        :return: The fields of the entry
+        :rtype: dict
+        """
+        return {
+            "session_id": self.session_id,
+            "user_query": self.user_query,
+            "meta": json.dumps(self.meta),
+            "enqueued_at": repr(self.enqueued_at),
+        }
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "Job":
+        """Returns the job stored in a Redis stream entry.
+
+        :param fields: The fields of the entry
+        :type fields: dict
+        :return: The job
+        :rtype: :class:`Job`
+        """
+        return cls(
+            fields["session_id"],
+            fields["user_query"],
+            json.loads(fields["meta"]),
+            float(fields["enqueued_at"]))
+
+
+class BaseDispatcher:
+    """Base class for answering chat messages in the background, so webhooks
+    can acknowledge a message straight away instead of waiting for the
+    completion API. The webhook calls :meth:`submit`, a worker gets the reply
+    with ``bot.get_reply(user_query, session_id=session_id)`` and passes it
+    to ``deliver`` to post it (e.g. with Slack's or Google Chat's API).
+
+    Messages of the same conversation are answered one at a time, in the
+    order they were submitted. :meth:`submit` returns False when ``max_queue``
+    jobs are already waiting, so the webhook can tell the user to try again
+    later rather than the backlog growing without bound. :meth:`stats`
+    returns the queue depth and job counters, for monitoring.
+
+    :param bot: The chatbot, with a ``session_store`` to keep the
+        conversations apart
+    :type bot: :class:`chatbot.chatbot.ChatBot`
+    :param deliver: Called with the job and the reply to post it
+    :type deliver: Callable[[Job, str], None]
+    :param on_error: Called with the job and the exception if getting or
+        delivering the reply fails, defaults to None (the error is printed)
+    :type on_error: Callable[[Job, Exception], None], optional
+    :param max_queue: The most jobs waiting before new ones are rejected,
+        defaults to 1000
+    :type max_queue: int, optional
+    """
+
+    def __init__(
+            self,
+            bot,
+            deliver: Callable[[Job, str], None],
+            on_error: Callable[[Job, Exception], None] = None,
+            max_queue: int = 1000):
+        self.bot = bot
+        self.deliver = deliver
+        self.on_error = on_error
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(
+            self, session_id: str, user_query: str, meta: dict = None) -> bool:
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        raise NotImplementedError
+
+    def close(self, wait: bool = True):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Returns the queue depth and the job counters of this process.
+
+        :return: The jobs waiting, being answered, submitted, rejected
+            because the queue was full, completed and failed, and the mean
+            and longest time jobs waited in the queue in seconds
+        :rtype: dict
+        """
+        depth = self.depth()
+        with self._lock:
+            started = self.completed + self.failed + self.in_flight
+            return {
+                "depth": depth,
+                "in_flight": self.in_flight,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "mean_wait_s": self.total_wait / started if started else 0.0,
+                "max_wait_s": self.max_wait,
+            }
+
+    def _run(self, job: Job):
+        """ Get the reply to the job and deliver it. Not meant to be called
+        directly."""
+        wait = time.time() - job.enqueued_at
+        with self._lock:
+            self.in_flight += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        failed = False
+        try:
+            reply = self.bot.get_reply(
+                job.user_query, session_id=job.session_id)
+            self.deliver(job, reply)
+        except Exception as e:
+            failed = True
+            self._handle_error(job, e)
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self._idle.notify_all()
+
+    def _handle_error(self, job: Job, error: Exception):
+        """ Pass the error to ``on_error``, or print it. Not meant to be
+        called directly."""
+        if self.on_error is None:
+            print("Error replying to chat message: ", error)
+            return
+        try:
+            self.on_error(job, error)
+        except Exception as e:
+            print("Error in on_error: ", e)
+
+
+class ThreadDispatcher(BaseDispatcher):
+    """Answers chat messages with a pool of worker threads in this process.
+    Each conversation has its own queue, and is handed to one worker at a
+    time, so the workers answer different conversations in parallel and each
+    conversation in order.
+
+    :param bot: The chatbot, with a ``session_store``
+    :type bot: :class:`chatbot.chatbot.ChatBot`
+    :param deliver: Called with the job and the reply to post it
+    :type deliver: Callable[[Job, str], None]
+    :param workers: The number of worker threads, defaults to 8
+    :type workers: int, optional
+    :param max_queue: The most jobs waiting before new ones are rejected,
+        defaults to 1000
+    :type max_queue: int, optional
+    :param on_error: Called with the job and the exception when a reply
+        fails, defaults to None
+    :type on_error: Callable[[Job, Exception], None], optional
+    """
+
+    def __init__(
+            self,
+            bot,
+            deliver: Callable[[Job, str], None],
+            workers: int = 8,
+            max_queue: int = 1000,
+            on_error: Callable[[Job, Exception], None] = None):
+        super().__init__(bot, deliver, on_error, max_queue)
+        # The jobs of each conversation with jobs waiting or in flight, and
+        # the conversations ready for a worker
+        self._sessions = {}
+        self._ready = queue.Queue()
+        self._depth = 0
+        self._closed = False
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f"dispatcher-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+            self, session_id: str, user_query: str, meta: dict = None) -> bool:
+        """Queue a message to be answered in the background.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        :param user_query: The user's message
+        :type user_query: str
+        :param meta: Whatever ``deliver`` needs to post the reply, defaults
+            to None
+        :type meta: dict, optional
+        :return: False if the queue is full and the job was rejected
+        :rtype: bool
+        """
+        job = Job(session_id, user_query, meta)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The dispatcher is closed.")
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                return False
+            self._depth += 1
+            self.submitted += 1
+            jobs = self._sessions.get(session_id)
+            if jobs is not None:
+                # A worker picks it up after the conversation's earlier jobs
+                jobs.append(job)
+                return True
+            self._sessions[session_id] = deque([job])
+        self._ready.put(session_id)
+        return True
+
+    def depth(self) -> int:
+        """Returns the number of jobs waiting for a worker.
+
+        :return: The queue depth
+        :rtype: int
+        """
+        return self._depth
+
+    def close(self, wait: bool = True, timeout: float = None):
+        """Stop accepting jobs, and stop the workers once the queued jobs
+        are answered.
+
+        :param wait: Wait for the queued jobs and the workers, defaults to
+            True
+        :type wait: bool, optional
+        :param timeout: The longest to wait for the queued jobs, in seconds,
+            defaults to None (no limit)
+        :type timeout: float, optional
+        """
+        with self._lock:
+            self._closed = True
+            if wait:
+                self._idle.wait_for(
+                    lambda: self._depth == 0 and self.in_flight == 0,
+                    timeout)
+        for _ in self._threads:
+            self._ready.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _work(self):
+        """ Answer the next job of each ready conversation, then hand the
+        conversation back if it has more. Not meant to be called directly."""
+        while True:
+            session_id = self._ready.get()
+            if session_id is None:
+                return
+            with self._lock:
+                job = self._sessions[session_id].popleft()
+                self._depth -= 1
+            self._run(job)
+            with self._lock:
+                if not self._sessions[session_id]:
+                    del self._sessions[session_id]
+                    continue
+            self._ready.put(session_id)
+
+
+class RedisStreamDispatcher(BaseDispatcher):
+    """Answers chat messages from Redis streams, so the jobs submitted by
+    any process (e.g. every gunicorn worker) are shared by the workers of all
+    of them, and survive a restart.
+
+    The jobs are spread over ``shards`` streams by conversation. A worker
+    takes a lease on a shard before reading it, so each shard (and each
+    conversation) is read by one worker at a time, in order. Jobs are
+    removed once answered. If a worker dies mid-job its lease expires after
+    ``lease_timeout`` and the next worker answers the job again before the
+    rest of the shard.
+
+    :param bot: The chatbot, with a ``session_store``
+    :type bot: :class:`chatbot.chatbot.ChatBot`
+    :param deliver: Called with the job and the reply to post it
+    :type deliver: Callable[[Job, str], None]
+    :param redis_url: The URL for the Redis instance
+    :type redis_url: str
+    :param workers: The number of worker threads in this process, defaults
+        to 4. Use 0 for processes that only submit jobs.
+    :type workers: int, optional
+    :param max_queue: The most jobs waiting, across all processes, before
+        new ones are rejected, defaults to 1000
+    :type max_queue: int, optional
+    :param on_error: Called with the job and the exception when a reply
+        fails, defaults to None
+    :type on_error: Callable[[Job, Exception], None], optional
+    :param name: The prefix of the stream keys, defaults to "chatbot:jobs"
+    :type name: str, optional
+    :param shards: The number of streams, the most conversations answered at
+        once across all processes, defaults to 16
+    :type shards: int, optional
+    :param lease_timeout: How long a worker can take to answer a job before
+        another one can take over its shard, in seconds, defaults to 300
+    :type lease_timeout: float, optional
+    :param poll_interval: How long idle workers wait before checking for new
+        jobs, in seconds, defaults to 0.1
+    :type poll_interval: float, optional
+    """
+
+    def __init__(
+            self,
+            bot,
+            deliver: Callable[[Job, str], None],
+            redis_url: str,
+            workers: int = 4,
+            max_queue: int = 1000,
+            on_error: Callable[[Job, Exception], None] = None,
+            name: str = "chatbot:jobs",
+            shards: int = 16,
+            lease_timeout: float = 300,
+            poll_interval: float = 0.1):
+        super().__init__(bot, deliver, on_error, max_queue)
+        import redis
+        self.redis_client = redis.from_url(
+            redis_url,
+            encoding='utf-8',
+            decode_responses=True,
+            socket_timeout=3.0)
+        self.name = name
+        self.shards = shards
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.group = f"{name}:workers"
+        self._stopping = threading.Event()
+        self._create_groups()
+        consumer = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._threads = [
+            threading.Thread(
+                target=self._work, args=(f"{consumer}:{i}",),
+                name=f"dispatcher-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+            self, session_id: str, user_query: str, meta: dict = None) -> bool:
+        """Add a message to the conversation's stream.
+
+        :param session_id: The id of the conversation
+        :type session_id: str
+        :param user_query: The user's message
+        :type user_query: str
+        :param meta: Whatever ``deliver`` needs to post the reply, must be
+            JSON serializable, defaults to None
+        :type meta: dict, optional
+        :return: False if the queue is full and the job was rejected
+        :rtype: bool
+        """
+        if self.depth() >= self.max_queue:
+            with self._lock:
+                self.rejected += 1
+            return False
+        job = Job(session_id, user_query, meta)
+        self.redis_client.xadd(self._stream(session_id), job.to_fields())
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def depth(self) -> int:
+        """Returns the number of jobs not answered yet, across all
+        processes.
+
+        :return: The queue depth
+        :rtype: int
+        """
+        return sum(self._lengths())
+
+    def close(self, wait: bool = True):
+        """Stop the workers of this process after their current job. Jobs
+        still queued are left for the other processes, or the next start.
+
+        :param wait: Wait for the workers to stop, defaults to True
+        :type wait: bool, optional
+        """
+        self._stopping.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _stream(self, session_id: str) -> str:
+        """ The stream of the conversation's shard, crc32 rather than hash()
+        so every process agrees. Not meant to be called directly."""
+        shard = zlib.crc32(session_id.encode("utf-8")) % self.shards
+        return f"{self.name}:{shard}"
+
+    def _create_groups(self):
+        """ Create the consumer group of each stream, if needed. Not meant
+        to be called directly."""
+        import redis
+        for shard in range(self.shards):
+            try:
+                self.redis_client.xgroup_create(
+                    f"{self.name}:{shard}", self.group, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def _lengths(self) -> list[int]:
+        """ The number of jobs in each stream. Not meant to be called
+        directly."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for shard in range(self.shards):
+            pipe.xlen(f"{self.name}:{shard}")
+        return pipe.execute()
+
+    def _work(self, consumer: str):
+        """ Drain the shards that have jobs, one at a time, sleeping when
+        there are none. Not meant to be called directly."""
+        while not self._stopping.is_set():
+            try:
+                worked = False
+                shards = [s for s, n in enumerate(self._lengths()) if n]
+                # So the workers don't all try the same shard first
+                random.shuffle(shards)
+                for shard in shards:
+                    if self._stopping.is_set():
+                        break
+                    if self._acquire(shard, consumer):
+                        try:
+                            worked |= self._drain(shard, consumer)
+                        finally:
+                            self._release(shard, consumer)
+            except Exception as e:
+                print("Error reading chat jobs: ", e)
+                worked = False
+            if not worked:
+                self._stopping.wait(self.poll_interval)
+
+    def _drain(self, shard: int, consumer: str) -> bool:
+        """ Answer the jobs of a shard in order while holding its lease,
+        returns whether there were any. Jobs a previous owner read but
+        didn't finish come first. Not meant to be called directly."""
+        stream = f"{self.name}:{shard}"
+        worked = False
+        while not self._stopping.is_set():
+            _, entries, *_ = self.redis_client.xautoclaim(
+                stream, self.group, consumer, min_idle_time=0,
+                start_id="0-0", count=1)
+            if not entries:
+                response = self.redis_client.xreadgroup(
+                    self.group, consumer, {stream: ">"}, count=1)
+                entries = response[0][1] if response else []
+            if not entries:
+                return worked
+            entry_id, fields = entries[0]
+            if fields:
+                self._run(Job.from_fields(fields))
+                worked = True
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.xack(stream, self.group, entry_id)
+            pipe.xdel(stream, entry_id)
+            pipe.execute()
+            if not self._renew(shard, consumer):
+                return worked
+        return worked
+
+    def _lease(self, shard: int) -> str:
+        """ The key of the shard's lease. Not meant to be called directly."""
+        return f"{self.name}:lease:{shard}"
+
+    def _acquire(self, shard: int, consumer: str) -> bool:
+        """ Take the shard's lease if nobody has it. Not meant to be called
+        directly."""
+        return bool(self.redis_client.set(
+            self._lease(shard), consumer, nx=True,
+            px=int(self.lease_timeout * 1000)))
+
+    def _renew(self, shard: int, consumer: str) -> bool:
+        """ Extend the lease if this worker still has it. Not meant to be
+        called directly."""
+        return self._if_owner(
+            shard, consumer,
+            lambda pipe, key: pipe.pexpire(
+                key, int(self.lease_timeout * 1000)))
+
+    def _release(self, shard: int, consumer: str):
+        """ Give the lease up if this worker still has it. Not meant to be
+        called directly."""
+        self._if_owner(shard, consumer, lambda pipe, key: pipe.delete(key))
+
+    def _if_owner(self, shard: int, consumer: str, command) -> bool:
+        """ Run a command on the lease if it's owned by this worker, in a
+        transaction so it can't be taken over in between. Not meant to be
+        called directly."""
+        import redis
+        key = self._lease(shard)
+        with self.redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != consumer:
+                    return False
+                pipe.multi()
+                command(pipe, key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
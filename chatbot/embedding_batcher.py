@@ -0,0 +1,238 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import openai
+
+from chatbot.rate_limiter import RateLimiter
+from chatbot.utils import embedding_to_bytes, get_encoding
+
+
+class _Batch:
+    """ The texts waiting to be embedded together. Not meant to be used
+    directly."""
+
+    def __init__(self, model: str, full):
+        self.model = model
+        self.texts = []
+        self.futures = []
+        # Set when the batch is full, so the caller sending it stops waiting
+        self.full = full
+
+
+class EmbeddingBatcher:
+    """Combines the embedding requests of concurrent callers into batched
+    calls to OpenAI's embedding API. The first caller waits up to
+    ``max_wait`` seconds for others to join its batch (or until there are
+    ``max_batch_size`` texts), sends them all in one request and hands each
+    caller its own vector. Callers asking for a text that is already waiting
+    or in flight share its result instead of adding it again.
+
+    It works from threads (:meth:`embed`) and from asyncio (:meth:`aembed`),
+    the two are batched separately. Pass it to the knowledge base (or use
+    :func:`chatbot.embedding_cache.get_embedding` with ``batcher``) to use it,
+    together with an embedding cache if there is one. The async callers
+    must all use the same event loop.
+
+    :param max_wait: How long the first caller of a batch waits for others,
+        in seconds, defaults to 0.005
+    :type max_wait: float, optional
+    :param max_batch_size: The most texts sent in one request, defaults to 64
+    :type max_batch_size: int, optional
+    :param rate_limiter: Schedules and retries the batched calls, defaults to
+        None
+    :type rate_limiter: :class:`chatbot.rate_limiter.RateLimiter`, optional
+    """
+
+    def __init__(
+            self,
+            max_wait: float = 0.005,
+            max_batch_size: int = 64,
+            rate_limiter: RateLimiter = None):
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.rate_limiter = rate_limiter
+        # Texts that are waiting or in flight, for the threaded callers
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._pending = {}
+        # The same for the async callers, they all run in one event loop
+        self._abatches = {}
+        self._apending = {}
+        # The tasks sending the async batches, kept so they aren't collected
+        self._tasks = set()
+        self.requests = 0
+        self.deduplicated = 0
+        self.batches = 0
+
+    def embed(self, text: str, model: str) -> bytes:
+        """Get the embedding of the text, batched with those of concurrent
+        callers.
+
+        :param text: The text to embed
+        :type text: str
+        :param model: The embedding model
+        :type model: str
+        :return: The float32 bytes of the embedding
+        :rtype: bytes
+        """
+        with self._lock:
+            self.requests += 1
+            future = self._pending.get((model, text))
+            if future is not None:
+                self.deduplicated += 1
+                leader = None
+            else:
+                future = Future()
+                self._pending[(model, text)] = future
+                leader = self._add(
+                    self._batches, model, text, future, threading.Event)
+        if leader is not None:
+            self._wait_and_send(leader)
+        return future.result()
+
+    async def aembed(self, text: str, model: str) -> bytes:
+        """Async version of :meth:`embed`.
+
+        :param text: The text to embed
+        :type text: str
+        :param model: The embedding model
+        :type model: str
+        :return: The float32 bytes of the embedding
+        :rtype: bytes
+        """
+        self.requests += 1
+        future = self._apending.get((model, text))
+        if future is not None:
+            self.deduplicated += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._apending[(model, text)] = future
+            leader = self._add(
+                self._abatches, model, text, future, asyncio.Event)
+            if leader is not None:
+                # Sent from its own task, not the caller's, so the batch
+                # still goes out if the caller that opened it is cancelled
+                task = loop.create_task(self._await_and_send(leader))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        # shield, so one caller being cancelled doesn't cancel the others
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        """Returns the request counters.
+
+        :return: The number of texts requested, of those that were already
+            pending, and of API calls made
+        :rtype: dict
+        """
+        return {
+            "requests": self.requests,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+        }
+
+    def _add(
+            self, batches: dict, model: str, text: str, future,
+            event_type) -> _Batch | None:
+        """ Add a text to the open batch of the model, returns the batch if
+        this caller opened it and has to send it. Full batches are closed so
+        the next caller opens a new one. Not meant to be called directly."""
+        batch = batches.get(model)
+        leader = None
+        if batch is None:
+            batch = leader = batches[model] = _Batch(model, event_type())
+        batch.texts.append(text)
+        batch.futures.append(future)
+        if len(batch.texts) >= self.max_batch_size:
+            del batches[model]
+            batch.full.set()
+        return leader
+
+    def _close(self, batches: dict, batch: _Batch):
+        """ Stop new texts from joining the batch. Not meant to be called
+        directly."""
+        if batches.get(batch.model) is batch:
+            del batches[batch.model]
+
+    def _wait_and_send(self, batch: _Batch):
+        """ Wait for the batch to fill up or time out, then send it. Not
+        meant to be called directly."""
+        batch.full.wait(self.max_wait)
+        with self._lock:
+            self._close(self._batches, batch)
+            self.batches += 1
+        try:
+            kwargs = dict(
+                input=batch.texts, model=batch.model, encoding_format="base64")
+            if self.rate_limiter:
+                response = self.rate_limiter.call(
+                    openai.Embedding.create, self._tokens(batch), **kwargs)
+            else:
+                response = openai.Embedding.create(**kwargs)
+            self._resolve(batch, response, self._pending)
+        except Exception as e:
+            self._fail(batch, e, self._pending)
+
+    async def _await_and_send(self, batch: _Batch):
+        """ Async version of `_wait_and_send`, run in its own task. Not meant
+        to be called directly."""
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            self._close(self._abatches, batch)
+            self.batches += 1
+            kwargs = dict(
+                input=batch.texts, model=batch.model, encoding_format="base64")
+            if self.rate_limiter:
+                response = await self.rate_limiter.acall(
+                    openai.Embedding.acreate, self._tokens(batch), **kwargs)
+            else:
+                response = await openai.Embedding.acreate(**kwargs)
+        except BaseException as e:
+            # Also when the task is cancelled (e.g. the loop is closing), or
+            # the callers would wait for the batch forever
+            self._close(self._abatches, batch)
+            if isinstance(e, Exception):
+                self._fail(batch, e, self._apending)
+                return
+            self._fail(
+                batch,
+                RuntimeError("The embedding batch was cancelled"),
+                self._apending)
+            raise
+        self._resolve(batch, response, self._apending)
+
+    @staticmethod
+    def _tokens(batch: _Batch) -> int:
+        """ The tokens of the batch, for the rate limiter. Not meant to be
+        called directly."""
+        encoding = get_encoding(batch.model)
+        return sum(len(encoding.encode(text)) for text in batch.texts)
+
+    def _resolve(self, batch: _Batch, response: dict, pending: dict):
+        """ Hand each caller its vector. Not meant to be called directly."""
+        vectors = [
+            embedding_to_bytes(data["embedding"])
+            for data in sorted(response["data"], key=lambda d: d["index"])
+        ]
+        with self._lock:
+            for text, future, vector in zip(
+                    batch.texts, batch.futures, vectors):
+                pending.pop((batch.model, text), None)
+                future.set_result(vector)
+
+    def _fail(self, batch: _Batch, error: BaseException, pending: dict):
+        """ Raise the error in every caller of the batch. Not meant to be
+        called directly."""
+        with self._lock:
+            for text, future in zip(batch.texts, batch.futures):
+                pending.pop((batch.model, text), None)
+                future.set_exception(error)
+                if isinstance(future, asyncio.Future):
+                    # Callers that were cancelled never retrieve it, the
+                    # others still get it raised when they await
+                    future.exception()
@@ -0,0 +1,505 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import openai
+
+from chatbot import instrumentation
+from chatbot.embedding_batcher import EmbeddingBatcher
+from chatbot.rate_limiter import RateLimiter
+from chatbot.utils import embedding_to_bytes, get_encoding
+
+
+class BaseEmbeddingCache:
+    """Base class for caching query embeddings, so repeated queries don't
+    need a round trip to OpenAI's embedding API. Entries are keyed by the
+    embedding model and a hash of the normalized text, and the values are the
+    float32 bytes of the vector (the same format stored in Redis). This
+    interface is assumed to be implemented by
+    :class:`chatbot.chatbot.KnowledgeBaseRedis`, so any new child classes must
+    implement :meth:`get` and :meth:`set`.
+
+    Each cache counts its own ``hits`` and ``misses``.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(model: str, text: str) -> str:
+        """Returns the cache key for the text, the whitespace is collapsed
+        and the text is case folded before hashing so trivially different
+        versions of a query share an entry.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cache key
+        :rtype: str
+        """
+        normalized = " ".join(text.split()).casefold()
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{model}:{digest}"
+
+    def get(self, model: str, text: str) -> bytes | None:
+        raise NotImplementedError
+
+    def set(self, model: str, text: str, vector: bytes):
+        raise NotImplementedError
+
+    async def aget(self, model: str, text: str) -> bytes | None:
+        """Async version of :meth:`get`, calls the sync method by default.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        return self.get(model, text)
+
+    async def aset(self, model: str, text: str, vector: bytes):
+        """Async version of :meth:`set`, calls the sync method by default.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        self.set(model, text, vector)
+
+    def warmup(self):
+        """Open the cache's connections before the first query. Does nothing
+        by default."""
+
+    def _count(self, vector: bytes | None):
+        """ Update the hit/miss counters. Not meant to be called directly."""
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters.
+
+        :return: The hits, misses and hit rate of the cache
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class EmbeddingCacheLRU(BaseEmbeddingCache):
+    """Bounded in-process cache of embeddings that evicts the least recently
+    used entry when it's full. Safe to share between threads.
+
+    :param max_size: The maximum number of embeddings to keep, defaults to
+        1024 (about 6 MB for 1536 dimension vectors)
+    :type max_size: int, optional
+    """
+
+    def __init__(self, max_size: int = 1024):
+        super().__init__()
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model: str, text: str) -> bytes | None:
+        """Get the cached embedding for the text.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        key = self.cache_key(model, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def set(self, model: str, text: str, vector: bytes):
+        """Add an embedding to the cache, evicting the least recently used one
+        if the cache is full.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        key = self.cache_key(model, text)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class EmbeddingCacheRedis(BaseEmbeddingCache):
+    """Embedding cache shared between processes, stores the raw float32 bytes
+    of each vector in Redis with a TTL.
+
+    :param redis_url: The URL for the Redis instance
+    :type redis_url: str
+    :param ttl: How long to keep each embedding, in seconds, defaults to one
+        day
+    :type ttl: int, optional
+    :param prefix: The prefix for the cache keys, defaults to "embedding:"
+    :type prefix: str, optional
+    """
+
+    def __init__(self, redis_url: str, ttl: int = 86400,
+                 prefix: str = "embedding:"):
+        super().__init__()
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.prefix = prefix
+        import redis
+        # The vectors are binary, so responses must not be decoded
+        self.redis_client = redis.from_url(redis_url, socket_timeout=3.0)
+        self._async_redis_client = None
+
+    def _get_async_client(self):
+        """ Returns the async Redis client, creating it on first use. Not meant
+        to be called directly."""
+        if self._async_redis_client is None:
+            import redis.asyncio
+            self._async_redis_client = redis.asyncio.from_url(
+                self.redis_url, socket_timeout=3.0)
+        return self._async_redis_client
+
+    def warmup(self):
+        """Open a connection to Redis before the first query."""
+        try:
+            self.redis_client.ping()
+        except Exception as e:
+            print("Error connecting to embedding cache: ", e)
+
+    def get(self, model: str, text: str) -> bytes | None:
+        """Get the cached embedding for the text.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        try:
+            vector = self.redis_client.get(
+                self.prefix + self.cache_key(model, text))
+        except Exception as e:
+            print("Error reading embedding cache: ", e)
+            vector = None
+        self._count(vector)
+        return vector
+
+    def set(self, model: str, text: str, vector: bytes):
+        """Add an embedding to the cache.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        try:
+            self.redis_client.set(
+                self.prefix + self.cache_key(model, text), vector, ex=self.ttl)
+        except Exception as e:
+            print("Error writing embedding cache: ", e)
+
+    async def aget(self, model: str, text: str) -> bytes | None:
+        """Async version of :meth:`get`.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        try:
+            vector = await self._get_async_client().get(
+                self.prefix + self.cache_key(model, text))
+        except Exception as e:
+            print("Error reading embedding cache: ", e)
+            vector = None
+        self._count(vector)
+        return vector
+
+    async def aset(self, model: str, text: str, vector: bytes):
+        """Async version of :meth:`set`.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        try:
+            await self._get_async_client().set(
+                self.prefix + self.cache_key(model, text), vector, ex=self.ttl)
+        except Exception as e:
+            print("Error writing embedding cache: ", e)
+
+
+class TwoTierEmbeddingCache(BaseEmbeddingCache):
+    """Embedding cache that checks a small in-process cache first, then a
+    shared one (usually :class:`EmbeddingCacheLRU` and
+    :class:`EmbeddingCacheRedis`). Hits in the shared tier are copied into the
+    local tier. The counters here count hits in either tier, the per tier
+    numbers are in :meth:`stats`.
+
+    :param local: The in-process tier
+    :type local: :class:`BaseEmbeddingCache`
+    :param shared: The shared tier
+    :type shared: :class:`BaseEmbeddingCache`
+    """
+
+    def __init__(self, local: BaseEmbeddingCache, shared: BaseEmbeddingCache):
+        super().__init__()
+        self.local = local
+        self.shared = shared
+
+    def get(self, model: str, text: str) -> bytes | None:
+        """Get the cached embedding for the text from either tier.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        vector = self.local.get(model, text)
+        if vector is None:
+            vector = self.shared.get(model, text)
+            if vector is not None:
+                self.local.set(model, text, vector)
+        self._count(vector)
+        return vector
+
+    def set(self, model: str, text: str, vector: bytes):
+        """Add an embedding to both tiers.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        self.local.set(model, text, vector)
+        self.shared.set(model, text, vector)
+
+    def warmup(self):
+        """Open the connections of both tiers."""
+        self.local.warmup()
+        self.shared.warmup()
+
+    async def aget(self, model: str, text: str) -> bytes | None:
+        """Async version of :meth:`get`.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :return: The cached vector, or None
+        :rtype: bytes | None
+        """
+        vector = await self.local.aget(model, text)
+        if vector is None:
+            vector = await self.shared.aget(model, text)
+            if vector is not None:
+                await self.local.aset(model, text, vector)
+        self._count(vector)
+        return vector
+
+    async def aset(self, model: str, text: str, vector: bytes):
+        """Async version of :meth:`set`.
+
+        :param model: The embedding model
+        :type model: str
+        :param text: The text that was embedded
+        :type text: str
+        :param vector: The float32 bytes of the embedding
+        :type vector: bytes
+        """
+        await self.local.aset(model, text, vector)
+        await self.shared.aset(model, text, vector)
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters, overall and for each tier.
+
+        :return: The cache statistics
+        :rtype: dict
+        """
+        return {
+            **super().stats(),
+            "local": self.local.stats(),
+            "shared": self.shared.stats(),
+        }
+
+
+def get_embedding(
+        text: str,
+        model: str,
+        cache: BaseEmbeddingCache = None,
+        batcher: EmbeddingBatcher = None,
+        rate_limiter: RateLimiter = None) -> bytes:
+    """Get the embedding of the text as float32 bytes, checking the cache
+    first if there is one and adding the embedding to it otherwise.
+
+    :param text: The text to embed
+    :type text: str
+    :param model: The embedding model
+    :type model: str
+    :param cache: The embedding cache, defaults to None
+    :type cache: :class:`BaseEmbeddingCache`, optional
+    :param batcher: Batches the API call with those of concurrent callers,
+        defaults to None
+    :type batcher: :class:`chatbot.embedding_batcher.EmbeddingBatcher`,
+        optional
+    :param rate_limiter: Schedules and retries the API call, when there is
+        no batcher (the batcher has its own), defaults to None
+    :type rate_limiter: :class:`chatbot.rate_limiter.RateLimiter`, optional
+    :return: The embedding of the text
+    :rtype: bytes
+    """
+    if cache:
+        vector = cache.get(model, text)
+        instrumentation.record_cache("embedding", vector is not None)
+        if vector is not None:
+            return vector
+    with instrumentation.stage("embedding"):
+        if batcher:
+            vector = batcher.embed(text, model)
+        else:
+            kwargs = dict(input=text, model=model, encoding_format="base64")
+            if rate_limiter:
+                embedding = rate_limiter.call(
+                    openai.Embedding.create,
+                    len(get_encoding(model).encode(text)), **kwargs)
+            else:
+                embedding = openai.Embedding.create(**kwargs)
+            # The base64 string is the raw float32 bytes, no list of floats
+            vector = embedding_to_bytes(embedding["data"][0]["embedding"])
+    if cache:
+        cache.set(model, text, vector)
+    return vector
+
+
+async def aget_embedding(
+        text: str,
+        model: str,
+        cache: BaseEmbeddingCache = None,
+        batcher: EmbeddingBatcher = None,
+        rate_limiter: RateLimiter = None) -> bytes:
+    """Async version of :func:`get_embedding`.
+
+    :param text: The text to embed
+    :type text: str
+    :param model: The embedding model
+    :type model: str
+    :param cache: The embedding cache, defaults to None
+    :type cache: :class:`BaseEmbeddingCache`, optional
+    :param batcher: Batches the API call with those of concurrent callers,
+        defaults to None
+    :type batcher: :class:`chatbot.embedding_batcher.EmbeddingBatcher`,
+        optional
+    :param rate_limiter: Schedules and retries the API call, when there is
+        no batcher (the batcher has its own), defaults to None
+    :type rate_limiter: :class:`chatbot.rate_limiter.RateLimiter`, optional
+    :return: The embedding of the text
+    :rtype: bytes
+    """
+    if cache:
+        vector = await cache.aget(model, text)
+        instrumentation.record_cache("embedding", vector is not None)
+        if vector is not None:
+            return vector
+    with instrumentation.stage("embedding"):
+        if batcher:
+            vector = await batcher.aembed(text, model)
+        else:
+            kwargs = dict(input=text, model=model, encoding_format="base64")
+            if rate_limiter:
+                embedding = await rate_limiter.acall(
+                    openai.Embedding.acreate,
+                    len(get_encoding(model).encode(text)), **kwargs)
+            else:
+                embedding = await openai.Embedding.acreate(**kwargs)
+            # The base64 string is the raw float32 bytes, no list of floats
+            vector = embedding_to_bytes(embedding["data"][0]["embedding"])
+    if cache:
+        await cache.aset(model, text, vector)
+    return vector
+
+
+def get_embeddings(
+        texts: list[str],
+        model: str,
+        cache: BaseEmbeddingCache = None,
+        rate_limiter: RateLimiter = None,
+        batch_size: int = 500) -> list[bytes]:
+    """Get the embeddings of many texts as float32 bytes, the ones that
+    aren't in the cache are embedded ``batch_size`` at a time, one API call
+    per batch, and added to it.
+
+    :param texts: The texts to embed
+    :type texts: list[str]
+    :param model: The embedding model
+    :type model: str
+    :param cache: The embedding cache, defaults to None
+    :type cache: :class:`BaseEmbeddingCache`, optional
+    :param rate_limiter: Schedules and retries the API calls, defaults to
+        None
+    :type rate_limiter: :class:`chatbot.rate_limiter.RateLimiter`, optional
+    :param batch_size: The most texts sent in one request, defaults to 500
+    :type batch_size: int, optional
+    :return: The embedding of each text, in order
+    :rtype: list[bytes]
+    """
+    vectors = [None] * len(texts)
+    if cache:
+        for i, text in enumerate(texts):
+            vectors[i] = cache.get(model, text)
+            instrumentation.record_cache("embedding", vectors[i] is not None)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    for start in range(0, len(missing), batch_size):
+        rows = missing[start:start + batch_size]
+        batch = [texts[i] for i in rows]
+        kwargs = dict(input=batch, model=model, encoding_format="base64")
+        if rate_limiter:
+            encoding = get_encoding(model)
+            response = rate_limiter.call(
+                openai.Embedding.create,
+                sum(len(encoding.encode(text)) for text in batch), **kwargs)
+        else:
+            response = openai.Embedding.create(**kwargs)
+        data = sorted(response["data"], key=lambda d: d["index"])
+        for i, embedding in zip(rows, data):
+            vectors[i] = embedding_to_bytes(embedding["embedding"])
+            if cache:
+                cache.set(model, texts[i], vectors[i])
+    return vectors
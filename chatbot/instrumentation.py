@@ -0,0 +1,439 @@
+import contextlib
+import contextvars
+import time
+
+# The request being recorded, set by :func:`request`. Nested code (the
+# knowledge base, the embedding cache, ...) records to it without passing it
+# around. asyncio tasks copy the context they're created in, but threads
+# (and thread pool workers) start with an empty one, so work handed to them
+# is run with ``contextvars.copy_context().run``.
+_current = contextvars.ContextVar("chatbot_request", default=None)
+
+# Returned when nothing is being recorded, so disabled hooks cost one lookup
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class RequestMetrics:
+    """The measurements of one request, passed to the instrumentation hooks.
+
+    Stages are timed separately and can be nested: ``context`` includes the
+    ``embedding`` and ``search`` done to get the context. Stages that run more
+    than once in a request (e.g. several embeddings) are added up.
+
+    :param kind: The method that handled the request, e.g. "get_reply"
+    :type kind: str
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        # Seconds spent in each stage
+        self.stages = {}
+        # Tokens, by type: "prompt", "completion" and "context"
+        self.tokens = {}
+        # Cache results, by cache name: True for a hit, False for a miss
+        self.cache = {}
+        # Documents retrieved for the context, with their scores
+        self.documents = []
+        self.retries = 0
+        self.error = None
+        self.duration = None
+        self.start = time.perf_counter()
+
+    def as_dict(self) -> dict:
+        """Returns the metrics as a dict, e.g. to log them as JSON.
+
+        :return: The metrics
+        :rtype: dict
+        """
+        return {
+            "kind": self.kind,
+            "duration": self.duration,
+            "stages": dict(self.stages),
+            "tokens": dict(self.tokens),
+            "cache": dict(self.cache),
+            "documents": list(self.documents),
+            "retries": self.retries,
+            "error": self.error,
+        }
+
+
+class BaseInstrumentation:
+    """Base class for the hooks called by :class:`chatbot.chatbot.ChatBot` for
+    each request and each stage of it: ``memory``, ``context`` (with
+    ``embedding``, ``search`` and ``rerank``), ``response_cache``, ``trim``,
+    ``completion`` (and ``first_token`` when streaming) and ``save``.
+    All the hooks do nothing by default, override the ones needed.
+
+    Without an instrumentation the chatbot doesn't record anything, the only
+    cost is checking a context variable at each stage.
+    """
+
+    def start_request(self, metrics: RequestMetrics):
+        """Called when a request starts.
+
+        :param metrics: The metrics of the request
+        :type metrics: :class:`RequestMetrics`
+        """
+
+    def end_request(self, metrics: RequestMetrics):
+        """Called when a request is finished (or failed, then
+        ``metrics.error`` is set), with all its metrics.
+
+        :param metrics: The metrics of the request
+        :type metrics: :class:`RequestMetrics`
+        """
+
+    def start_stage(self, metrics: RequestMetrics, stage: str):
+        """Called when a stage starts. Whatever it returns is passed to
+        :meth:`end_stage`, e.g. a tracing span.
+
+        :param metrics: The metrics of the request
+        :type metrics: :class:`RequestMetrics`
+        :param stage: The name of the stage
+        :type stage: str
+        """
+
+    def end_stage(
+            self, metrics: RequestMetrics, stage: str, duration: float,
+            state=None, error: BaseException = None):
+        """Called when a stage is finished.
+
+        :param metrics: The metrics of the request
+        :type metrics: :class:`RequestMetrics`
+        :param stage: The name of the stage
+        :type stage: str
+        :param duration: How long the stage took, in seconds
+        :type duration: float
+        :param state: What :meth:`start_stage` returned, None for stages
+            recorded with :func:`mark`
+        :param error: The exception raised in the stage, if any
+        :type error: BaseException, optional
+        """
+
+
+class CallbackInstrumentation(BaseInstrumentation):
+    """Calls functions with the measurements, e.g. to log them or send them
+    to a metrics library that isn't supported here.
+
+    :param on_request: Called with the :class:`RequestMetrics` of every
+        finished request, defaults to None
+    :type on_request: Callable[[RequestMetrics], None], optional
+    :param on_stage: Called with the metrics, stage name and duration of
+        every finished stage, defaults to None
+    :type on_stage: Callable[[RequestMetrics, str, float], None], optional
+    """
+
+    def __init__(self, on_request=None, on_stage=None):
+        self.on_request = on_request
+        self.on_stage = on_stage
+
+    def end_request(self, metrics: RequestMetrics):
+        if self.on_request:
+            self.on_request(metrics)
+
+    def end_stage(
+            self, metrics: RequestMetrics, stage: str, duration: float,
+            state=None, error: BaseException = None):
+        if self.on_stage:
+            self.on_stage(metrics, stage, duration)
+
+
+class OpenTelemetryInstrumentation(BaseInstrumentation):
+    """Traces each request as an OpenTelemetry span, with a child span per
+    stage, and the tokens, cache results and retries as attributes. Needs the
+    ``opentelemetry-api`` package.
+
+    :param tracer: The tracer to use, defaults to one named "chatbot" from
+        the global tracer provider
+    :type tracer: opentelemetry.trace.Tracer, optional
+    """
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import context, trace
+        except ImportError as e:
+            raise ImportError(
+                "OpenTelemetryInstrumentation needs opentelemetry-api, "
+                "pip install opentelemetry-api") from e
+        self._context = context
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("chatbot")
+        # The span and context token of each request
+        self._spans = {}
+
+    def start_request(self, metrics: RequestMetrics):
+        span = self.tracer.start_span(f"chatbot.{metrics.kind}")
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        self._spans[id(metrics)] = (span, token)
+
+    def end_request(self, metrics: RequestMetrics):
+        span, token = self._spans.pop(id(metrics))
+        for name, count in metrics.tokens.items():
+            span.set_attribute(f"chatbot.tokens.{name}", count)
+        for name, hit in metrics.cache.items():
+            span.set_attribute(f"chatbot.cache.{name}", "hit" if hit else "miss")
+        if metrics.documents:
+            span.set_attribute(
+                "chatbot.documents", [str(d["id"]) for d in metrics.documents])
+            span.set_attribute(
+                "chatbot.document_scores",
+                [d["score"] for d in metrics.documents])
+        span.set_attribute("chatbot.retries", metrics.retries)
+        if metrics.error:
+            span.set_status(self._trace.Status(
+                self._trace.StatusCode.ERROR, metrics.error))
+        span.end()
+        self._detach(token)
+
+    def start_stage(self, metrics: RequestMetrics, stage: str):
+        span = self.tracer.start_span(f"chatbot.{stage}")
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        return span, token
+
+    def end_stage(
+            self, metrics: RequestMetrics, stage: str, duration: float,
+            state=None, error: BaseException = None):
+        if state is None:
+            return
+        span, token = state
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR))
+        span.end()
+        self._detach(token)
+
+    def _detach(self, token):
+        """ Detach a context, a stream closed from another task can't be.
+        Not meant to be called directly."""
+        try:
+            self._context.detach(token)
+        except ValueError:
+            pass
+
+
+class PrometheusInstrumentation(BaseInstrumentation):
+    """Exports the measurements as Prometheus metrics: histograms of the
+    request and stage durations and of the retrieved documents' scores, and
+    counters of tokens, cache results, retries and errors. Needs the
+    ``prometheus-client`` package, expose them with its ``start_http_server``
+    or ``make_asgi_app``.
+
+    :param registry: The registry for the metrics, defaults to the global one
+    :type registry: prometheus_client.CollectorRegistry, optional
+    :param prefix: The prefix of the metric names, defaults to "chatbot"
+    :type prefix: str, optional
+    """
+
+    def __init__(self, registry=None, prefix: str = "chatbot"):
+        try:
+            import prometheus_client
+        except ImportError as e:
+            raise ImportError(
+                "PrometheusInstrumentation needs prometheus-client, "
+                "pip install prometheus-client") from e
+        kwargs = {"registry": registry} if registry is not None else {}
+        self.request_seconds = prometheus_client.Histogram(
+            f"{prefix}_request_seconds", "Duration of chatbot requests",
+            ["kind"], **kwargs)
+        self.stage_seconds = prometheus_client.Histogram(
+            f"{prefix}_stage_seconds", "Duration of each stage of a request",
+            ["stage"], **kwargs)
+        self.tokens = prometheus_client.Counter(
+            f"{prefix}_tokens", "Tokens used, by type", ["type"], **kwargs)
+        self.cache = prometheus_client.Counter(
+            f"{prefix}_cache_lookups", "Cache lookups, by cache and result",
+            ["cache", "result"], **kwargs)
+        self.document_score = prometheus_client.Histogram(
+            f"{prefix}_document_score",
+            "Cosine similarity of the documents retrieved for the context",
+            buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0),
+            **kwargs)
+        self.retries = prometheus_client.Counter(
+            f"{prefix}_retries", "Retried API calls", **kwargs)
+        self.errors = prometheus_client.Counter(
+            f"{prefix}_errors", "Failed requests", ["kind"], **kwargs)
+
+    def end_request(self, metrics: RequestMetrics):
+        self.request_seconds.labels(metrics.kind).observe(metrics.duration)
+        for name, count in metrics.tokens.items():
+            self.tokens.labels(name).inc(count)
+        for name, hit in metrics.cache.items():
+            self.cache.labels(name, "hit" if hit else "miss").inc()
+        for document in metrics.documents:
+            self.document_score.observe(document["score"])
+        if metrics.retries:
+            self.retries.inc(metrics.retries)
+        if metrics.error:
+            self.errors.labels(metrics.kind).inc()
+
+    def end_stage(
+            self, metrics: RequestMetrics, stage: str, duration: float,
+            state=None, error: BaseException = None):
+        self.stage_seconds.labels(stage).observe(duration)
+
+
+class _Request:
+    """ Context manager that records the metrics of one request. Not meant
+    to be used directly, see :func:`request`."""
+
+    def __init__(self, instrumentation: BaseInstrumentation, kind: str):
+        self.instrumentation = instrumentation
+        self.metrics = RequestMetrics(kind)
+
+    def __enter__(self) -> RequestMetrics:
+        self._token = _current.set(self)
+        self.instrumentation.start_request(self.metrics)
+        return self.metrics
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.duration = time.perf_counter() - self.metrics.start
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self.metrics.error = repr(exc)
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # A stream closed from another context, the value is dropped
+            # with that context anyway
+            pass
+        self.instrumentation.end_request(self.metrics)
+
+
+class _Stage:
+    """ Context manager that times one stage of a request. Not meant to be
+    used directly, see :func:`stage`."""
+
+    def __init__(self, request: _Request, name: str):
+        self.instrumentation = request.instrumentation
+        self.metrics = request.metrics
+        self.name = name
+
+    def __enter__(self):
+        self._state = self.instrumentation.start_stage(self.metrics, self.name)
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self._start
+        stages = self.metrics.stages
+        stages[self.name] = stages.get(self.name, 0.0) + duration
+        self.instrumentation.end_stage(
+            self.metrics, self.name, duration, self._state, exc)
+
+
+def request(instrumentation: BaseInstrumentation | None, kind: str):
+    """Returns a context manager that records a request with the
+    instrumentation, or does nothing if it's None.
+
+    :param instrumentation: The instrumentation, or None
+    :type instrumentation: :class:`BaseInstrumentation` | None
+    :param kind: The method handling the request, e.g. "get_reply"
+    :type kind: str
+    """
+    if instrumentation is None:
+        return _NULL_CONTEXT
+    return _Request(instrumentation, kind)
+
+
+def stage(name: str):
+    """Returns a context manager that times a stage of the current request,
+    or does nothing if no request is being recorded.
+
+    :param name: The name of the stage
+    :type name: str
+    """
+    current_request = _current.get()
+    if current_request is None:
+        return _NULL_CONTEXT
+    return _Stage(current_request, name)
+
+
+def mark(name: str):
+    """Record the time since the current request started as a stage, e.g.
+    the time to the first token of a stream.
+
+    :param name: The name of the stage
+    :type name: str
+    """
+    current_request = _current.get()
+    if current_request is None:
+        return
+    metrics = current_request.metrics
+    duration = time.perf_counter() - metrics.start
+    metrics.stages[name] = duration
+    current_request.instrumentation.end_stage(metrics, name, duration)
+
+
+def record_stage(name: str, duration: float):
+    """Add a stage that was timed outside the current request, e.g. its
+    share of work done for several requests at once, if it's recorded.
+
+    :param name: The name of the stage
+    :type name: str
+    :param duration: How long the stage took, in seconds
+    :type duration: float
+    """
+    current_request = _current.get()
+    if current_request is None:
+        return
+    metrics = current_request.metrics
+    metrics.stages[name] = metrics.stages.get(name, 0.0) + duration
+    current_request.instrumentation.end_stage(metrics, name, duration)
+
+
+def current() -> RequestMetrics | None:
+    """Returns the metrics of the request being recorded, if any.
+
+    :return: The metrics of the current request
+    :rtype: :class:`RequestMetrics` | None
+    """
+    current_request = _current.get()
+    return current_request.metrics if current_request else None
+
+
+def record_tokens(kind: str, count: int):
+    """Add to the token count of the current request, if it's recorded.
+
+    :param kind: The type of tokens, e.g. "prompt"
+    :type kind: str
+    :param count: The number of tokens
+    :type count: int
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.tokens[kind] = metrics.tokens.get(kind, 0) + count
+
+
+def record_cache(name: str, hit: bool):
+    """Record a cache lookup in the current request, if it's recorded.
+
+    :param name: The name of the cache, e.g. "embedding"
+    :type name: str
+    :param hit: Whether the lookup was a hit
+    :type hit: bool
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.cache[name] = hit
+
+
+def record_documents(documents: list[dict]):
+    """Record the documents retrieved for the context of the current request,
+    if it's recorded. Their content is left out.
+
+    :param documents: The documents, with their ``"id"``, their ``"score"``
+        (cosine similarity to the query) and their ``"mmr_score"`` if they
+        were re-ranked
+    :type documents: list[dict]
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.documents.extend(
+            {key: value for key, value in document.items()
+             if key != "content"}
+            for document in documents)
+
+
+def record_retry():
+    """Count a retried API call in the current request, if it's recorded."""
+    metrics = current()
+    if metrics is not None:
+        metrics.retries += 1
@@ -0,0 +1,391 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+from chatbot import instrumentation
+
+# Errors worth retrying, the rest (bad requests, auth, ...) fail straight away
+_RETRYABLE = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    TimeoutError,
+    asyncio.TimeoutError,
+)
+# Errors that mean the API is overloaded, so fewer calls are sent at once
+_OVERLOADED = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    TimeoutError,
+    asyncio.TimeoutError,
+)
+
+
+class _TokenBucket:
+    """ Refills at ``per_minute`` a minute, up to a minute's worth. Callers
+    reserve what they need and wait for it, so the bucket can go negative and
+    later callers wait their turn. Not meant to be used directly."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """ Take the amount, returns how long to wait before using it."""
+        self._refill()
+        self.available -= amount
+        return max(0.0, -self.available / self.rate)
+
+    def try_take(self, amount: float) -> bool:
+        """ Take the amount only if it's available now."""
+        self._refill()
+        if self.available < amount:
+            return False
+        self.available -= amount
+        return True
+
+    def refund(self, amount: float):
+        self.available = min(self.capacity, self.available + amount)
+
+
+class RateLimiter:
+    """Schedules calls to one of OpenAI's models so they stay under its rate
+    limits, and retries the ones that fail because of them. Share one
+    instance between everything that calls the same model (e.g. the
+    :class:`chatbot.chatbot.ChatBot` of each worker thread, or the knowledge
+    base and response cache for the embedding model).
+
+    - Requests and tokens per minute are token buckets. A call waits until
+      both have room for it, the tokens are estimated by the caller and
+      corrected with the usage in the response.
+    - The number of calls at once adapts (AIMD): it grows by about one per
+      round of successful calls up to ``max_concurrency``, and halves on a
+      rate limit error, a timeout or when the API is overloaded.
+    - Rate limit, timeout, connection and server errors are retried up to
+      ``max_retries`` times, after exponential backoff with full jitter (or
+      the server's ``Retry-After``).
+    - With ``hedge_after``, a non-streaming call that hasn't returned after
+      that many seconds is sent again if there's quota and a slot to spare,
+      and the first response is used. This cuts the tail latency at the cost of some
+      duplicate requests.
+
+    :param requests_per_minute: The request limit, defaults to None (no limit)
+    :type requests_per_minute: int, optional
+    :param tokens_per_minute: The token limit, defaults to None (no limit)
+    :type tokens_per_minute: int, optional
+    :param max_concurrency: The most calls at once, defaults to 32
+    :type max_concurrency: int, optional
+    :param min_concurrency: The fewest calls at once after backing off,
+        defaults to 1
+    :type min_concurrency: int, optional
+    :param max_retries: How many times a failed call is retried, defaults
+        to 5
+    :type max_retries: int, optional
+    :param base_delay: The backoff before the first retry, in seconds,
+        defaults to 0.5
+    :type base_delay: float, optional
+    :param max_delay: The longest backoff, in seconds, defaults to 30
+    :type max_delay: float, optional
+    :param hedge_after: Send a second request for calls slower than this, in
+        seconds, defaults to None (no hedging)
+    :type hedge_after: float, optional
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: int = None,
+            tokens_per_minute: int = None,
+            max_concurrency: int = 32,
+            min_concurrency: int = 1,
+            max_retries: int = 5,
+            base_delay: float = 0.5,
+            max_delay: float = 30.0,
+            hedge_after: float = None):
+        self.requests = None
+        if requests_per_minute:
+            self.requests = _TokenBucket(requests_per_minute)
+        self.tokens = None
+        if tokens_per_minute:
+            self.tokens = _TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        # Futures of the async callers waiting for a slot, and their loops
+        self._async_waiters = []
+        self._executor = None
+        self.retries = 0
+        self.hedges = 0
+
+    def call(self, create, tokens: int = 0, **kwargs):
+        """Call an OpenAI API method (e.g. ``openai.ChatCompletion.create``)
+        once the limits allow it, retrying it if it fails because of them.
+
+        :param create: The API method
+        :type create: Callable
+        :param tokens: The estimated number of tokens of the call, prompt and
+            completion, defaults to 0
+        :type tokens: int, optional
+        :return: What the API method returns
+        """
+        attempt = 0
+        while True:
+            time.sleep(self._reserve(tokens))
+            with self._slot_free:
+                while not self._try_acquire():
+                    self._slot_free.wait()
+            try:
+                if self.hedge_after and not kwargs.get("stream"):
+                    response = self._hedged_call(create, tokens, kwargs)
+                else:
+                    response = create(**kwargs)
+            except BaseException as e:
+                if not _is_retryable(e):
+                    self._release(success=False, error=e)
+                    raise
+                self._release(success=False, error=e)
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt, e))
+                attempt += 1
+                continue
+            self._release(success=True)
+            self._correct_tokens(tokens, response)
+            return response
+
+    async def acall(self, create, tokens: int = 0, **kwargs):
+        """Async version of :meth:`call`, for methods like
+        ``openai.ChatCompletion.acreate``.
+
+        :param create: The async API method
+        :type create: Callable
+        :param tokens: The estimated number of tokens of the call, defaults
+            to 0
+        :type tokens: int, optional
+        :return: What the API method returns
+        """
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(tokens))
+            await self._aacquire()
+            try:
+                if self.hedge_after and not kwargs.get("stream"):
+                    response = await self._ahedged_call(create, tokens, kwargs)
+                else:
+                    response = await create(**kwargs)
+            except BaseException as e:
+                if not _is_retryable(e):
+                    self._release(success=False, error=e)
+                    raise
+                self._release(success=False, error=e)
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+                continue
+            self._release(success=True)
+            self._correct_tokens(tokens, response)
+            return response
+
+    def stats(self) -> dict:
+        """Returns the current concurrency limit and the retry and hedge
+        counters.
+
+        :return: The limiter's state
+        :rtype: dict
+        """
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "retries": self.retries,
+            "hedges": self.hedges,
+        }
+
+    def _reserve(self, tokens: int) -> float:
+        """ Reserve a request and the tokens, returns how long to wait for
+        them. Not meant to be called directly."""
+        with self._lock:
+            delay = 0.0
+            if self.requests:
+                delay = self.requests.reserve(1)
+            if self.tokens and tokens:
+                delay = max(delay, self.tokens.reserve(tokens))
+            return delay
+
+    def _try_acquire(self) -> bool:
+        """ Take a concurrency slot if there's one, the lock must be held.
+        Not meant to be called directly."""
+        if self.in_flight < max(self.min_concurrency, int(self.concurrency)):
+            self.in_flight += 1
+            return True
+        return False
+
+    async def _aacquire(self):
+        """ Wait for a concurrency slot without blocking the event loop. Not
+        meant to be called directly."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def _release(self, success: bool, error: BaseException = None):
+        """ Free a slot and adapt the concurrency: add about one slot per
+        round of successful calls, halve it when the API is overloaded, other
+        errors leave it as is. Not meant to be called directly."""
+        with self._lock:
+            self.in_flight -= 1
+            if success:
+                self.concurrency = min(
+                    self.max_concurrency,
+                    self.concurrency + 1 / max(self.concurrency, 1))
+            elif isinstance(error, _OVERLOADED):
+                self.concurrency = max(
+                    self.min_concurrency, self.concurrency / 2)
+            # Wake everyone up, whoever gets there first takes the slot
+            self._slot_free.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        """ How long to wait before retrying, the server's Retry-After if it
+        sent one, otherwise exponential backoff with full jitter. Not meant
+        to be called directly."""
+        with self._lock:
+            self.retries += 1
+        instrumentation.record_retry()
+        headers = getattr(error, "headers", None) or {}
+        try:
+            return min(self.max_delay, float(headers["retry-after"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _can_hedge(self, tokens: int) -> bool:
+        """ Only hedge with quota that's available right now. Not meant to
+        be called directly."""
+        with self._lock:
+            if self.requests and not self.requests.try_take(1):
+                return False
+            if self.tokens and tokens and not self.tokens.try_take(tokens):
+                if self.requests:
+                    self.requests.refund(1)
+                return False
+            self.hedges += 1
+            return True
+
+    def _acquire_hedge(self, tokens: int) -> bool:
+        """ Take a concurrency slot and the quota for a hedge, only if both
+        are available right now. Not meant to be called directly."""
+        with self._lock:
+            if not self._try_acquire():
+                return False
+        if not self._can_hedge(tokens):
+            # Give the slot back, no call was made to adapt the limit to
+            self._release(success=False)
+            return False
+        return True
+
+    def _release_hedge(self, hedge):
+        """ Free the slot of a finished hedge, adapting the concurrency to
+        its outcome like any other call. Not meant to be called directly."""
+        error = hedge.exception()
+        self._release(success=error is None, error=error)
+
+    def _hedged_call(self, create, tokens: int, kwargs: dict):
+        """ Send the call, and again if it's slow, returns the first
+        response. The slower call can't be cancelled, it's left to finish in
+        the background. Not meant to be called directly."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=2 * self.max_concurrency,
+                thread_name_prefix="hedge")
+        # Each call runs in a copy of the caller's context, so what it
+        # records goes to the caller's request
+        calls = [self._executor.submit(
+            contextvars.copy_context().run, create, **kwargs)]
+        done, _ = wait(calls, timeout=self.hedge_after)
+        if not done and self._acquire_hedge(tokens):
+            hedge = self._executor.submit(
+                contextvars.copy_context().run, create, **kwargs)
+            # The hedge holds its own slot until it's done, even if it's left
+            # to finish in the background
+            hedge.add_done_callback(self._release_hedge)
+            calls.append(hedge)
+        done, _ = wait(calls, return_when=FIRST_COMPLETED)
+        # Prefer a successful response if both are done
+        for call in done:
+            if call.exception() is None:
+                return call.result()
+        return done.pop().result()
+
+    async def _ahedged_call(self, create, tokens: int, kwargs: dict):
+        """ Async version of `_hedged_call`, the slower call is cancelled.
+        Not meant to be called directly."""
+        calls = [asyncio.ensure_future(create(**kwargs))]
+        try:
+            done, _ = await asyncio.wait(calls, timeout=self.hedge_after)
+            if not done and self._can_hedge(tokens):
+                calls.append(asyncio.ensure_future(create(**kwargs)))
+            done, _ = await asyncio.wait(
+                calls, return_when=asyncio.FIRST_COMPLETED)
+            for call in done:
+                if call.exception() is None:
+                    return call.result()
+            return done.pop().result()
+        finally:
+            for call in calls:
+                call.cancel()
+
+    def _correct_tokens(self, tokens: int, response):
+        """ Give back the tokens that were estimated but not used, once the
+        response says how many were. Not meant to be called directly."""
+        if not self.tokens or not tokens:
+            return
+        try:
+            used = response["usage"]["total_tokens"]
+        except (KeyError, TypeError):
+            return
+        with self._lock:
+            self.tokens.refund(tokens - used)
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """ Whether a failed call is worth retrying, server errors are too."""
+    if isinstance(error, _RETRYABLE):
+        return True
+    return (isinstance(error, openai.error.APIError)
+            and (error.http_status or 0) >= 500)
+
+
+def _wake(waiter: asyncio.Future):
+    """ Wake an async caller waiting for a slot, unless it gave up."""
+    if not waiter.done():
+        waiter.set_result(None)
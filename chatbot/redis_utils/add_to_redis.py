@@ -1,35 +1,342 @@
+import argparse
+import hashlib
+import itertools
+import json
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from xml.etree import ElementTree
 
 from bs4 import BeautifulSoup
 import numpy as np
 import openai
 import redis
 
+from chatbot.chatbot import write_knowledge_base_local
+from chatbot.rate_limiter import RateLimiter
+from chatbot.utils import (
+    chunk_text,
+    compact_vector,
+    embedding_to_bytes,
+    get_encoding,
+)
+
 
 BLOG_URL = r"https://heathhenley.github.io"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Number of posts fetched at the same time
+FETCH_WORKERS = 8
+# Where the post urls are listed, tried in order before walking the pages.
+# Feeds often only list the latest posts, so the sitemap comes first.
+FEED_PATHS = ("sitemap.xml", "index.xml", "feed.xml", "rss.xml")
+# Progress of the crawl, so an interrupted one resumes where it stopped
+CHECKPOINT_PATH = "crawl_checkpoint.jsonl"
+# Number of posts checked and written per Redis round trip
+BATCH_SIZE = 50
+# Number of chunks embedded per API call
+EMBEDDING_BATCH_SIZE = 500
+# Size of the chunks the posts are split into, in tokens
+CHUNK_TOKENS = 300
+CHUNK_OVERLAP_TOKENS = 50
+# Retries the embedding calls that are rate limited, so a large crawl doesn't
+# fail halfway through
+RATE_LIMITER = RateLimiter(max_concurrency=1)
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def add_text_to_redis(db, text, url):
-    """ Add text, url, and embedding to redis db."""
-    # Get the embedding for the text
-    embedding = openai.Embedding.create(
-        input=text,
-        model="text-embedding-ada-002"
-    )
-    vector = embedding["data"][0]["embedding"]
-    vector = np.array(vector).astype(np.float32).tobytes()
-    post_hash = {
-        "url": url,
-        "content": text,
-        "embedding": vector
-    }
-    db.hset(name=f"blog:{url}", mapping=post_hash)
+
+def make_session(pool_size: int = FETCH_WORKERS) -> requests.Session:
+    """ A session that keeps a connection open for each fetch worker, so
+    the requests reuse them instead of connecting every time."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = make_session()
+
+
+def content_hash(text: str, vector_format: str = "") -> str:
+    """ Hash of the post text, used to skip posts that haven't changed. The
+    format of the stored vectors is included, so changing it re-embeds the
+    posts."""
+    return hashlib.sha256((vector_format + text).encode("utf-8")).hexdigest()
+
+
+def vector_format(vector_type: str = "FLOAT32", dim: int = None) -> str:
+    """ The format of the vectors stored in Redis, empty for the default."""
+    if vector_type == "FLOAT32" and not dim:
+        return ""
+    return f"{vector_type}:{dim or ''}:"
+
+
+def embed_texts(texts):
+    """ Get the embeddings for the texts, EMBEDDING_BATCH_SIZE at a time."""
+    vectors = []
+    for batch in batched(texts, EMBEDDING_BATCH_SIZE):
+        # base64 is the raw float32 bytes, no need to parse lists of floats
+        embedding = RATE_LIMITER.call(
+            openai.Embedding.create,
+            input=batch, model=EMBEDDING_MODEL, encoding_format="base64")
+        # The results aren't guaranteed to be in the same order as the inputs
+        for data in sorted(embedding["data"], key=lambda d: d["index"]):
+            vectors.append(embedding_to_bytes(data["embedding"]))
+    return vectors
+
+
+def split_posts(posts):
+    """ Split (url, text, ...) posts into overlapping chunks, returns a list
+    of (url, text, chunks, ...) tuples."""
+    encoding = get_encoding(EMBEDDING_MODEL)
+    return [
+        (url, text, chunk_text(
+            text, encoding, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS), *rest)
+        for url, text, *rest in posts
+    ]
+
+
+def add_texts_to_redis(db, posts, vector_type="FLOAT32", dim=None):
+    """ Split a batch of (url, text, old_num_chunks, validators) posts into
+    overlapping chunks, and add each chunk's text, parent url and embedding
+    to the redis db, using as few embedding requests as possible and one
+    pipelined write. Chunks left over from an older, longer version of a post
+    are deleted. The embeddings are stored as vector_type, truncated to dim
+    dimensions if given, which must match the index (see create_index.py).
+    The validators (ETag, Last-Modified) are stored with the first chunk, for
+    the next crawl's conditional requests."""
+    chunks = split_posts(posts)
+    vectors = iter(embed_texts(
+        [chunk for _, _, post_chunks, *_ in chunks for chunk in post_chunks]))
+    pipe = db.pipeline(transaction=False)
+    for url, text, post_chunks, old_chunks, *rest in chunks:
+        # Posts used to be stored whole, under the url
+        pipe.delete(f"blog:{url}")
+        for i, chunk in enumerate(post_chunks):
+            chunk_hash = {
+                "url": url,
+                "chunk": i,
+                "content": chunk,
+                "embedding": compact_vector(next(vectors), vector_type, dim)
+            }
+            if i == 0:
+                # The first chunk keeps track of the whole post
+                chunk_hash["content_hash"] = content_hash(
+                    text, vector_format(vector_type, dim))
+                chunk_hash["num_chunks"] = len(post_chunks)
+                if rest and rest[0]:
+                    chunk_hash.update(rest[0])
+                    chunk_hash["vector_format"] = vector_format(
+                        vector_type, dim)
+            pipe.hset(name=f"blog:{url}#{i}", mapping=chunk_hash)
+        for i in range(len(post_chunks), old_chunks):
+            pipe.delete(f"blog:{url}#{i}")
+    pipe.execute()
+
+
+def changed_posts(db, posts, vector_format=""):
+    """ Return the (url, text, ...) posts whose text is not already in the
+    db (in the same vector format), as (url, text, old_num_chunks, ...),
+    checking the stored hashes of the whole batch in one round trip."""
+    pipe = db.pipeline(transaction=False)
+    for url, *_ in posts:
+        pipe.hmget(f"blog:{url}#0", "content_hash", "num_chunks")
+    stored = pipe.execute()
+    return [
+        (url, text, int(old_chunks or 0), *rest)
+        for (url, text, *rest), (old_hash, old_chunks) in zip(posts, stored)
+        if old_hash != content_hash(text, vector_format)
+    ]
+
+
+def stored_validators(db, urls, vector_format=""):
+    """ The ETag and Last-Modified stored with each post by the last crawl,
+    as {url: validators}, fetched in one round trip. Posts stored in another
+    vector format have none, so they're fetched again and re-embedded."""
+    pipe = db.pipeline(transaction=False)
+    for url in urls:
+        pipe.hmget(
+            f"blog:{url}#0", "etag", "last_modified", "vector_format")
+    validators = {}
+    for url, (etag, last_modified, stored_format) in zip(
+            urls, pipe.execute()):
+        if stored_format == vector_format and (etag or last_modified):
+            validators[url] = {
+                key: value
+                for key, value in (
+                    ("etag", etag), ("last_modified", last_modified))
+                if value
+            }
+    return validators
+
+
+def save_validators(db, posts, vector_format=""):
+    """ Store the validators of (url, text, validators) posts that are
+    already in the db, so the next crawl can ask if they changed."""
+    pipe = db.pipeline(transaction=False)
+    for url, _, validators in posts:
+        if validators:
+            pipe.hset(
+                f"blog:{url}#0",
+                mapping={**validators, "vector_format": vector_format})
+    pipe.execute()
+
+
+def read_local(path):
+    """ Read the chunks already in a local knowledge base, grouped by url, as
+    {url: (content_hash, [(document, embedding), ...])}. The full float32
+    embeddings are used if the knowledge base is compact."""
+    existing = {}
+    try:
+        embeddings_path = os.path.join(path, "embeddings_float32.npy")
+        if not os.path.exists(embeddings_path):
+            embeddings_path = os.path.join(path, "embeddings.npy")
+        embeddings = np.load(embeddings_path)
+        with open(os.path.join(path, "documents.jsonl"), encoding="utf-8") as f:
+            documents = [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return existing
+    for document, embedding in zip(documents, embeddings):
+        _, chunks = existing.setdefault(
+            document["url"], (document["content_hash"], []))
+        chunks.append((document, embedding.tobytes()))
+    return existing
+
+
+def read_local_validators(path):
+    """ The ETag and Last-Modified stored with each post of a local
+    knowledge base by the last crawl, as {url: validators}."""
+    validators = {}
+    try:
+        with open(os.path.join(path, "documents.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                document = json.loads(line)
+                if document.get("validators"):
+                    validators[document["url"]] = document["validators"]
+    except FileNotFoundError:
+        pass
+    return validators
+
+
+def write_local(path, posts, **compact_kwargs):
+    """ Write the (url, text) or (url, text, validators) posts to a local
+    knowledge base (see chatbot.chatbot.KnowledgeBaseLocal), reusing the
+    stored embeddings of posts that haven't changed. A text of None means the
+    post wasn't downloaded (it wasn't modified, or it couldn't be fetched),
+    so its stored chunks are kept. The validators are stored with the
+    first chunk of each post. The keyword arguments (dtype, dim, pca) are
+    passed to write_knowledge_base_local. Returns the number of posts
+    embedded."""
+    existing = read_local(path)
+    documents, embeddings, changed = [], [], []
+    for url, text, *rest in posts:
+        validators = rest[0] if rest else None
+        old_hash, chunks = existing.get(url, (None, []))
+        if chunks and (text is None or old_hash == content_hash(text)):
+            for document, embedding in chunks:
+                if document["chunk"] == 0:
+                    document = _with_validators(document, validators)
+                documents.append(document)
+                embeddings.append(embedding)
+        elif text is not None:
+            changed.append((url, text, validators))
+        else:
+            print(f"{url} wasn't downloaded, and it isn't stored")
+    chunks = split_posts(changed)
+    vectors = embed_texts(
+        [chunk for _, _, post_chunks, _ in chunks for chunk in post_chunks])
+    embeddings.extend(vectors)
+    for url, text, post_chunks, validators in chunks:
+        for i, chunk in enumerate(post_chunks):
+            document = {
+                "url": url,
+                "chunk": i,
+                "content": chunk,
+                "content_hash": content_hash(text),
+            }
+            if i == 0:
+                document = _with_validators(document, validators)
+            documents.append(document)
+    write_knowledge_base_local(path, documents, embeddings, **compact_kwargs)
+    return len(changed)
+
+
+def _with_validators(document, validators):
+    """ The document with the post's latest validators, if there are any."""
+    if not validators:
+        return document
+    return {**document, "validators": validators}
+
+
+def discover_post_urls(
+        base_url: str, session: requests.Session = SESSION) -> list[str]:
+    """ Find the post urls in the blog's sitemap or feed, one request
+    instead of one per page, and only walk the pages if there's neither."""
+    for path in FEED_PATHS:
+        urls = feed_urls(f"{base_url}/{path}", session)
+        posts = [url for url in urls if "/posts/" in url]
+        if posts:
+            return list(dict.fromkeys(posts))
+    return blog_to_post_urls(base_url, session)
 
 
-def blog_to_post_urls(base_url: str) -> list[str]:
-    urls = []
+def feed_urls(
+        feed_url: str, session: requests.Session = SESSION,
+        nested: bool = True) -> list[str]:
+    """ The page urls in a sitemap (following a sitemap index), RSS or Atom
+    feed, empty if there isn't one at the url."""
+    try:
+        res = session.get(feed_url, timeout=10)
+        if res.status_code != 200:
+            return []
+        root = ElementTree.fromstring(res.content)
+    except (requests.RequestException, ElementTree.ParseError) as e:
+        print(e)
+        return []
+    kind = _local_name(root.tag)
+    if kind == "sitemapindex" and nested:
+        return [
+            url
+            for loc in _children(root, "sitemap", "loc")
+            for url in feed_urls(loc.text.strip(), session, nested=False)
+        ]
+    if kind == "urlset":
+        return [loc.text.strip() for loc in _children(root, "url", "loc")]
+    if kind == "rss":
+        return [link.text.strip() for link in _children(root, "item", "link")]
+    if kind == "feed":
+        return [
+            urljoin(feed_url, link.get("href"))
+            for link in _children(root, "entry", "link")
+            if link.get("rel", "alternate") == "alternate"
+        ]
+    return []
+
+
+def _local_name(tag: str) -> str:
+    """ The tag without its XML namespace."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(root, parent: str, child: str):
+    """ The child elements of each parent element, at any depth, whatever
+    their namespace."""
+    for element in root.iter():
+        if _local_name(element.tag) != parent:
+            continue
+        for sub in element:
+            if _local_name(sub.tag) == child and (
+                    sub.text and sub.text.strip() or sub.get("href")):
+                yield sub
+
+
+def blog_to_post_urls(
+        base_url: str, session: requests.Session = SESSION) -> list[str]:
+    # dict keeps the order the posts were found in, and is O(1) to check
+    urls = {}
     page = 0
     while True:
         if page > 0:
@@ -38,38 +345,233 @@ def blog_to_post_urls(base_url: str) -> list[str]:
             blog_page = base_url
         res = None
         try:
-            res = requests.get(blog_page, timeout=10) 
+            res = session.get(blog_page, timeout=10)
             if res.status_code != 200:
                 break
         except Exception as e:
             print(e)
             break
-        page += 1 
+        page += 1
         soup = BeautifulSoup(res.text, 'html.parser')
         for a in soup.find_all("a"):
-            if "/posts/" in a['href'] and a['href'] not in urls:
-                urls.append(a['href'])
-    return urls
+            if "/posts/" in a.get('href', ""):
+                urls[urljoin(blog_page, a['href'])] = None
+    return list(urls)
 
-def post_url_to_text(url: str) -> str:
-    res = None
+
+def fetch_post(
+        url: str, validators: dict = None,
+        session: requests.Session = SESSION):
+    """ Fetch a post, asking the server if it changed when there are
+    validators (ETag, Last-Modified) from the last crawl. Returns the text
+    and the post's latest validators, the text is None if it wasn't modified
+    and "" if it couldn't be fetched."""
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        res = requests.get(url, timeout=10)
-        if res.status_code != 200:
-            return ""
+        res = session.get(url, headers=headers, timeout=10)
     except Exception as e:
         print(e)
-        return ""
-    soup = BeautifulSoup(res.text, 'html.parser')
+        return "", {}
+    latest = {
+        key: res.headers.get(header, validators.get(key))
+        for key, header in (
+            ("etag", "ETag"), ("last_modified", "Last-Modified"))
+    }
+    latest = {key: value for key, value in latest.items() if value}
+    if res.status_code == 304:
+        return None, latest
+    if res.status_code != 200:
+        return "", {}
+    return post_html_to_text(res.text), latest
+
+
+def post_html_to_text(html: str) -> str:
+    soup = BeautifulSoup(html, 'html.parser')
     text = ""
     for p in soup.find_all("section", class_="p-article__body"):
         text += p.text
     return text
 
 
+def post_url_to_text(url: str, session: requests.Session = SESSION) -> str:
+    return fetch_post(url, session=session)[0] or ""
+
+
+def fetch_posts(
+        urls, validators=None, max_workers=FETCH_WORKERS,
+        session: requests.Session = SESSION):
+    """ Fetch the posts concurrently with a bounded pool of threads, over
+    the session's pooled connections, yields (url, text, validators) in the
+    same order as the urls. Posts with validators from the last crawl are
+    only downloaded if they changed, otherwise their text is None. Posts that
+    couldn't be fetched or have no text also have a text of None, with the
+    validators of the last crawl, so what's stored for them is kept."""
+    validators = validators or {}
+
+    def fetch(url):
+        return fetch_post(url, validators.get(url), session)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for url, (text, latest) in zip(urls, pool.map(fetch, urls)):
+            if text == "":
+                yield url, None, validators.get(url, {})
+            else:
+                yield url, text, latest
+
+
+class CrawlCheckpoint:
+    """ The progress of a crawl, in a JSONL file: the first line has the
+    post urls that were found, then each post that was done is appended as
+    it's done. An interrupted crawl of the same blog into the same knowledge
+    base, with the same vector format, resumes from it, skipping the
+    discovery and the posts that were done. The file is removed when the
+    crawl finishes."""
+
+    def __init__(self, path, base_url, target, vector_format=""):
+        self.path = path
+        self.key = {
+            "base_url": base_url,
+            "target": target,
+            "vector_format": vector_format,
+        }
+        self.urls = None
+        self.posts = {}
+        self._file = None
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        """ Read the checkpoint of an interrupted crawl, if it's for the
+        same blog and knowledge base."""
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            return
+        if header.get("key") != self.key:
+            return
+        self.urls = header["urls"]
+        for line in lines[1:]:
+            try:
+                url, text, validators = json.loads(line)
+            except (json.JSONDecodeError, ValueError):
+                # The last line of a crawl that was killed mid-write
+                continue
+            self.posts[url] = (url, text, validators)
+
+    def start(self, urls):
+        """ Save the urls to crawl, and the posts already done if this
+        resumes a crawl, to a new file."""
+        self.urls = urls
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"key": self.key, "urls": urls}) + "\n")
+            for post in self.posts.values():
+                f.write(json.dumps(post) + "\n")
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def remaining(self):
+        """ The urls that aren't done yet."""
+        return [url for url in self.urls if url not in self.posts]
+
+    def record(self, posts):
+        """ Save (url, text, validators) posts as done."""
+        for post in posts:
+            self.posts[post[0]] = tuple(post)
+            if self._file:
+                self._file.write(json.dumps(post) + "\n")
+        if self._file:
+            self._file.flush()
+
+    def finish(self):
+        """ The crawl is done, remove the checkpoint."""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def batched(iterable, size):
+    """ Split an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description="Crawl the blog and add the posts to the knowledge base.")
+    parser.add_argument(
+        "--local",
+        metavar="PATH",
+        help="write a local knowledge base to this directory instead of Redis")
+    parser.add_argument(
+        "--vector-type",
+        choices=["FLOAT32", "FLOAT16"],
+        default="FLOAT32",
+        help="type of the vectors stored in Redis, must match the index")
+    parser.add_argument(
+        "--dim",
+        type=int,
+        help="number of dimensions to keep, must match the index")
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16", "int8"],
+        default="float32",
+        help="type of the local embedding matrix")
+    parser.add_argument(
+        "--pca",
+        action="store_true",
+        help="reduce the local embeddings to --dim with PCA, not truncation")
+    parser.add_argument(
+        "--checkpoint",
+        default=CHECKPOINT_PATH,
+        help="file to save the crawl's progress to, an interrupted crawl "
+             "resumes from it (empty to not save it)")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="download every post again, ignoring the ETags and "
+             "Last-Modified dates of the last crawl and the checkpoint")
+    args = parser.parse_args()
+
+    target = os.path.abspath(args.local) if args.local else "redis"
+    if args.full and args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    # The posts done in Redis were stored in this format, a local knowledge
+    # base is compacted from the full embeddings every time it's written
+    stored_format = vector_format(args.vector_type, args.dim)
+    checkpoint = CrawlCheckpoint(
+        args.checkpoint, BLOG_URL, target,
+        "" if args.local else stored_format)
+
+    if args.local:
+        print("Crawling my blog...")
+        urls = checkpoint.urls or discover_post_urls(BLOG_URL)
+        checkpoint.start(urls)
+        validators = {} if args.full else read_local_validators(args.local)
+        for post in fetch_posts(checkpoint.remaining(), validators):
+            checkpoint.record([post])
+        posts = [
+            checkpoint.posts[url] for url in urls if url in checkpoint.posts]
+        added = write_local(
+            args.local, posts, dtype=args.dtype, dim=args.dim, pca=args.pca)
+        checkpoint.finish()
+        print(f"Added {added} posts, {len(posts) - added} were unchanged")
+        return
+
     print("connecting to Redis...")
-    redis_client = redis.from_url(url=os.getenv("REDIS_URL", ""), 
+    redis_client = redis.from_url(url=os.getenv("REDIS_URL", ""),
         encoding='utf-8',
         decode_responses=True,
         socket_timeout=30.0)
@@ -79,11 +581,34 @@ def main():
     print("Connected to Redis")
 
     print("Crawling my blog...")
-    for url in blog_to_post_urls(BLOG_URL): 
-        text = post_url_to_text(url)
-        print(f"Parsing: {url}")
-        add_text_to_redis(redis_client, text, url)
+    urls = checkpoint.urls or discover_post_urls(BLOG_URL)
+    checkpoint.start(urls)
+    remaining = checkpoint.remaining()
+    validators = {}
+    if not args.full:
+        validators = stored_validators(redis_client, remaining, stored_format)
+    # Fetching, hashing and embedding are streamed, so a batch is written
+    # while the next posts are still downloading
+    added, skipped = 0, len(urls) - len(remaining)
+    for batch in batched(fetch_posts(remaining, validators), BATCH_SIZE):
+        # Posts the server says weren't modified aren't downloaded again
+        modified = [post for post in batch if post[1] is not None]
+        changed = changed_posts(redis_client, modified, stored_format)
+        skipped += len(batch) - len(changed)
+        if changed:
+            print(f"Embedding {len(changed)} new or updated posts")
+            add_texts_to_redis(
+                redis_client, changed, args.vector_type, args.dim)
+            added += len(changed)
+        changed_urls = {url for url, *_ in changed}
+        save_validators(
+            redis_client,
+            [post for post in modified if post[0] not in changed_urls],
+            stored_format)
+        checkpoint.record(batch)
+    checkpoint.finish()
+    print(f"Added {added} posts, {skipped} were unchanged")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,242 @@
+""" Report the memory saved, the recall lost and the search latency of each
+compact vector format.
+
+Loads the stored embeddings, from Redis (as written by add_to_redis.py, with
+the same --vector-type) or from a local knowledge base, holds some of them out
+as queries, and builds a local knowledge base in each format from the rest.
+The recall@k of each format is measured against an exact float32 search, with
+the latency of each local search. The memory saved is that of the loaded
+matrix, which isn't always the size on disk: float16 is converted to float32
+when it's loaded. The Redis formats (the FLOAT16 field, and truncated
+dimensions) are compared the same way, by searching exactly the vectors Redis
+would store; their latency depends on the index, measure it with
+tune_index.py. Run it from the root of the repo, for example:
+
+    python -m chatbot.redis_utils.compact_report --local ./kb --dim 512 256
+    python -m chatbot.redis_utils.compact_report --prefix blog: --json
+    python -m chatbot.redis_utils.compact_report --vector-type FLOAT16
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import redis
+
+from chatbot.chatbot import KnowledgeBaseLocal, write_knowledge_base_local
+from chatbot.redis_utils.tune_index import load_vectors
+from chatbot.utils import VECTOR_TYPES, compact_vector
+
+
+def load_local(path: str) -> np.ndarray:
+    """ Read the full float32 embeddings of a local knowledge base."""
+    embeddings_path = os.path.join(path, "embeddings_float32.npy")
+    if not os.path.exists(embeddings_path):
+        embeddings_path = os.path.join(path, "embeddings.npy")
+    matrix = np.load(embeddings_path)
+    if matrix.dtype != np.float32:
+        raise Exception(f"{embeddings_path} isn't float32, can't compare")
+    return matrix
+
+
+def formats(dims):
+    """ The local (dtype, dim, pca) formats to compare, full size first."""
+    yield "float32", None, False
+    yield "float16", None, False
+    yield "int8", None, False
+    for dim in dims:
+        yield "float32", dim, False
+        yield "float32", dim, True
+        yield "int8", dim, True
+
+
+def redis_formats(dims):
+    """ The (vector_type, dim) formats of the Redis vector field to compare,
+    Redis only truncates the dimensions."""
+    yield "FLOAT16", None
+    for dim in dims:
+        yield "FLOAT32", dim
+        yield "FLOAT16", dim
+
+
+def exact_top_k(corpus, queries, k):
+    """ The rows of the k most similar documents to each query."""
+    scores = queries @ corpus.T
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def recall(found, expected, k):
+    """ Recall@k of each query's results, averaged."""
+    return float(np.mean([
+        len(set(rows).intersection(exact)) / k
+        for rows, exact in zip(found, expected)
+    ]))
+
+
+def disk_bytes(path: str) -> int:
+    """ The size of the files loaded by KnowledgeBaseLocal to search."""
+    return sum(
+        os.path.getsize(os.path.join(path, name))
+        for name in ("embeddings.npy", "scales.npy", "projection.npy")
+        if os.path.exists(os.path.join(path, name)))
+
+
+def memory_bytes(knowledge_base: KnowledgeBaseLocal) -> int:
+    """ The size of the arrays KnowledgeBaseLocal searches, once loaded."""
+    return sum(
+        array.nbytes
+        for array in (
+            knowledge_base.embeddings,
+            knowledge_base.scales,
+            knowledge_base.projection)
+        if array is not None)
+
+
+def evaluate(corpus, queries, k, dtype, dim, pca):
+    """ Recall@k of one local format against exact search, its size in
+    memory and on disk, and the latency of its searches."""
+    exact = exact_top_k(corpus, queries, k)
+    with tempfile.TemporaryDirectory() as path:
+        write_knowledge_base_local(
+            path,
+            [{"content": ""}] * len(corpus),
+            [row.tobytes() for row in corpus],
+            dtype=dtype,
+            dim=dim,
+            pca=pca)
+        disk = disk_bytes(path)
+        knowledge_base = KnowledgeBaseLocal(path, api_key=None)
+        size = memory_bytes(knowledge_base)
+        # Load the pages once, so the first query isn't timed reading them
+        knowledge_base.warmup()
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results = knowledge_base.search(query.tobytes(), k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append([row for row, _ in results])
+    return {
+        "store": "local",
+        "dtype": dtype,
+        "dim": dim or corpus.shape[1],
+        "reduction": "pca" if pca and dim else "truncate" if dim else None,
+        "bytes": size,
+        "bytes_per_vector": size / len(corpus),
+        "disk_bytes": disk,
+        "recall_at_k": recall(found, exact, k),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def evaluate_redis(corpus, queries, k, vector_type, dim):
+    """ Recall@k of one format of the Redis vector field against exact
+    search, and the size of the stored vectors, which Redis keeps in memory.
+    The documents and queries are compacted the way add_to_redis.py and
+    KnowledgeBaseRedis do it, then searched exactly, as a FLAT index
+    would."""
+    exact = exact_top_k(corpus, queries, k)
+
+    def compact(matrix):
+        compacted = np.array([
+            np.frombuffer(
+                compact_vector(row.tobytes(), vector_type, dim),
+                dtype=VECTOR_TYPES[vector_type])
+            for row in matrix
+        ], dtype=np.float32)
+        # COSINE distance, the stored vectors aren't renormalized
+        return compacted / np.linalg.norm(compacted, axis=1, keepdims=True)
+
+    found = exact_top_k(compact(corpus), compact(queries), k)
+    dims = dim or corpus.shape[1]
+    bytes_per_vector = dims * np.dtype(VECTOR_TYPES[vector_type]).itemsize
+    return {
+        "store": "redis",
+        "dtype": vector_type,
+        "dim": dims,
+        "reduction": "truncate" if dim else None,
+        "bytes": bytes_per_vector * len(corpus),
+        "bytes_per_vector": bytes_per_vector,
+        "disk_bytes": None,
+        "recall_at_k": recall(found, exact, k),
+        "p50_ms": None,
+        "p99_ms": None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the size and recall of compact vector formats.")
+    parser.add_argument(
+        "--local", metavar="PATH", help="read a local knowledge base")
+    parser.add_argument(
+        "--prefix", default="blog:", help="the Redis key prefix to read")
+    parser.add_argument(
+        "--vector-type",
+        choices=["FLOAT32", "FLOAT16"],
+        default="FLOAT32",
+        help="type of the vectors stored in Redis, as given to add_to_redis")
+    parser.add_argument(
+        "--dim", type=int, nargs="*", default=[768, 256],
+        help="the reduced dimensions to compare")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    if args.local:
+        matrix = load_local(args.local)
+    else:
+        # The embeddings are binary, so responses must not be decoded
+        r = redis.from_url(url=os.getenv("REDIS_URL", ""))
+        _, matrix = load_vectors(r, args.prefix, args.vector_type)
+    matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    # Hold the queries out, a document is always its own nearest neighbor
+    rng = np.random.default_rng(0)
+    rows = rng.permutation(len(matrix))
+    num_queries = min(args.queries, len(matrix) // 2)
+    queries, corpus = matrix[rows[:num_queries]], matrix[rows[num_queries:]]
+    if len(corpus) < args.k:
+        raise Exception(f"Only found {len(matrix)} embeddings")
+
+    dims = [d for d in args.dim if d < matrix.shape[1]]
+    results = [
+        evaluate(corpus, queries, args.k, dtype, dim, pca)
+        for dtype, dim, pca in formats(dims)
+    ]
+    results += [
+        evaluate_redis(corpus, queries, args.k, vector_type, dim)
+        for vector_type, dim in redis_formats(dims)
+    ]
+    full = results[0]["bytes"]
+    for result in results:
+        result["saved"] = 1 - result["bytes"] / full
+        result["recall_lost"] = results[0]["recall_at_k"] - result["recall_at_k"]
+
+    if args.json:
+        print(json.dumps({"docs": len(corpus), "k": args.k,
+                          "results": results}, indent=2))
+        return
+    print(f"{len(corpus)} documents, {num_queries} queries, k={args.k}")
+    print(f"{'format':>30} {'mem/vec':>8} {'disk/vec':>8} {'saved':>7} "
+          f"{'recall@k':>9} {'lost':>7} {'p50 ms':>8}")
+    for result in results:
+        name = f"{result['store']} {result['dtype']} x{result['dim']}"
+        if result["reduction"]:
+            name += f" ({result['reduction']})"
+        latency = "-"
+        if result["p50_ms"] is not None:
+            latency = f"{result['p50_ms']:.2f}"
+        disk = "-"
+        if result["disk_bytes"] is not None:
+            disk = f"{result['disk_bytes'] / len(corpus):.0f}"
+        print(f"{name:>30} {result['bytes_per_vector']:>8.0f} {disk:>8} "
+              f"{result['saved']:>7.1%} {result['recall_at_k']:>9.3f} "
+              f"{result['recall_lost']:>7.3f} {latency:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,97 @@
+import argparse
 import os
 import redis
 from redis.commands.search.field import VectorField, TextField
-from redis.commands.search.query import Query
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
- 
-r = redis.from_url(url=os.getenv("REDIS_URL", ""),
-    encoding='utf-8',
-    decode_responses=True)
- 
-SCHEMA = [
-    TextField("url"),
-    VectorField("embedding", "HNSW", {"TYPE": "FLOAT32", "DIM": 1536, "DISTANCE_METRIC": "COSINE"}),
-]
- 
-# Create the index
-try:
-    r.ft("posts").create_index(fields=SCHEMA, definition=IndexDefinition(prefix=["blog:"], index_type=IndexType.HASH))
-except Exception as e:
-    print(e)
-    print("Index already exists")
\ No newline at end of file
+
+
+def index_schema(
+        dim: int = 1536,
+        algorithm: str = "HNSW",
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_runtime: int = 10,
+        distance_metric: str = "COSINE",
+        vector_type: str = "FLOAT32") -> list:
+    """ Returns the fields for a knowledge base index. FLAT is an exact
+    (brute force) search, HNSW is approximate and much faster for large
+    corpora: M is the number of links per node and EF_CONSTRUCTION the size
+    of the candidate list used when building the graph (higher means better
+    recall but a bigger, slower to build index), and EF_RUNTIME is the
+    default size of the candidate list at query time. FLOAT16 vectors take
+    half the memory of FLOAT32 ones, for a small loss of recall."""
+    attributes = {
+        "TYPE": vector_type, "DIM": dim, "DISTANCE_METRIC": distance_metric}
+    if algorithm == "HNSW":
+        attributes.update({
+            "M": m,
+            "EF_CONSTRUCTION": ef_construction,
+            "EF_RUNTIME": ef_runtime,
+        })
+    elif algorithm != "FLAT":
+        raise ValueError(f"Unknown vector index algorithm: {algorithm}")
+    return [
+        TextField("url"),
+        VectorField("embedding", algorithm, attributes),
+    ]
+
+
+def create_index(
+        redis_client,
+        index_name: str = "posts",
+        prefix: str = "blog:",
+        **schema_kwargs):
+    """ Create a vector index over the hashes with the prefix, the keyword
+    arguments are passed to index_schema. Several indexes (e.g. with
+    different HNSW parameters) can be created over the same prefix."""
+    redis_client.ft(index_name).create_index(
+        fields=index_schema(**schema_kwargs),
+        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH))
+
+
+def add_index_arguments(parser):
+    """ Add the index configuration options to an argument parser."""
+    parser.add_argument("--index-name", default="posts")
+    parser.add_argument("--prefix", default="blog:")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument(
+        "--vector-type", choices=["FLOAT32", "FLOAT16"], default="FLOAT32")
+    parser.add_argument("--algorithm", choices=["HNSW", "FLAT"], default="HNSW")
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-runtime", type=int, default=10)
+
+
+def schema_kwargs_from_args(args) -> dict:
+    """ The index_schema keyword arguments from parsed arguments."""
+    return {
+        "dim": args.dim,
+        "algorithm": args.algorithm,
+        "m": args.m,
+        "ef_construction": args.ef_construction,
+        "ef_runtime": args.ef_runtime,
+        "vector_type": args.vector_type,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create the vector index for the knowledge base.")
+    add_index_arguments(parser)
+    args = parser.parse_args()
+
+    r = redis.from_url(url=os.getenv("REDIS_URL", ""),
+        encoding='utf-8',
+        decode_responses=True)
+
+    # Create the index
+    try:
+        create_index(
+            r, args.index_name, args.prefix, **schema_kwargs_from_args(args))
+    except Exception as e:
+        print(e)
+        print("Index already exists")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+""" Measure the recall and latency of a Redis vector index configuration.
+
+Builds a temporary index with the given parameters over the documents that
+are already stored (e.g. by add_to_redis), then runs a sample of the stored
+vectors as queries and compares the results with an exact brute force search,
+for each EF_RUNTIME value. Each query's own document is left out of both the
+exact and the found results, so it can't inflate the recall. The temporary
+index is dropped afterwards, the documents are kept. From the repo root, for
+example:
+
+    python -m chatbot.redis_utils.create_index ...
+    python -m chatbot.redis_utils.tune_index --m 32 --ef-construction 400 \
+        --ef-runtime-values 10 50
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.query import Query
+
+from chatbot.redis_utils.create_index import (
+    add_index_arguments,
+    create_index,
+    schema_kwargs_from_args,
+)
+from chatbot.utils import VECTOR_TYPES
+
+
+def load_vectors(redis_client, prefix: str, vector_type: str = "FLOAT32"):
+    """ Read every stored embedding under the prefix, returns the keys and
+    the normalized vectors as a float32 matrix."""
+    keys = list(redis_client.scan_iter(match=f"{prefix}*", count=1000))
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hget(key, "embedding")
+    vectors = pipe.execute()
+    keys = [k.decode() for k, v in zip(keys, vectors) if v]
+    matrix = np.array(
+        [np.frombuffer(v, dtype=VECTOR_TYPES[vector_type])
+         for v in vectors if v], dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return keys, matrix
+
+
+def wait_for_indexing(redis_client, index_name: str, timeout: float = 600):
+    """ Wait until the index has finished indexing the existing documents."""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        info = redis_client.ft(index_name).info()
+        percent = info.get("percent_indexed", info.get(b"percent_indexed", 1))
+        if float(percent) >= 1:
+            return
+        time.sleep(0.5)
+    raise TimeoutError(f"Index {index_name} is still indexing")
+
+
+def knn_search(redis_client, index_name, vector, k, ef_runtime=None):
+    """ Run one KNN query, returns the keys of the results."""
+    ef = f" EF_RUNTIME {ef_runtime}" if ef_runtime else ""
+    query = (
+        Query(f"*=>[KNN {k} @embedding $vector{ef} AS vector_score]")
+        .return_fields("vector_score")
+        .sort_by("vector_score")
+        .paging(0, k)
+        .dialect(2))
+    results = redis_client.ft(index_name).search(
+        query, query_params={"vector": vector})
+    return [
+        doc.id.decode() if isinstance(doc.id, bytes) else doc.id
+        for doc in results.docs
+    ]
+
+
+def evaluate(
+        redis_client, index_name, keys, matrix, queries, k, ef_runtime,
+        vector_type="FLOAT32"):
+    """ Recall@k against exact search, and the query latencies, for one
+    EF_RUNTIME value. The queries are stored documents, so each one is held
+    out of its own results: the exact search skips it and the index is asked
+    for one extra result with the query's key removed."""
+    # Exact top k for every query at once, without the query itself
+    scores = matrix[queries] @ matrix.T
+    scores[np.arange(len(queries)), queries] = -np.inf
+    exact = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    recalls, latencies = [], []
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        vector = matrix[query].astype(VECTOR_TYPES[vector_type]).tobytes()
+        found = knn_search(
+            redis_client, index_name, vector, k + 1, ef_runtime)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found = [key for key in found if key != keys[query]][:k]
+        expected = {keys[i] for i in expected}
+        recalls.append(len(expected.intersection(found)) / k)
+    return {
+        "ef_runtime": ef_runtime,
+        "recall_at_k": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure recall@k and latency of a vector index config.")
+    add_index_arguments(parser)
+    parser.add_argument(
+        "--ef-runtime-values", type=int, nargs="+", default=[10, 50, 100, 200],
+        help="the EF_RUNTIME values to measure (HNSW only)")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    # The embeddings are binary, so responses must not be decoded
+    r = redis.from_url(url=os.getenv("REDIS_URL", ""))
+    keys, matrix = load_vectors(r, args.prefix, args.vector_type)
+    if len(keys) <= args.k:
+        raise Exception(f"Only found {len(keys)} documents under {args.prefix}")
+    args.dim = matrix.shape[1]
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(keys), min(args.queries, len(keys)), replace=False)
+
+    index_name = f"{args.index_name}_tune_{os.getpid()}"
+    create_index(r, index_name, args.prefix, **schema_kwargs_from_args(args))
+    try:
+        wait_for_indexing(r, index_name)
+        ef_values = args.ef_runtime_values if args.algorithm == "HNSW" else [None]
+        results = [
+            evaluate(r, index_name, keys, matrix, queries, args.k, ef,
+                     args.vector_type)
+            for ef in ef_values
+        ]
+    finally:
+        # Drop the temporary index but keep the documents
+        r.ft(index_name).dropindex(delete_documents=False)
+
+    config = {**schema_kwargs_from_args(args), "k": args.k, "docs": len(keys)}
+    if args.json:
+        print(json.dumps({"config": config, "results": results}, indent=2))
+        return
+    print(config)
+    print(f"{'EF_RUNTIME':>10} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        print(f"{str(result['ef_runtime']):>10} {result['recall_at_k']:>9.3f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
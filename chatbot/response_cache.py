@@ -0,0 +1,403 @@
+import hashlib
+import time
+
+from typing import TYPE_CHECKING
+
+import openai
+
+from chatbot.embedding_cache import (
+    BaseEmbeddingCache,
+    aget_embedding,
+    get_embedding,
+)
+from chatbot.embedding_batcher import EmbeddingBatcher
+from chatbot.rate_limiter import RateLimiter
+
+if TYPE_CHECKING:
+    from redis.commands.search.query import Query
+
+
+class BaseResponseCache:
+    """Base class for a cache of the chatbot's replies. Before calling the
+    completion API, :class:`chatbot.chatbot.ChatBot` asks the cache for a reply
+    to the query, and stores the new reply in it afterwards. This interface is
+    assumed to be implemented by the :class:`chatbot.chatbot.ChatBot`, so any
+    new child classes must implement :meth:`lookup` and :meth:`store`.
+
+    The cached reply only depends on the query and the context, not on the
+    conversation history, so this is meant for stateless bots (like the
+    FastAPI example with ``memory_length=1``).
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def context_id(context: str | None) -> str:
+        """Returns a short id for the retrieved context, so that a reply is
+        only reused when the same context would be sent with it.
+
+        :param context: The context for the query
+        :type context: str | None
+        :return: The id of the context
+        :rtype: str
+        """
+        if not context:
+            return "none"
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+
+    def lookup(self, user_query: str, context: str | None) -> str | None:
+        raise NotImplementedError
+
+    def store(self, user_query: str, context: str | None, reply: str):
+        raise NotImplementedError
+
+    async def alookup(
+            self, user_query: str, context: str | None) -> str | None:
+        """Async version of :meth:`lookup`, calls the sync method by default.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :return: The cached reply, or None
+        :rtype: str | None
+        """
+        return self.lookup(user_query, context)
+
+    async def astore(self, user_query: str, context: str | None, reply: str):
+        """Async version of :meth:`store`, calls the sync method by default.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :param reply: The chatbot's reply
+        :type reply: str
+        """
+        self.store(user_query, context, reply)
+
+    def warmup(self):
+        """Load and connect what the first lookup would otherwise wait for,
+        called by :meth:`chatbot.chatbot.ChatBot.warmup`. Does nothing by
+        default."""
+
+
+class ResponseCacheRedis(BaseResponseCache):
+    """Semantic cache of replies stored in Redis. Each entry holds the query
+    embedding, the id of the context and the reply, and is found with the
+    same Redis vector search used by :class:`chatbot.chatbot.KnowledgeBaseRedis`.
+    A cached reply is returned when a past query with the same context has a
+    cosine similarity of at least ``threshold`` with the new one.
+
+    Entries expire after ``ttl`` seconds, and the oldest ones are evicted when
+    there are more than ``max_entries``. The index is created by the first
+    :meth:`store`, until then every lookup is a miss.
+
+    :param redis_url: The URL for the Redis instance
+    :type redis_url: str
+    :param api_key: The API key for OpenAI's API
+    :type api_key: str
+    :param threshold: The minimum cosine similarity for a hit, defaults to
+        0.95
+    :type threshold: float, optional
+    :param ttl: How long to keep each reply, in seconds, defaults to one hour
+    :type ttl: int, optional
+    :param max_entries: The maximum number of cached replies, defaults to
+        10000
+    :type max_entries: int, optional
+    :param index_name: The name of the Redis search index, defaults to
+        "answers"
+    :type index_name: str, optional
+    :param prefix: The prefix for the cache keys, defaults to "answer:"
+    :type prefix: str, optional
+    :param embedding_cache: Cache for the query embeddings, defaults to None.
+        Share it with the knowledge base so each query is only embedded once.
+    :type embedding_cache: :class:`BaseEmbeddingCache`, optional
+    :param embedding_model: The embedding model, defaults to
+        "text-embedding-ada-002"
+    :type embedding_model: str, optional
+    :param embedding_batcher: Batches the query embeddings of concurrent
+        requests, defaults to None. Share it with the knowledge base.
+    :type embedding_batcher: :class:`EmbeddingBatcher`, optional
+    :param rate_limiter: Schedules and retries the embedding calls, defaults
+        to None. Share it with the knowledge base.
+    :type rate_limiter: :class:`RateLimiter`, optional
+    """
+
+    def __init__(
+            self,
+            redis_url: str,
+            api_key: str,
+            threshold: float = 0.95,
+            ttl: int = 3600,
+            max_entries: int = 10000,
+            index_name: str = "answers",
+            prefix: str = "answer:",
+            embedding_cache: BaseEmbeddingCache = None,
+            embedding_model: str = "text-embedding-ada-002",
+            embedding_batcher: EmbeddingBatcher = None,
+            rate_limiter: RateLimiter = None):
+        super().__init__()
+        openai.api_key = api_key
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_name = index_name
+        self.prefix = prefix
+        self.embedding_cache = embedding_cache
+        self.embedding_model = embedding_model
+        self.embedding_batcher = embedding_batcher
+        self.rate_limiter = rate_limiter
+        import redis
+        # The embeddings are binary, so responses must not be decoded
+        self.redis_url = redis_url
+        self.redis_client = redis.from_url(redis_url, socket_timeout=3.0)
+        self._async_redis_client = None
+        self._has_index = False
+
+    def _get_async_client(self):
+        """ Returns the async Redis client, creating it on first use. Not meant
+        to be called directly."""
+        if self._async_redis_client is None:
+            import redis.asyncio
+            self._async_redis_client = redis.asyncio.from_url(
+                self.redis_url, socket_timeout=3.0)
+        return self._async_redis_client
+
+    async def aclose(self):
+        """Close the async Redis connection pool, if it was opened."""
+        if self._async_redis_client is not None:
+            await self._async_redis_client.close()
+            self._async_redis_client = None
+
+    def warmup(self):
+        """Load the search modules and open a connection to Redis before
+        the first lookup."""
+        self._knn_query(None)
+        try:
+            self.redis_client.ping()
+        except Exception as e:
+            print("Error connecting to response cache: ", e)
+        if self.embedding_cache:
+            self.embedding_cache.warmup()
+
+    def lookup(self, user_query: str, context: str | None) -> str | None:
+        """Get a cached reply for a query similar to this one, with the same
+        context.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :return: The cached reply, or None
+        :rtype: str | None
+        """
+        vector = get_embedding(
+            user_query, self.embedding_model, self.embedding_cache,
+            self.embedding_batcher, self.rate_limiter)
+        try:
+            results = self.redis_client.ft(self.index_name).search(
+                self._knn_query(context), query_params={"vector": vector})
+        except Exception as e:
+            self._search_error(e)
+            results = None
+        return self._reply_from_results(results)
+
+    def store(self, user_query: str, context: str | None, reply: str):
+        """Add a reply to the cache, evicting the oldest replies if it's full.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :param reply: The chatbot's reply
+        :type reply: str
+        """
+        vector = get_embedding(
+            user_query, self.embedding_model, self.embedding_cache,
+            self.embedding_batcher, self.rate_limiter)
+        try:
+            self._ensure_index(len(vector) // 4)
+            self._add_entry(vector, context, reply)
+        except Exception as e:
+            print("Error writing response cache: ", e)
+
+    async def alookup(
+            self, user_query: str, context: str | None) -> str | None:
+        """Async version of :meth:`lookup`, the search runs on an async Redis
+        client so it doesn't block the event loop.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :return: The cached reply, or None
+        :rtype: str | None
+        """
+        vector = await aget_embedding(
+            user_query, self.embedding_model, self.embedding_cache,
+            self.embedding_batcher, self.rate_limiter)
+        try:
+            results = await self._get_async_client().ft(
+                self.index_name).search(
+                    self._knn_query(context), query_params={"vector": vector})
+        except Exception as e:
+            self._search_error(e)
+            results = None
+        return self._reply_from_results(results)
+
+    async def astore(self, user_query: str, context: str | None, reply: str):
+        """Async version of :meth:`store`, using the async Redis client.
+
+        :param user_query: The user's query
+        :type user_query: str
+        :param context: The context for the query
+        :type context: str | None
+        :param reply: The chatbot's reply
+        :type reply: str
+        """
+        vector = await aget_embedding(
+            user_query, self.embedding_model, self.embedding_cache,
+            self.embedding_batcher, self.rate_limiter)
+        try:
+            await self._aensure_index(len(vector) // 4)
+            await self._aadd_entry(vector, context, reply)
+        except Exception as e:
+            print("Error writing response cache: ", e)
+
+    def _knn_query(self, context: str | None) -> "Query":
+        """ Build the query for the closest cached query with the same
+        context. Not meant to be called directly."""
+        from redis.commands.search.query import Query
+        base_query = (
+            f"(@context_id:{{{self.context_id(context)}}})"
+            "=>[KNN 1 @embedding $vector AS vector_score]")
+        return (
+            Query(base_query)
+            .return_fields("reply", "vector_score")
+            .sort_by("vector_score")
+            .dialect(2))
+
+    @staticmethod
+    def _search_error(error: Exception):
+        """ Report a failed search, unless the index doesn't exist because
+        nothing was stored yet, which is just a miss. Not meant to be called
+        directly."""
+        message = str(error).lower()
+        if "no such index" in message or "unknown index" in message:
+            return
+        print("Error calling Redis search: ", error)
+
+    def _reply_from_results(self, results) -> str | None:
+        """ Returns the cached reply if the closest match is similar enough,
+        and updates the hit/miss counters. Not meant to be called directly."""
+        if results and results.docs:
+            doc = results.docs[0]
+            # The COSINE metric returns the distance, 1 - similarity
+            if 1.0 - float(doc.vector_score) >= self.threshold:
+                self.hits += 1
+                reply = doc.reply
+                return reply.decode("utf-8") if isinstance(reply, bytes) else reply
+        self.misses += 1
+        return None
+
+    def _index_definition(self, dim: int) -> dict:
+        """ The arguments to create the search index for the cache. Not meant
+        to be called directly."""
+        from redis.commands.search.field import (
+            TagField,
+            TextField,
+            VectorField,
+        )
+        from redis.commands.search.indexDefinition import (
+            IndexDefinition,
+            IndexType,
+        )
+        schema = [
+            TagField("context_id"),
+            TextField("reply", no_stem=True),
+            VectorField("embedding", "HNSW", {
+                "TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE"}),
+        ]
+        return {
+            "fields": schema,
+            "definition": IndexDefinition(
+                prefix=[self.prefix], index_type=IndexType.HASH),
+        }
+
+    def _ensure_index(self, dim: int):
+        """ Create the search index for the cache if it doesn't exist. Not
+        meant to be called directly."""
+        if self._has_index:
+            return
+        import redis
+        try:
+            self.redis_client.ft(self.index_name).info()
+        except redis.ResponseError:
+            self.redis_client.ft(self.index_name).create_index(
+                **self._index_definition(dim))
+        self._has_index = True
+
+    async def _aensure_index(self, dim: int):
+        """ Async version of :meth:`_ensure_index`. Not meant to be called
+        directly."""
+        if self._has_index:
+            return
+        import redis
+        search = self._get_async_client().ft(self.index_name)
+        try:
+            await search.info()
+        except redis.ResponseError:
+            await search.create_index(**self._index_definition(dim))
+        self._has_index = True
+
+    def _queue_entry(
+            self, pipe, vector: bytes, context: str | None,
+            reply: str) -> str:
+        """ Queue the commands that store a reply and drop expired entries on
+        a pipeline, the last one counts the entries left. The insertion times
+        are kept in a sorted set so the oldest entries can be found without
+        scanning. Returns the key of the sorted set. The key of the reply has
+        the id of the context, so the same query with another context doesn't
+        replace it. Not meant to be called directly."""
+        now = time.time()
+        context_id = self.context_id(context)
+        vector_id = hashlib.sha256(vector).hexdigest()[:16]
+        key = f"{self.prefix}{context_id}:{vector_id}"
+        entries = f"{self.prefix}entries"
+        pipe.hset(key, mapping={
+            "context_id": context_id,
+            "reply": reply,
+            "embedding": vector,
+        })
+        pipe.expire(key, self.ttl)
+        pipe.zadd(entries, {key: now})
+        pipe.zremrangebyscore(entries, "-inf", now - self.ttl)
+        pipe.zcard(entries)
+        return entries
+
+    def _add_entry(self, vector: bytes, context: str | None, reply: str):
+        """ Store a reply, then evict expired and excess entries. Not meant to
+        be called directly."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        entries = self._queue_entry(pipe, vector, context, reply)
+        count = pipe.execute()[-1]
+        if count > self.max_entries:
+            oldest = self.redis_client.zpopmin(entries, count - self.max_entries)
+            if oldest:
+                self.redis_client.delete(*[k for k, _ in oldest])
+
+    async def _aadd_entry(
+            self, vector: bytes, context: str | None, reply: str):
+        """ Async version of :meth:`_add_entry`. Not meant to be called
+        directly."""
+        client = self._get_async_client()
+        pipe = client.pipeline(transaction=False)
+        entries = self._queue_entry(pipe, vector, context, reply)
+        count = (await pipe.execute())[-1]
+        if count > self.max_entries:
+            oldest = await client.zpopmin(entries, count - self.max_entries)
+            if oldest:
+                await client.delete(*[k for k, _ in oldest])
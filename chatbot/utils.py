@@ -1,19 +1,188 @@
-import tiktoken
+import base64
+import functools
 
 # From: https://platform.openai.com/docs/guides/chat/introduction
 def num_tokens(messages, model, prompt=""):
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    num_tks = 0
-    for message in messages:
-        num_tks += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        for key, value in message.items():
-            if value:
-                num_tks += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tks += -1  # role is always required and always 1 token
+    encoding = get_encoding(model)
+    num_tks = sum(message_tokens(message, encoding) for message in messages)
     num_tks += 2  # every reply is primed with <im_start>assistant
     return num_tks + len(encoding.encode(prompt))
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding for the model. Loading an encoding is
+    slow, so it's only done once per model."""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def message_tokens(message, encoding):
+    """Returns the number of tokens used by a single message."""
+    num_tks = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+    for key, value in message.items():
+        if value:
+            num_tks += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tks += -1  # role is always required and always 1 token
+    return num_tks
+
+
+# Places to cut the context, from most to least preferred
+_BOUNDARIES = ("\n\n", "\n", ". ", "? ", "! ")
+
+
+def truncate_to_tokens(text, max_tokens, encoding, boundary_window=0.2):
+    """Returns the longest start of the text that fits in ``max_tokens``.
+    The text is only encoded once, and cut at the exact token boundary. If
+    there's a paragraph or sentence break in the last ``boundary_window``
+    fraction of what's kept, the text is cut there instead of mid sentence."""
+    if max_tokens <= 0:
+        return ""
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    # Cutting tokens can split a multi-byte character, so drop partial ones
+    cut = encoding.decode_bytes(tokens[:max_tokens]).decode(
+        "utf-8", errors="ignore")
+    earliest = int(len(cut) * (1 - boundary_window))
+    for boundary in _BOUNDARIES:
+        index = cut.rfind(boundary, earliest)
+        if index != -1:
+            return cut[:index + len(boundary)].rstrip()
+    return cut
+
+
+def pack_to_tokens(texts, max_tokens, encoding, separator="\n\n"):
+    """Joins as many of the texts as fit in ``max_tokens``, in order. Texts
+    that don't fit are skipped so a shorter one further down the list can
+    still be used, and if not even the first one fits, it's truncated. Used
+    to build the context from the most similar documents first."""
+    if not texts:
+        return None
+    if max_tokens is None:
+        return separator.join(texts)
+    packed, used = [], 0
+    for text in texts:
+        # Count the separator too
+        tokens = len(encoding.encode(text)) + 1
+        if used + tokens <= max_tokens:
+            packed.append(text)
+            used += tokens
+    if not packed:
+        packed.append(truncate_to_tokens(texts[0], max_tokens, encoding))
+    return separator.join(packed)
+
+
+def chunk_text(text, encoding, chunk_tokens=300, overlap_tokens=50):
+    """Splits the text into chunks of ``chunk_tokens`` tokens, each one
+    overlapping the previous one by ``overlap_tokens`` so that sentences cut
+    at a chunk boundary are still complete in one of the chunks. The text is
+    only encoded once."""
+    if overlap_tokens >= chunk_tokens:
+        raise ValueError("The overlap must be smaller than the chunk size.")
+    tokens = encoding.encode(text)
+    step = chunk_tokens - overlap_tokens
+    chunks = []
+    for start in range(0, max(len(tokens) - overlap_tokens, 1), step):
+        chunk = encoding.decode_bytes(tokens[start:start + chunk_tokens])
+        chunks.append(chunk.decode("utf-8", errors="ignore"))
+    return chunks
+
+
+# Vector field types supported by Redis, and the matching numpy types. numpy
+# is imported by the functions that need it, so importing this module (and
+# the chatbot) stays fast when there's no knowledge base
+VECTOR_TYPES = {"FLOAT32": "float32", "FLOAT16": "float16"}
+
+
+def embedding_to_bytes(embedding):
+    """Returns an embedding from the API as float32 bytes. Embeddings
+    requested with ``encoding_format="base64"`` are already the raw float32
+    bytes, so they're decoded without building a list of floats."""
+    if isinstance(embedding, str):
+        return base64.b64decode(embedding)
+    import numpy as np
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def compact_vector(vector, vector_type="FLOAT32", dim=None):
+    """Converts float32 embedding bytes to the vector type stored in the
+    index. If ``dim`` is given, only the first ``dim`` dimensions are kept
+    (Matryoshka-style truncation) and the vector is renormalized."""
+    if vector_type == "FLOAT32" and not dim:
+        return vector
+    import numpy as np
+    array = np.frombuffer(vector, dtype=np.float32)
+    if dim and dim < len(array):
+        array = array[:dim]
+        array = array / np.linalg.norm(array)
+    return array.astype(VECTOR_TYPES[vector_type]).tobytes()
+
+
+def reduce_dimensions(matrix, dim, pca=False):
+    """Reduces a matrix of normalized embeddings to ``dim`` dimensions,
+    returns the renormalized matrix and the projection (None when the
+    dimensions are truncated). The projection is the top ``dim`` principal
+    directions, queries are multiplied by it before searching."""
+    import numpy as np
+    if pca:
+        _, _, components = np.linalg.svd(matrix, full_matrices=False)
+        projection = components[:dim].T.astype(np.float32)
+        reduced = matrix @ projection
+    else:
+        projection = None
+        reduced = matrix[:, :dim]
+    norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+    return reduced / np.where(norms == 0, 1, norms), projection
+
+
+def quantize_int8(matrix):
+    """Scalar quantization of a float matrix to int8, with one scale per
+    dimension, returns the quantized matrix and the scales. ``matrix @ x`` is
+    approximately ``quantized @ (scales * x)``."""
+    import numpy as np
+    scales = np.abs(matrix).max(axis=0) / 127
+    scales[scales == 0] = 1
+    quantized = np.round(matrix / scales).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def max_marginal_relevance(
+        query, candidates, k, lambda_mult=0.5, dedupe_threshold=None):
+    """Picks up to ``k`` of the candidate vectors (the rows of a matrix) by
+    Maximal Marginal Relevance: each pick has the highest
+    ``lambda_mult * sim(query, c) - (1 - lambda_mult) * max(sim(c, picked))``,
+    so the documents are relevant to the query without repeating each other.
+    With ``lambda_mult=1`` it's the plain similarity ranking. Candidates with
+    a cosine similarity above ``dedupe_threshold`` to a pick are dropped as
+    duplicates. The similarities are computed once, as two matrix products,
+    and each pick only updates a vector. Returns the indices of the picks, in
+    order, and their MMR scores."""
+    import numpy as np
+    query = np.asarray(query, dtype=np.float32)
+    candidates = np.asarray(candidates, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1)
+    norms = np.linalg.norm(candidates, axis=1, keepdims=True)
+    candidates = candidates / np.where(norms == 0, 1, norms)
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    # The highest similarity of each candidate to the picks so far
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    picked, scores = [], []
+    while len(picked) < k and available.any():
+        mmr = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        picked.append(best)
+        scores.append(float(mmr[best]))
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+        if dedupe_threshold is not None:
+            available &= similarity[best] < dedupe_threshold
+    return picked, scores
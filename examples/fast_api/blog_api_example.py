@@ -1,9 +1,18 @@
+import json
 import os
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
-from chatbot import chatbot
+from chatbot import (
+  async_chatbot,
+  chatbot,
+  embedding_batcher,
+  embedding_cache,
+  rate_limiter,
+  response_cache,
+)
 
 description = """
 This is a simple API that uses OpenAI's GPT-3.5 API to answer questions about
@@ -31,19 +40,61 @@ app.add_middleware(
 
 prompt = """You are a helpful chatbot for Heath Henley's personal blog. The
 most relevant information from the blog to the query from the user is enclosed. Please answer the user's query using the information from the blog, if the information is not sufficient, please ask the user for more information.\n"""
-bot = chatbot.ChatBot(
+# Lots of the same questions get asked, so skip embedding them again, and
+# reuse the answers to near duplicate questions
+query_embeddings = embedding_cache.TwoTierEmbeddingCache(
+  local=embedding_cache.EmbeddingCacheLRU(max_size=1024),
+  shared=embedding_cache.EmbeddingCacheRedis(redis_url=os.getenv("REDIS_URL")))
+# Queries that arrive at the same time are embedded in one API call, and bursts
+# wait for quota instead of failing with rate limit errors
+query_batcher = embedding_batcher.EmbeddingBatcher(
+  max_wait=0.01, rate_limiter=rate_limiter.RateLimiter())
+bot = async_chatbot.AsyncChatBot(
   api_key=os.getenv("OPENAI_API_KEY"),
   prompt=prompt,
+  rate_limiter=rate_limiter.RateLimiter(
+    requests_per_minute=int(os.getenv("OPENAI_RPM", 3500)),
+    tokens_per_minute=int(os.getenv("OPENAI_TPM", 90000))),
   message_memory=chatbot.MessageMemory(memory_length=1),
-  knowledge_base=chatbot.KnowledgeBaseRedis(
+  knowledge_base=async_chatbot.AsyncKnowledgeBaseRedis(
+      redis_url=os.getenv("REDIS_URL"),
+      api_key=os.getenv("OPENAI_API_KEY"),
+      embedding_cache=query_embeddings,
+      embedding_batcher=query_batcher),
+  response_cache=response_cache.ResponseCacheRedis(
       redis_url=os.getenv("REDIS_URL"),
-      api_key=os.getenv("OPENAI_API_KEY"))
+      api_key=os.getenv("OPENAI_API_KEY"),
+      embedding_cache=query_embeddings,
+      embedding_batcher=query_batcher)
 )
 
+@app.on_event("startup")
+async def warmup_bot():
+  """ Load the tokenizer and connect to Redis before the first request."""
+  await bot.awarmup()
+
+@app.on_event("shutdown")
+async def close_bot():
+  """ Release the pooled HTTP and Redis connections."""
+  await bot.aclose()
+
 @app.get("/")
-def search_blog(user_query: str) -> str:
+async def search_blog(user_query: str) -> str:
   """ Search the blog for relevant information and return a response.
 
   Gets the most relevant information from the blog to the query
   and uses it as context when generating the response."""
-  return bot.get_reply(user_query)
+  return await bot.aget_reply(user_query)
+
+@app.get("/stream")
+async def stream_blog(user_query: str) -> StreamingResponse:
+  """ Same as the search endpoint, but streams the response back as
+  server-sent events while it's being generated.
+
+  Each event's data is a JSON encoded piece of the response, and a final
+  `done` event is sent when the response is complete."""
+  async def events():
+    async for delta in bot.aget_reply_stream(user_query):
+      yield f"data: {json.dumps(delta)}\n\n"
+    yield "event: done\ndata: \n\n"
+  return StreamingResponse(events(), media_type="text/event-stream")
@@ -18,17 +18,73 @@ A basic Hangouts Chat bot to interface with OpenAI's GPT-3.5 API.
 """
 import logging
 import os
+import threading
 
+import redis
 from flask import Flask, json, request
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+
+from chatbot import chatbot, dispatcher
+
+_local = threading.local()
+
+
+def memory_factory(session_id):
+    """Keep the history in Redis if there is one, so that every gunicorn
+    worker sees the same conversation, otherwise keep it in memory."""
+    if redis_client:
+        return chatbot.RedisMessageMemory(
+            redis_client, session_id, memory_length=10)
+    return chatbot.MessageMemory(memory_length=10)
+
+
+def chat_service():
+    """The Chat API client of the current thread (they aren't thread safe),
+    replies are posted with it since the webhook returns before they're
+    ready. Needs a service account key in GOOGLE_APPLICATION_CREDENTIALS."""
+    if not hasattr(_local, "service"):
+        credentials = service_account.Credentials.from_service_account_file(
+            os.getenv("GOOGLE_APPLICATION_CREDENTIALS"),
+            scopes=["https://www.googleapis.com/auth/chat.bot"])
+        _local.service = build(
+            "chat", "v1", credentials=credentials, cache_discovery=False)
+    return _local.service
+
+
+def post_reply(job, reply):
+    """Post the reply in the thread of the message."""
+    chat_service().spaces().messages().create(
+        parent=job.meta["space"],
+        body={"text": reply, "thread": {"name": job.meta["thread"]}}).execute()
+
+
+def post_error(job, error):
+    print(f"Error replying in {job.meta['space']}: {error}")
+    post_reply(
+        job, "I seem to have hit an uncharted obstacle. Please try again.")
 
-from chatbot import chatbot
 
 # Globals
 app = Flask(__name__)
+redis_client = None
+if os.getenv("REDIS_URL"):
+    redis_client = redis.from_url(
+        os.getenv("REDIS_URL"), decode_responses=True, socket_timeout=3.0)
+# Each space (room or DM) gets its own history.
 bot = chatbot.ChatBot(
     api_key=os.getenv("OPENAI_API_KEY"),
     prompt=os.getenv("PROMPT", chatbot.DEFAULT_PROMPT),
-    message_memory=chatbot.MessageMemory(memory_length=10))
+    session_store=chatbot.SessionMemoryStore(memory_factory=memory_factory))
+# Load the tokenizer when the worker starts rather than on the first message
+bot.warmup()
+# The webhook only queues the message and returns, the workers post the
+# replies. With Redis the queue is shared by all the gunicorn workers.
+if redis_client:
+    replies = dispatcher.RedisStreamDispatcher(
+        bot, post_reply, os.getenv("REDIS_URL"), on_error=post_error)
+else:
+    replies = dispatcher.ThreadDispatcher(bot, post_reply, on_error=post_error)
 
 @app.route('/', methods=['POST'])
 def home_post():
@@ -40,7 +96,9 @@ def home_post():
     if data['type'] == 'REMOVED_FROM_SPACE':
         logging.info('Bot removed from a space')
         return None
-    resp_dict = {'text' : format_response(data)}
+    text = format_response(data)
+    # An empty response, the reply is posted later
+    resp_dict = {'text' : text} if text else {}
     return json.jsonify(resp_dict)
 
 
@@ -57,11 +115,14 @@ def format_response(event):
         return f"Thanks for adding me to a DM, {event['user']['displayName']}!"
     # Case 3: The bot got a message
     if event['type'] == 'MESSAGE':
-        try:
-            return bot.get_reply(event['message']['text'])
-        except Exception as e:
-            print(e)
-            return "I seem to have hit an uncharted obstacle. Please try again."
+        queued = replies.submit(
+            event['space']['name'],
+            event['message']['text'],
+            {"space": event['space']['name'],
+             "thread": event['message']['thread']['name']})
+        if not queued:
+            return "I'm a bit busy right now, please try again in a minute."
+        return None
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@
 import os
 from slack_bolt import App
 
-from chatbot import chatbot
+from chatbot import chatbot, dispatcher
 
 
 def get_name_from_id(app, userid) -> str:
@@ -23,14 +23,33 @@ if __name__ == "__main__":
     # a prompt that we store in an environment variable for now. It should
     # be a blurb that describes the character of the chatbot - in this
     # case, John Wilson.
+    # Each channel gets its own history.
     bot = chatbot.ChatBot(
         api_key=os.getenv("OPENAI_API_KEY"),
         prompt=os.getenv("PROMPT", chatbot.DEFAULT_PROMPT),
-        message_memory=chatbot.MessageMemory(memory_length=5))
+        session_store=chatbot.SessionMemoryStore(
+            memory_factory=lambda session_id: chatbot.MessageMemory(
+                memory_length=5)))
+    # Load the tokenizer now rather than on the first message
+    bot.warmup()
     
     app = App(
         token=os.environ.get("SLACK_TOKEN"),
         signing_secret=os.environ.get("SLACK_SIGNING_SECRET"))
+
+    def post_reply(job, reply):
+        app.client.chat_postMessage(channel=job.meta["channel"], text=reply)
+
+    def post_error(job, error):
+        print(f"Error replying in {job.meta['channel']}: {error}")
+        app.client.chat_postMessage(
+            channel=job.meta["channel"],
+            text="You son of a.... something went wrong 🙃.")
+
+    # The handler only queues the message, so Slack gets its ack right away
+    # and the replies are posted by the worker threads when they're ready
+    replies = dispatcher.ThreadDispatcher(
+        bot, post_reply, workers=8, max_queue=100, on_error=post_error)
     
     # Handle messages that mention the bot in any channel where the bot is
     # invited. Check the slack docs for all the event types that can be
@@ -40,13 +59,12 @@ if __name__ == "__main__":
         message = event['text']
         who = get_name_from_id(app, event['user'])
         if message:
-            try:
-                say(bot.get_reply(f"{who} says: {message}"))
-            except Exception as e:
-                import traceback
-                print(traceback.format_exc())
-                print(e)
-                say("You son of a.... something went wrong 🙃.")
+            queued = replies.submit(
+                event['channel'],
+                f"{who} says: {message}",
+                {"channel": event['channel']})
+            if not queued:
+                say("I'm swamped, give me a minute and try again.")
         else:
             say("Knock it off! Something went wrong. Please try again.")
     
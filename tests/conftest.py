@@ -0,0 +1,28 @@
+import pytest
+
+
+class ByteEncoding:
+    """ Stands in for a tiktoken encoding, one token per byte, so the tests
+    don't download tiktoken's encodings."""
+
+    @staticmethod
+    def encode(text):
+        return list(text.encode("utf-8"))
+
+    @staticmethod
+    def decode_bytes(tokens):
+        return bytes(tokens)
+
+    @staticmethod
+    def decode(tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+
+@pytest.fixture
+def fake_tokenizer(monkeypatch):
+    """ Make every tokenizer a :class:`ByteEncoding`."""
+    tiktoken = pytest.importorskip("tiktoken")
+    monkeypatch.setattr(
+        tiktoken, "encoding_for_model", lambda model: ByteEncoding)
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: ByteEncoding)
+    return ByteEncoding
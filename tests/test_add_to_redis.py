@@ -0,0 +1,202 @@
+""" Tests of the incremental crawl in chatbot.redis_utils.add_to_redis,
+against a local blog served by http.server: a sitemap and two posts with
+ETags. The embeddings and the tokenizer are faked, so no API key or network
+access is needed.
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from chatbot.redis_utils import add_to_redis
+
+POSTS = {
+    "/posts/first/": "The first post, about vector search. " * 20,
+    "/posts/second/": "The second post, about crawling a blog. " * 20,
+}
+
+
+class Blog(BaseHTTPRequestHandler):
+    """ Serves the sitemap and the posts, with an ETag per post, and keeps
+    the headers of each post request. The posts in ``failing`` return an
+    error."""
+
+    requests = []
+    failing = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host = f"http://127.0.0.1:{self.server.server_port}"
+        if self.path == "/sitemap.xml":
+            urls = "".join(f"<url><loc>{host}{path}</loc></url>"
+                           for path in POSTS)
+            return self._send(200, (
+                '<?xml version="1.0"?><urlset xmlns='
+                f'"http://www.sitemaps.org/schemas/sitemap/0.9">{urls}'
+                "</urlset>").encode())
+        if self.path not in POSTS:
+            return self._send(404)
+        self.requests.append((self.path, dict(self.headers)))
+        if self.path in self.failing:
+            return self._send(500)
+        etag = f'"{add_to_redis.content_hash(POSTS[self.path])[:12]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        html = ('<html><section class="p-article__body">'
+                f"{POSTS[self.path]}</section></html>").encode()
+        self._send(200, html, {"ETag": etag, "Content-Type": "text/html"})
+
+
+@pytest.fixture
+def blog(monkeypatch, fake_tokenizer):
+    """ Start the blog, point the crawler at it and fake the embeddings and
+    the tokenizer. Returns the blog's url, the post requests and the
+    embedded texts."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Blog)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    requests, embedded = [], []
+    monkeypatch.setattr(Blog, "requests", requests)
+    monkeypatch.setattr(Blog, "failing", set())
+    monkeypatch.setattr(add_to_redis, "BLOG_URL", base_url)
+
+    def embed_texts(texts):
+        embedded.extend(texts)
+        return [np.ones(8, dtype=np.float32).tobytes() for _ in texts]
+
+    monkeypatch.setattr(add_to_redis, "embed_texts", embed_texts)
+    yield base_url, requests, embedded
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["add_to_redis", *args])
+    add_to_redis.main()
+
+
+def test_second_local_crawl_only_revalidates(blog, monkeypatch, tmp_path):
+    base_url, requests, embedded = blog
+    kb = str(tmp_path / "kb")
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    crawl(monkeypatch, "--local", kb, "--checkpoint", checkpoint)
+    assert len(requests) == 2
+    assert embedded
+    validators = add_to_redis.read_local_validators(kb)
+    assert set(validators) == {base_url + path for path in POSTS}
+
+    requests.clear()
+    embedded.clear()
+    crawl(monkeypatch, "--local", kb, "--checkpoint", checkpoint)
+    assert len(requests) == 2
+    for path, headers in requests:
+        assert headers["If-None-Match"] == \
+            validators[base_url + path]["etag"]
+    assert embedded == []
+    # The unchanged posts are kept, with their validators
+    assert add_to_redis.read_local_validators(kb) == validators
+    assert not os.path.exists(checkpoint)
+
+
+def test_failed_fetch_keeps_stored_post(blog, monkeypatch, tmp_path):
+    base_url, requests, embedded = blog
+    kb = str(tmp_path / "kb")
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    crawl(monkeypatch, "--local", kb, "--checkpoint", checkpoint)
+    with open(os.path.join(kb, "documents.jsonl"), encoding="utf-8") as f:
+        documents = f.read()
+    validators = add_to_redis.read_local_validators(kb)
+
+    Blog.failing.add("/posts/second/")
+    embedded.clear()
+    crawl(monkeypatch, "--local", kb, "--checkpoint", checkpoint)
+    assert embedded == []
+    with open(os.path.join(kb, "documents.jsonl"), encoding="utf-8") as f:
+        assert f.read() == documents
+    assert add_to_redis.read_local_validators(kb) == validators
+
+
+def test_resume_from_half_written_checkpoint(blog, monkeypatch, tmp_path):
+    base_url, requests, embedded = blog
+    kb = str(tmp_path / "kb")
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    first, second = (base_url + path for path in POSTS)
+    # A crawl that was killed after the first post, while writing the second
+    interrupted = add_to_redis.CrawlCheckpoint(
+        checkpoint, base_url, os.path.abspath(kb))
+    interrupted.start([first, second])
+    interrupted.record([(first, *add_to_redis.fetch_post(first))])
+    interrupted._file.write(json.dumps([second, "The sec"])[:20])
+    interrupted._file.close()
+    requests.clear()
+
+    crawl(monkeypatch, "--local", kb, "--checkpoint", checkpoint)
+    # Only the post that wasn't done is fetched, and both are stored
+    assert [path for path, _ in requests] == ["/posts/second/"]
+    assert set(add_to_redis.read_local_validators(kb)) == {first, second}
+    with open(os.path.join(kb, "documents.jsonl"), encoding="utf-8") as f:
+        assert {json.loads(line)["url"] for line in f} == {first, second}
+    assert not os.path.exists(checkpoint)
+
+
+def test_redis_crawl_stores_validators(blog, monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    base_url, requests, embedded = blog
+    db = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(add_to_redis.redis, "from_url", lambda **kw: db)
+    crawl(monkeypatch, "--checkpoint", "")
+    urls = [base_url + path for path in POSTS]
+    validators = add_to_redis.stored_validators(db, urls)
+    assert set(validators) == set(urls)
+    # Stored in another vector format, the posts must be fetched again
+    assert add_to_redis.stored_validators(
+        db, urls, add_to_redis.vector_format("FLOAT16")) == {}
+
+    requests.clear()
+    embedded.clear()
+    crawl(monkeypatch, "--checkpoint", "")
+    assert len(requests) == 2
+    for path, headers in requests:
+        assert headers["If-None-Match"] == \
+            validators[base_url + path]["etag"]
+    assert embedded == []
+
+
+def test_checkpoint_of_another_vector_format_is_not_resumed(
+        blog, monkeypatch, tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    base_url, requests, embedded = blog
+    db = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(add_to_redis.redis, "from_url", lambda **kw: db)
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    first, second = (base_url + path for path in POSTS)
+    # A FLOAT32 crawl that was interrupted after the first post
+    interrupted = add_to_redis.CrawlCheckpoint(
+        checkpoint, base_url, "redis", add_to_redis.vector_format())
+    interrupted.start([first, second])
+    interrupted.record([(first, *add_to_redis.fetch_post(first))])
+    interrupted._file.close()
+    requests.clear()
+
+    crawl(monkeypatch, "--checkpoint", checkpoint, "--vector-type", "FLOAT16")
+    # The first post must be stored as FLOAT16 too
+    assert sorted(path for path, _ in requests) == sorted(POSTS)
+    assert set(add_to_redis.stored_validators(
+        db, [first, second], add_to_redis.vector_format("FLOAT16"))) == \
+        {first, second}
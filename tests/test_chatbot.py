@@ -0,0 +1,96 @@
+""" Tests of chatbot.chatbot.ChatBot, with the completion API and the
+tokenizer faked.
+
+    python -m pytest tests
+"""
+import time
+
+import openai
+import pytest
+
+from chatbot.chatbot import BaseKnowledgeBase, ChatBot, SessionMemoryStore
+from chatbot.instrumentation import CallbackInstrumentation
+
+
+class SlowKnowledgeBase(BaseKnowledgeBase):
+    """ Takes 10 ms to retrieve the contexts of any number of queries."""
+
+    def get_context(self, user_query):
+        return self.get_contexts([user_query])[0]
+
+    def get_contexts(self, user_queries):
+        time.sleep(0.01)
+        return [f"About {query}" for query in user_queries]
+
+
+@pytest.fixture
+def completions(monkeypatch, fake_tokenizer):
+    """ Fake the chat completion API, it replies "ok". Returns the messages
+    of each call."""
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["messages"])
+        return {
+            "choices": [{"message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"completion_tokens": 1},
+        }
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return calls
+
+
+def test_get_replies_records_the_prefetched_context(completions):
+    requests = []
+    bot = ChatBot(
+        "x",
+        knowledge_base=SlowKnowledgeBase(),
+        instrumentation=CallbackInstrumentation(on_request=requests.append))
+    items = ["first", ["second", "third"]]
+    results = {
+        result["id"]: result
+        for result in bot.get_replies(items, concurrency=2)}
+    assert results[0]["reply"] == "ok"
+    assert results[1]["replies"] == ["ok", "ok"]
+    assert len(requests) == 3
+    for metrics in requests:
+        # The 10 ms retrieval of the three queries, shared between them
+        assert metrics.stages["context"] >= 0.01 / 3
+
+
+def test_session_in_use_is_not_evicted():
+    store = SessionMemoryStore(max_sessions=1)
+    with store.session("a") as memory:
+        # Over the limit, but "a" is still answering a query
+        with store.session("b"):
+            pass
+        assert store.get("a") is memory
+    # Once released, the store is brought back within its limit
+    with store.session("c"):
+        pass
+    assert len(store) == 1
+
+
+def test_least_recently_used_session_is_evicted():
+    store = SessionMemoryStore(max_sessions=2)
+    for session_id in ("a", "b", "c"):
+        with store.session(session_id):
+            pass
+    memory = store.get("c")
+    assert len(store) == 2
+    assert store.get("c") is memory
+    assert "a" not in store._sessions
+
+
+def test_trimming_keeps_the_summary(fake_tokenizer):
+    bot = ChatBot("x")
+    summary = {"role": "system", "content": "Summary: they like HNSW."}
+    turns = [
+        {"role": "user", "content": "a" * 6000},
+        {"role": "assistant", "content": "b" * 6000},
+        {"role": "user", "content": "c" * 6000},
+    ]
+    message_list = [summary, *turns]
+    bot._trim_to_fit_token_limit(message_list, None)
+    # One token per byte, so only two of the turns fit
+    assert message_list == [summary, *turns[1:]]
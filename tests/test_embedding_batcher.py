@@ -0,0 +1,55 @@
+""" Tests of the async batching in chatbot.embedding_batcher, with the
+embedding API faked.
+
+    python -m pytest tests
+"""
+import asyncio
+
+import numpy as np
+import openai
+import pytest
+
+from chatbot.embedding_batcher import EmbeddingBatcher
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """ Fake the async embedding API, each text embeds to its length.
+    Returns the batches of texts it was called with."""
+    calls = []
+
+    async def acreate(input, model, encoding_format=None):
+        calls.append(list(input))
+        await asyncio.sleep(0.05)
+        return {"data": [
+            {"index": i, "embedding": [float(len(text))]}
+            for i, text in enumerate(input)
+        ]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", acreate)
+    return calls
+
+
+def test_cancelled_leader_does_not_fail_the_batch(calls):
+    async def main():
+        batcher = EmbeddingBatcher(max_wait=0.01)
+        model = "text-embedding-ada-002"
+        leader = asyncio.create_task(batcher.aembed("a", model))
+        await asyncio.sleep(0)
+        followers = [
+            asyncio.create_task(batcher.aembed(text, model))
+            for text in ("bb", "ccc")
+        ]
+        # Cancel the caller that opened the batch while it's being sent
+        await asyncio.sleep(0.02)
+        leader.cancel()
+        results = await asyncio.gather(
+            leader, *followers, return_exceptions=True)
+        return batcher, results
+
+    batcher, results = asyncio.run(main())
+    assert calls == [["a", "bb", "ccc"]]
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert [np.frombuffer(vector, dtype=np.float32)[0]
+            for vector in results[1:]] == [2.0, 3.0]
+    assert batcher.stats()["batches"] == 1
@@ -0,0 +1,44 @@
+""" Tests of the knowledge bases: the Redis search queries they build (no
+Redis server is needed to build them) and the local files.
+
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from chatbot.chatbot import (
+    KnowledgeBaseLocal,
+    KnowledgeBaseRedis,
+    write_knowledge_base_local,
+)
+
+
+def limit(args):
+    """ The offset and number of results of FT.SEARCH arguments."""
+    index = args.index("LIMIT")
+    return args[index + 1], args[index + 2]
+
+
+def test_knn_query_returns_top_k():
+    kb = KnowledgeBaseRedis("redis://localhost:6379", "x", top_k=15)
+    args = kb._knn_query(kb.top_k).get_args()
+    assert "KNN 15" in args[0]
+    assert limit(args) == (0, 15)
+
+
+def test_rerank_candidates_are_all_returned():
+    kb = KnowledgeBaseRedis(
+        "redis://localhost:6379", "x", mmr_lambda=0.5, fetch_k=20)
+    args = kb._vector_search_args(b"\0" * 16, kb.top_k)
+    assert args[:2] == ["FT.SEARCH", "posts"]
+    assert "KNN 20" in args[2]
+    assert limit(args) == (0, 20)
+
+
+@pytest.mark.parametrize("compact_kwargs", [
+    {}, {"dtype": "int8"}, {"dtype": "float16", "dim": 256}])
+def test_empty_local_knowledge_base(tmp_path, compact_kwargs):
+    write_knowledge_base_local(str(tmp_path), [], [], **compact_kwargs)
+    kb = KnowledgeBaseLocal(str(tmp_path), "x")
+    query = np.ones(1536, dtype=np.float32).tobytes()
+    assert kb.search(query, 4) == []
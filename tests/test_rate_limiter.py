@@ -0,0 +1,64 @@
+""" Tests of chatbot.rate_limiter.RateLimiter, with fake API methods.
+
+    python -m pytest tests
+"""
+import threading
+import time
+
+from chatbot import instrumentation
+from chatbot.instrumentation import CallbackInstrumentation
+from chatbot.rate_limiter import RateLimiter
+
+
+def slow_first_call(delay: float = 0.2):
+    """ An API method whose first call is slow and the next ones fast, each
+    timed as an "api" stage of the current request."""
+    calls = []
+    lock = threading.Lock()
+
+    def create(**kwargs):
+        with lock:
+            calls.append(kwargs)
+            first = len(calls) == 1
+        with instrumentation.stage("api"):
+            time.sleep(delay if first else 0.01)
+        return {"first": first}
+
+    return create, calls
+
+
+def test_hedged_calls_record_to_the_request():
+    create, calls = slow_first_call()
+    limiter = RateLimiter(hedge_after=0.05)
+    requests = []
+    hooks = CallbackInstrumentation(on_request=requests.append)
+    with instrumentation.request(hooks, "test"):
+        response = limiter.call(create)
+    assert response == {"first": False}
+    assert len(calls) == 2
+    # The hedge's stage, recorded in a worker thread
+    assert requests[0].stages["api"] >= 0.01
+
+
+def test_hedged_calls_take_a_slot():
+    create, calls = slow_first_call()
+    limiter = RateLimiter(hedge_after=0.05)
+    seen = []
+
+    def counted(**kwargs):
+        seen.append(limiter.in_flight)
+        return create(**kwargs)
+
+    assert limiter.call(counted) == {"first": False}
+    assert seen == [1, 2]
+    # The slower call left in the background frees its slot once it's done
+    time.sleep(0.3)
+    assert limiter.in_flight == 0
+
+
+def test_no_hedge_without_a_free_slot():
+    create, calls = slow_first_call()
+    limiter = RateLimiter(hedge_after=0.05, max_concurrency=1)
+    assert limiter.call(create) == {"first": True}
+    assert len(calls) == 1
+    assert limiter.stats()["hedges"] == 0
@@ -0,0 +1,51 @@
+""" Tests of chatbot.response_cache.ResponseCacheRedis, with the embeddings
+faked and fakeredis instead of a Redis server (it has no search, so only the
+storage is tested).
+
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+import redis
+
+from chatbot import response_cache
+from chatbot.response_cache import ResponseCacheRedis
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """ A cache whose queries all embed to the same vector."""
+    vector = np.ones(8, dtype=np.float32).tobytes()
+    monkeypatch.setattr(
+        response_cache, "get_embedding", lambda *args: vector)
+    cache = ResponseCacheRedis("redis://localhost:6379", "x")
+    cache.redis_client = fakeredis.FakeRedis()
+    # fakeredis can't create the index
+    cache._has_index = True
+    return cache
+
+
+def test_same_query_is_stored_per_context(cache):
+    cache.store("What's HNSW?", "context one", "reply one")
+    cache.store("What's HNSW?", "context two", "reply two")
+    keys = [
+        key for key in cache.redis_client.scan_iter(match="answer:*")
+        if key != b"answer:entries"]
+    replies = {cache.redis_client.hget(key, "reply") for key in keys}
+    assert replies == {b"reply one", b"reply two"}
+
+
+class MissingIndex:
+    """ The search commands of an index that doesn't exist."""
+
+    def search(self, *args, **kwargs):
+        raise redis.ResponseError("answers: no such index")
+
+
+def test_missing_index_is_a_silent_miss(cache, capsys):
+    cache.redis_client.ft = lambda index_name: MissingIndex()
+    assert cache.lookup("What's HNSW?", None) is None
+    assert cache.misses == 1
+    assert capsys.readouterr().out == ""